@@ -25,7 +25,7 @@ class RandomPlayer:
 
 if __name__=='__main__':
     generator = gui.GuiNChessGenerator(number_of_players=4, player_type_list=[RandomPlayer]*4)
-    game = gui.GuiGame(generator)
+    game = gui.GuiGame(generator, [thc.ConsolePrinter()])
     game.set_halfboards(generator)
     winner = game.play(max_moves=100)
     print "The winner is " , winner
@@ -0,0 +1,212 @@
+"""
+Animations of recorded games.
+
+The games of a record file (see records.py) are replayed and drawn with the
+board geometry of gui.py, one frame per position: before the first move
+and after every move. The frames of every game are split into chunks that
+are rendered in a pool of worker processes. Every worker keeps one GuiGame
+and its BoardRenderer per board size, restores the start position for a
+chunk, applies the moves before it and draws the frames of the chunk
+incrementally.
+
+A game is written as a directory of PNG frames, <out>/game<k>/frame<n>.png,
+or as one animated PNG (APNG), <out>/game<k>.png. Every APNG frame after the
+first only holds the rectangle that changed since the frame before, so the
+files stay small and fast to encode. Browsers show APNGs animated; other
+viewers show the first frame.
+
+python animate.py games.rec --out animations --games 0 1 2 --processes 8
+python animate.py games.rec --out frames --format frames
+"""
+
+import argparse
+import multiprocessing
+import os
+import struct
+import zlib
+
+import numpy as np
+
+import threechess as thc
+import records
+import gui
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+# fcTL: sequence number, width, height, x and y offset, delay numerator and
+# denominator (seconds), dispose and blend operation
+FRAME_CONTROL = struct.Struct('>IIIIIHHBB')
+
+def png_chunk(kind, data):
+    return (struct.pack('>I', len(data)) + kind + data
+            + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+def encode_rows(pixels, level=6):
+    """
+    The zlib compressed image data of an RGB array, without filtering.
+    """
+    height, width = pixels.shape[:2]
+    rows = np.zeros((height, 1 + 3*width), dtype=np.uint8)
+    rows[:, 1:] = pixels.reshape(height, 3*width)
+    return zlib.compress(rows.tostring(), level)
+
+def changed_rectangle(frame, previous):
+    """
+    The smallest (x, y, width, height) rectangle holding all pixels in which
+    frame differs from previous; the whole frame if previous is None.
+    """
+    height, width = frame.shape[:2]
+    if previous is None:
+        return 0, 0, width, height
+    diff = (frame!=previous).any(axis=2)
+    rows = np.nonzero(diff.any(axis=1))[0]
+    if len(rows)==0:
+        return 0, 0, 1, 1
+    cols = np.nonzero(diff.any(axis=0))[0]
+    return cols[0], rows[0], cols[-1]-cols[0]+1, rows[-1]-rows[0]+1
+
+def write_apng(path, size, frames, delay=0.5, plays=0):
+    """
+    Write an animated PNG of frames, (x, y, width, height, data) tuples of
+    the encoded changed rectangles (the first one the whole image of size
+    (width, height)), shown delay seconds each. plays=0 loops forever.
+    """
+    width, height = size
+    delay_num = int(round(delay*1000))
+    f = open(path, 'wb')
+    try:
+        f.write(PNG_SIGNATURE)
+        f.write(png_chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        f.write(png_chunk('acTL', struct.pack('>II', len(frames), plays)))
+        sequence = 0
+        for k, (x, y, w, h, data) in enumerate(frames):
+            f.write(png_chunk('fcTL', FRAME_CONTROL.pack(sequence, w, h, x, y, delay_num, 1000, 0, 0)))
+            sequence += 1
+            if k==0:
+                f.write(png_chunk('IDAT', data))
+            else:
+                f.write(png_chunk('fdAT', struct.pack('>I', sequence) + data))
+                sequence += 1
+        f.write(png_chunk('IEND', ''))
+    finally:
+        f.close()
+
+# the games of a worker process per board size, see render_chunk
+worker_games = {}
+
+def board_game(n_players, n_rows, n_cols):
+    """
+    A GuiGame in the start position of a board, with its start snapshot.
+    """
+    key = (n_players, n_rows, n_cols)
+    if key not in worker_games:
+        if (n_rows, n_cols)!=(4, 8):
+            raise ValueError("gui.py only draws boards of 4x8 nodes per player")
+        generator = gui.GuiNChessGenerator(n_players, n_rows, n_cols, [thc.Player]*n_players)
+        game = gui.GuiGame(generator)
+        worker_games[key] = (game, game.snapshot())
+    game, start = worker_games[key]
+    game.restore(start)
+    return game
+
+def render_chunk(task):
+    """
+    Render the frames first to last (exclusive) of a game. A task is
+    (packed record, first, last, target), where target is a frame directory
+    or None. Frames are written to the directory, otherwise returned as the
+    (x, y, width, height, data) rectangles that changed since the frame
+    before (the whole frame for frame 0).
+    """
+    data, first, last, target = task
+    record = records.GameRecord.unpack(data)
+    game = board_game(record.n_players, record.n_rows, record.n_cols)
+    node_list = game.node_list
+    def apply_move(k):
+        start, end = record.moves[k]
+        game.make_move(thc.Move(game.board[start], node_list[start], node_list[end]))
+    previous = None
+    for k in range(max(first-1, 0)):
+        apply_move(k)
+    if first>0:
+        previous = game.render()[:, :, :3]
+        apply_move(first-1)
+    frames = []
+    for n in range(first, last):
+        if n>first:
+            apply_move(n-1)
+        frame = game.render()[:, :, :3]
+        if target is not None:
+            gui.write_frame(os.path.join(target, 'frame%04d.png' % n), frame)
+        else:
+            x, y, w, h = changed_rectangle(frame, previous)
+            frames.append((x, y, w, h, encode_rows(frame[y:y+h, x:x+w])))
+        previous = frame
+    return frames
+
+def chunk_tasks(data, n_frames, chunk, target):
+    return [(data, k, min(k+chunk, n_frames), target) for k in range(0, n_frames, chunk)]
+
+def export(path, out, games=None, format='apng', processes=None, chunk=64, delay=0.5):
+    """
+    Animate the games with the given indices (all by default) of the record
+    file path into the directory out. Returns the paths written.
+    """
+    if format not in ('apng', 'frames'):
+        raise ValueError("Unknown format " + str(format))
+    reader = records.GameRecordReader(path)
+    if games is None:
+        games = range(len(reader))
+    if not os.path.isdir(out):
+        os.makedirs(out)
+    tasks = []
+    outputs = []
+    for k in games:
+        record = reader[k]
+        n_frames = len(record)+1
+        if format=='frames':
+            target = os.path.join(out, 'game%06d' % k)
+            if not os.path.isdir(target):
+                os.makedirs(target)
+        else:
+            target = os.path.join(out, 'game%06d.png' % k)
+        game_tasks = chunk_tasks(record.pack(), n_frames, chunk, target if format=='frames' else None)
+        tasks.extend(game_tasks)
+        outputs.append((target, len(game_tasks)))
+    reader.close()
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    pool = None
+    if processes>1:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap(render_chunk, tasks)
+    else:
+        results = (render_chunk(task) for task in tasks)
+    try:
+        for (target, n_chunks) in outputs:
+            frames = []
+            for k in range(n_chunks):
+                frames.extend(results.next())
+            if format=='apng':
+                x, y, w, h, data = frames[0]
+                write_apng(target, (w, h), frames, delay)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return [target for (target, n_chunks) in outputs]
+
+def main():
+    parser = argparse.ArgumentParser(description="Animate recorded games.")
+    parser.add_argument('path', help="record file, see records.py")
+    parser.add_argument('--out', default='animations')
+    parser.add_argument('--games', type=int, nargs='+', default=None,
+                        help="indices of the games (default: all)")
+    parser.add_argument('--format', choices=('apng', 'frames'), default='apng')
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--chunk', type=int, default=64, help="frames per task")
+    parser.add_argument('--delay', type=float, default=0.5, help="seconds per frame")
+    args = parser.parse_args()
+    written = export(args.path, args.out, args.games, args.format, args.processes, args.chunk, args.delay)
+    print "%d games written to %s" % (len(written), args.out)
+
+if __name__=='__main__':
+    main()
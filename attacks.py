@@ -0,0 +1,162 @@
+"""
+Cached move lists per piece.
+
+AttackMapMoveGenerator keeps the moves of every piece between moves,
+together with what they were computed from: the node and move count of the
+piece, and the occupancy of the nodes its moves depend on (see read_nodes),
+as masks of the occupancy bitboards of the game:
+
+king     the neighbors
+pawn     the nodes one and two steps forward and the diagonal neighbors
+knight   the jump targets
+slider   the nodes of its rays up to and including the first piece on them
+
+A cached list is used as long as the piece has not moved and none of these
+nodes changed its occupancy, which is checked with two operations on the
+bitboards when the moves are asked for. Nothing is done when a move is made
+or taken back, so a search pays only for the pieces whose moves are asked
+for and have changed. The cached lists are the attack map of the position:
+Game.king_attacked looks the king up in the lists of the other players.
+
+game = thc.Game(generator, move_generator=attacks.AttackMapMoveGenerator)
+"""
+
+import threechess as thc
+
+def read_nodes(p, square):
+    """
+    The indices of the nodes whose occupancy the moves of piece p on the
+    node square depend on, for pieces other than sliders.
+    """
+    nodes = []
+    if isinstance(p, thc.King):
+        nodes = [j for targets in p.view[square] for j in targets]
+    elif isinstance(p, thc.Pawn):
+        view = p.view
+        for s in view[square][p.forward]:
+            nodes.append(s)
+            nodes.extend(view[s][p.forward])
+        for d in p.diagonals:
+            nodes.extend(view[square][d])
+    elif isinstance(p, thc.KnightLike):
+        nodes = p.targets[square]
+    else:
+        raise TypeError("No read mask for " + str(p))
+    return nodes
+
+class AttackMapMoveGenerator(thc.PieceMoveGenerator):
+    """
+    Generates moves from per piece move lists that are computed again only
+    when their piece moved or the occupancy of their read mask changed. The
+    pieces are numbered by their position in game.pieces (their number
+    attribute). self.cache holds per piece number the tuple (node, move
+    count, read mask, occupied nodes and own nodes of the mask, moves) of
+    its last refresh.
+    """
+    def __init__(self, game):
+        thc.PieceMoveGenerator.__init__(self, game)
+        n_nodes = game.topology.n_nodes
+        # read masks per node, shared by the pieces of a kind and owner
+        shared = {}
+        self.masks = []
+        self.refreshers = []
+        for k, p in enumerate(game.pieces):
+            p.number = k
+            key = (p.kind, p.owner.id)
+            if key not in shared:
+                shared[key] = [None]*n_nodes
+            self.masks.append(shared[key])
+            if isinstance(p, thc.DecideAndContinuePiece):
+                self.refreshers.append(self.refresh_slider)
+            else:
+                self.refreshers.append(self.refresh_piece)
+        self.cache = [(-1, -1, 0, 0, 0, None)]*len(game.pieces)
+
+    def refresh(self, p):
+        """
+        Compute the moves of p and remember what they depend on.
+        """
+        return self.refreshers[p.number](p)
+
+    def refresh_piece(self, p):
+        k = p.number
+        square = p.square
+        mask = self.masks[k][square]
+        if mask is None:
+            bits = self.game.topology.bits
+            mask = 0
+            for j in read_nodes(p, square):
+                mask |= bits[j]
+            self.masks[k][square] = mask
+        game = self.game
+        moves = p.get_move_indices()
+        self.cache[k] = (square, p.moved, mask, game.occupied & mask, game.occupancy[p.owner.id] & mask, moves)
+        return moves
+
+    def refresh_slider(self, p):
+        """
+        The moves of a slider, with the read mask found on the way.
+        """
+        game = self.game
+        board = game.board
+        bits = game.topology.bits
+        owner = p.owner
+        rays = p.rays[p.square]
+        moves = []
+        mask = 0
+        for d in p.initial_directions:
+            for path in rays[d]:
+                for j in path:
+                    mask |= bits[j]
+                    if board[j] is None:
+                        moves.append(j)
+                    else:
+                        if board[j].owner is not owner:
+                            moves.append(j)
+                        break
+        self.cache[p.number] = (p.square, p.moved, mask, game.occupied & mask,
+                                game.occupancy[owner.id] & mask, moves)
+        return moves
+
+    def piece_moves(self, p):
+        """
+        The moves of p; the list is kept by the generator and must not be
+        modified.
+        """
+        square, count, mask, occupied, own, moves = self.cache[p.number]
+        game = self.game
+        if (p.square==square and p.moved==count and game.occupied & mask==occupied
+                and game.occupancy[p.owner.id] & mask==own):
+            return moves
+        return self.refresh(p)
+
+    def moves(self, playerID):
+        game = self.game
+        playerID = int(playerID)
+        all_occupied = game.occupied
+        all_own = game.occupancy[playerID]
+        cache = self.cache
+        pieces = game.live_pieces[playerID]
+        for p in pieces:
+            square, count, mask, occupied, own, moves = cache[p.number]
+            if not (p.square==square and p.moved==count and all_occupied & mask==occupied
+                    and all_own & mask==own):
+                self.refresh(p)
+        return [(p, e) for p in pieces for e in cache[p.number][5]]
+
+    def iter_moves(self, playerID, captures_only=False, target=None):
+        return self.filter_moves(playerID, captures_only, target)
+
+    def king_attacked(self, playerID):
+        game = self.game
+        kings = game.get_pieces(playerID, thc.King.kind)
+        if not kings:
+            return False
+        square = kings[0].square
+        piece_moves = self.piece_moves
+        for k in range(game.n_players):
+            if k!=int(playerID):
+                for p in game.live_pieces[k]:
+                    if square in piece_moves(p):
+                        return True
+        return False
@@ -0,0 +1,239 @@
+"""
+Many random games at once.
+
+BatchSimulator plays B games on the same board in lockstep, every game a
+row of NumPy arrays over the node indices of the compiled topology: the
+piece codes of features.encode and whether the piece on a node has not
+moved yet. Every step generates the moves of the player to move for all
+games at once, picks one of them uniformly at random per game (like
+aiplayer.RandomPlayer) and applies them, with captures and the end of the
+game by king capture.
+
+The moves follow the rules of threechess.py, since they are looked up in
+tables built from the views and rays of Topology, which already contain the
+direction flip of Node.get_next_nodes and the seams of glue_halfboards:
+
+king     steps to empty neighbors only (kings do not capture)
+sliders  follow their rays up to the first piece, which they capture if it
+         belongs to another player
+knights  jump to every target not occupied by their owner
+pawns    step forward to an empty node, a second step if they have not
+         moved, and capture diagonally forward
+
+Moves are generated per piece: the (game, node) pairs of the pieces of the
+player to move are gathered from the arrays, and their paths looked up in
+padded tables of shape (nodes, paths, length).
+
+The order of moves is decided as by Game.play: when the queue of players
+to move runs short, a new order is appended, a random permutation per game
+with order='random' (as decided by RandomPlayer) or the players in turn
+with order='fixed'. A player without moves passes.
+
+python batchsim.py --boards 1000 --players 4 --max-moves 200
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+import threechess as thc
+from features import encode, pad_paths, n_kinds
+
+class BatchSimulator:
+    """
+    After start(n_boards) or load(games), step() plays one move in every
+    game that is not over. self.boards, self.unmoved, self.winner (-1
+    while a game is not over) and self.plies hold the state of the games.
+    With record=True, self.history holds (movers, starts, ends) per step,
+    with start -1 for games that did not move.
+    """
+    def __init__(self, n_players, n_rows=4, n_cols=8, order='random', seed=None, record=False):
+        if order not in ('random', 'fixed'):
+            raise ValueError("Unknown order " + str(order))
+        self.generator = thc.NChessGenerator(n_players, n_rows, n_cols, [thc.Player]*n_players)
+        self.template = self.generator.get_template()
+        t = self.topology = self.template.topology
+        self.n_players = n_players
+        self.n_nodes = n = t.n_nodes
+        self.order = order
+        self.record = record
+        self.rnd = np.random.RandomState(seed)
+        # per owner: (kind, table, mode); 'move' follows a path up to the first
+        # piece, 'quiet' only moves to empty nodes, 'double' is the second pawn
+        # step and 'capture' only captures
+        self.plans = []
+        for o in range(n_players):
+            view = t.views[o]
+            rays = t.rays[o]
+            plans = [(thc.King.kind, pad_paths([[(j,) for d in range(8) for j in view[i][d]] for i in range(n)], n), 'quiet')]
+            for piece_type in (thc.Queen, thc.Bishop, thc.Rook):
+                paths = [[path for d in piece_type.initial_directions for path in rays[i][d]] for i in range(n)]
+                plans.append((piece_type.kind, pad_paths(paths, n), 'move'))
+            jumps = t.jump_targets(o, thc.Knight.move_orders)
+            plans.append((thc.Knight.kind, pad_paths([[(j,) for j in targets] for targets in jumps], n), 'move'))
+            forward = thc.Pawn.forward
+            plans.append((thc.Pawn.kind, pad_paths([[(j,) for j in view[i][forward]] for i in range(n)], n), 'quiet'))
+            doubles = [[(s, j) for s in view[i][forward] for j in view[s][forward]] for i in range(n)]
+            plans.append((thc.Pawn.kind, pad_paths(doubles, n), 'double'))
+            captures = [[(j,) for d in thc.Pawn.diagonals for j in view[i][d]] for i in range(n)]
+            plans.append((thc.Pawn.kind, pad_paths(captures, n), 'capture'))
+            self.plans.append(plans)
+        self.initial = np.zeros(n, dtype=np.int8)
+        for (piece_type, owner, square) in self.template.layout:
+            self.initial[square] = 1 + owner*n_kinds + piece_type.kind
+
+    def start(self, n_boards):
+        """
+        Set up n_boards games in the initial position.
+        """
+        self.boards = np.tile(self.initial, (n_boards, 1))
+        self.unmoved = self.boards!=0
+        self.reset_state(n_boards)
+        self.queue = [np.full(n_boards, k, dtype=np.intp) for k in range(self.n_players)]
+
+    def load(self, games):
+        """
+        Continue from the positions of games (thc.Game objects on the board
+        of the simulator), with the players to move that their move lists
+        already hold. The move lists must be equally long.
+        """
+        self.boards = np.array([encode(g) for g in games], dtype=np.int8)
+        self.unmoved = np.array([[p is not None and not p.moved for p in g.board] for g in games])
+        self.reset_state(len(games))
+        self.winner[:] = [-1 if g.winner is None else int(g.winner.playerID) for g in games]
+        self.queue = [np.array(column, dtype=np.intp)
+                      for column in zip(*[[int(p.playerID) for p in g.move_list] for g in games])]
+
+    def reset_state(self, n_boards):
+        self.n_boards = n_boards
+        self.winner = np.full(n_boards, -1, dtype=np.intp)
+        self.plies = np.zeros(n_boards, dtype=np.intp)
+        self.history = []
+
+    def decide_order(self):
+        """
+        Append one order of all players to the queue of every game.
+        """
+        if self.order=='random':
+            orders = np.argsort(self.rnd.random_sample((self.n_boards, self.n_players)), axis=1)
+        else:
+            orders = np.tile(np.arange(self.n_players), (self.n_boards, 1))
+        self.queue.extend(orders.T)
+
+    def moves(self, rows, owner):
+        """
+        The moves of owner in the games rows (an index array) as arrays
+        (games, starts, ends), ordered by game. A target reached on two
+        paths is listed twice, like in Piece.get_move_indices.
+        """
+        n = self.n_nodes
+        boards = self.boards[rows]
+        padded = np.concatenate([boards, np.full((len(rows), 1), -1, dtype=boards.dtype)], axis=1)
+        empty = padded==0
+        enemy = (padded>0) & ((padded.astype(np.intp)-1)//n_kinds!=owner)
+        games, starts, ends = [], [], []
+        for (kind, table, mode) in self.plans[owner]:
+            present = boards==1 + owner*n_kinds + kind
+            if mode=='double':
+                present &= self.unmoved[rows]
+            b, i = np.nonzero(present)
+            if len(b)==0:
+                continue
+            paths = table[i]
+            g = b[:, None, None]
+            on_path = paths!=n
+            if mode=='quiet':
+                legal = on_path & empty[g, paths]
+            elif mode=='capture':
+                legal = on_path & enemy[g, paths]
+            elif mode=='double':
+                free = empty[g, paths]
+                legal = on_path & free & free[:, :, :1]
+                legal[:, :, 0] = False
+            else:
+                free = empty[g, paths]
+                reach = np.ones(paths.shape, dtype=bool)
+                if paths.shape[2]>1:
+                    reach[:, :, 1:] = np.cumprod(free[:, :, :-1], axis=2)
+                legal = on_path & reach & (free | enemy[g, paths])
+            k, p, l = np.nonzero(legal)
+            games.append(b[k])
+            starts.append(i[k])
+            ends.append(paths[k, p, l])
+        if not games:
+            empty_array = np.zeros(0, dtype=np.intp)
+            return empty_array, empty_array, empty_array
+        games = np.concatenate(games)
+        order = np.argsort(games, kind='mergesort')
+        return rows[games[order]], np.concatenate(starts)[order], np.concatenate(ends)[order]
+
+    def step(self):
+        """
+        Play one move in every game that is not over. Returns the number of
+        games that moved.
+        """
+        if len(self.queue)<=self.n_players:
+            self.decide_order()
+        movers = self.queue.pop(0)
+        starts = np.full(self.n_boards, -1, dtype=np.intp)
+        ends = np.full(self.n_boards, -1, dtype=np.intp)
+        active = np.nonzero(self.winner<0)[0]
+        for o in range(self.n_players):
+            rows = active[movers[active]==o]
+            if len(rows)==0:
+                continue
+            games, s, e = self.moves(rows, o)
+            if len(games)==0:
+                continue
+            counts = np.bincount(games, minlength=self.n_boards)
+            first = np.cumsum(counts) - counts
+            moving = rows[counts[rows]>0]
+            pick = first[moving] + (self.rnd.random_sample(len(moving))*counts[moving]).astype(np.intp)
+            starts[moving] = s[pick]
+            ends[moving] = e[pick]
+        moved = np.nonzero(starts>=0)[0]
+        s, e = starts[moved], ends[moved]
+        captured = self.boards[moved, e]
+        self.boards[moved, e] = self.boards[moved, s]
+        self.boards[moved, s] = 0
+        self.unmoved[moved, s] = False
+        self.unmoved[moved, e] = False
+        kings = moved[(captured>0) & ((captured.astype(np.intp)-1) % n_kinds==thc.King.kind)]
+        self.winner[kings] = movers[kings]
+        self.plies[moved] += 1
+        if self.record:
+            self.history.append((movers, starts, ends))
+        return len(moved)
+
+    def run(self, max_moves=200):
+        """
+        Step until every game is over or max_moves steps were made.
+        Returns the winners.
+        """
+        for k in range(max_moves):
+            if not (self.winner<0).any():
+                break
+            self.step()
+        return self.winner
+
+def main():
+    parser = argparse.ArgumentParser(description="Play many random games at once with numpy.")
+    parser.add_argument('--boards', type=int, default=1000)
+    parser.add_argument('--players', type=int, default=4)
+    parser.add_argument('--max-moves', type=int, default=200)
+    parser.add_argument('--order', choices=('random', 'fixed'), default='random')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    sim = BatchSimulator(args.players, order=args.order, seed=args.seed)
+    sim.start(args.boards)
+    start = time.time()
+    winners = sim.run(args.max_moves)
+    elapsed = time.time() - start
+    plies = sim.plies.sum()
+    print "%d games, %d without winner" % (args.boards, (winners<0).sum())
+    print "wins per seat: " + ", ".join("%d: %d" % (k, (winners==k).sum()) for k in range(args.players))
+    print "%.1fs, %.0f games/s, %.0f moves/s" % (elapsed, args.boards/elapsed, plies/elapsed)
+
+if __name__=='__main__':
+    main()
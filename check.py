@@ -0,0 +1,342 @@
+"""
+Consistency checks between the move generators and the modules that
+implement the rules or the board a second time.
+
+generators  the moves of every piece, the moves, captures and king attacks
+            of every player and the occupancy bitboards are the same with
+            the pieces and attacks move generators, along random games
+            made with do_move and partly taken back with unmake_move
+hashes      Game.hash equals compute_hash after every move and unmove, and
+            taking all moves back restores the start position and hash
+snapshots   game_from_snapshot and restore (onto a game that played other
+            moves) rebuild the snapshot, hash and moves of random positions,
+            for every move generator
+batchsim    the moves of BatchSimulator equal Game.generate_moves on random
+            positions, and the simulated games replay move by move in Game
+            to the same boards, winners and plies
+features    FeatureExtractor.mobility counts the moves (without double pawn
+            steps) and attacks that the pieces of threechess.py generate
+records     replaying a GameRecord rebuilds every snapshot of the game
+render      the incremental frames of GuiGame equal a full redraw, pixel
+            by pixel (needs matplotlib)
+sprt        the SPRT of tournament.py decides streams of equal scores (all
+            wins, all draws, all losses) after its minimal number of games
+            and random scores of a clearly stronger or equal player
+
+python check.py
+python check.py --players 3,4 --games 20 --checks generators batchsim
+
+exits with status 1 if a check fails.
+"""
+
+import argparse
+import collections
+import random
+import sys
+import traceback
+
+import numpy as np
+
+import threechess as thc
+import aiplayer
+import batchsim
+import features
+import gui
+import records
+import tournament
+from perft import parse_range
+
+def new_game(n_players, move_generator=thc.PieceMoveGenerator, player_type=thc.Player):
+    return thc.Game(thc.NChessGenerator(n_players, player_type_list=[player_type]*n_players),
+                    move_generator=move_generator)
+
+def move_pairs(game, playerID):
+    return sorted((p.square, e) for (p, e) in game.generate_moves(playerID))
+
+def random_move(game, playerID, rnd):
+    """
+    A random move of playerID as a Move, or None. The move is drawn from the
+    sorted (start, end) pairs, so that games with different move generators
+    make the same moves.
+    """
+    moves = move_pairs(game, playerID)
+    if not moves:
+        return None
+    start, end = rnd.choice(moves)
+    return thc.Move(game.board[start], game.node_list[start], game.node_list[end])
+
+def random_position(n_players, plies, rnd, move_generator=thc.PieceMoveGenerator):
+    game = new_game(n_players, move_generator)
+    for ply in range(plies):
+        if game.game_over:
+            break
+        move = random_move(game, ply % n_players, rnd)
+        if move is None:
+            break
+        game.make_move(move)
+    return game
+
+def generator_state(game):
+    """
+    Everything the move generator of game answers about its position.
+    """
+    g = game.move_generator
+    n = game.n_players
+    pieces = [(p.square, sorted(set(g.piece_moves(p)))) for p in game.pieces if p.alive]
+    players = [(move_pairs(game, k),
+                sorted((p.square, e) for (p, e) in g.iter_moves(k, captures_only=True)),
+                g.has_move(k), game.king_attacked(k)) for k in range(n)]
+    occupancy = [0]*n
+    for p in game.pieces:
+        if p.alive:
+            occupancy[int(p.owner)] |= 1 << p.square
+    assert occupancy==list(game.occupancy), "occupancy bitboards differ from the pieces"
+    assert game.occupied==reduce(lambda a, b: a | b, occupancy), "occupied differs from the pieces"
+    return pieces, players
+
+def check_generators(players, games, rnd):
+    names = sorted(thc.move_generator_names)
+    for n in players:
+        for k in range(games):
+            seed = rnd.getrandbits(32)
+            # the same game with every move generator, in lockstep
+            played = [new_game(n, thc.get_move_generator(name)) for name in names]
+            moves = random.Random(seed)
+            for ply in range(200):
+                states = [generator_state(g) for g in played]
+                for (name, state) in zip(names, states):
+                    assert state==states[0], ("%d players, game %d, ply %d: %s and %s generate different moves"
+                                              % (n, k, ply, names[0], name))
+                if played[0].game_over:
+                    break
+                move = random_move(played[0], ply % n, moves)
+                if move is None:
+                    break
+                takeback = moves.random()<0.2
+                for g in played:
+                    s, e = move.start.index, move.end.index
+                    g.do_move(thc.Move(g.board[s], g.node_list[s], g.node_list[e]))
+                    if takeback:
+                        g.unmake_move()
+                        g.do_move(thc.Move(g.board[s], g.node_list[s], g.node_list[e]))
+            for g in played:
+                while g.undo_stack:
+                    g.unmake_move()
+            states = [generator_state(g) for g in played]
+            assert all(s==states[0] for s in states), "%d players: the generators differ after unmaking" % n
+
+def check_hashes(players, games, rnd):
+    for n in players:
+        for k in range(games):
+            game = new_game(n)
+            start = game.snapshot()
+            start_hash = game.hash
+            for ply in range(200):
+                if game.game_over:
+                    break
+                move = random_move(game, ply % n, rnd)
+                if move is None:
+                    break
+                game.do_move(move)
+                assert game.hash==game.compute_hash(), "%d players, ply %d: hash after do_move" % (n, ply)
+                if rnd.random()<0.2:
+                    game.unmake_move()
+                    assert game.hash==game.compute_hash(), "%d players, ply %d: hash after unmake_move" % (n, ply)
+                    game.do_move(move)
+            while game.undo_stack:
+                game.unmake_move()
+                assert game.hash==game.compute_hash(), "%d players: hash while unmaking" % n
+            assert game.hash==start_hash, "%d players: the start hash is not restored" % n
+            assert game.snapshot()==start, "%d players: the start position is not restored" % n
+
+def pieces_state(game):
+    return [p and (p.kind, int(p.owner), p.moved) for p in game.board]
+
+def check_snapshots(players, games, rnd):
+    for name in sorted(thc.move_generator_names):
+        move_generator = thc.get_move_generator(name)
+        for n in players:
+            for k in range(games):
+                game = random_position(n, rnd.randint(0, 120), rnd, move_generator)
+                state = game.snapshot()
+                what = "%s, %d players, game %d" % (name, n, k)
+                rebuilt = thc.game_from_snapshot(state, move_generator=move_generator)
+                other = random_position(n, rnd.randint(1, 20), rnd, move_generator)
+                other.restore(state)
+                for g in (rebuilt, other):
+                    assert g.snapshot()==state, what + ": the snapshot differs"
+                    assert g.hash==game.hash==g.compute_hash(), what + ": the hash differs"
+                    assert [g.position_key(j) for j in range(n)]==[game.position_key(j) for j in range(n)], \
+                        what + ": the position keys differ"
+                    assert pieces_state(g)==pieces_state(game), what + ": the board differs"
+                    assert all(p is None or p.position.piece is p for p in g.board), what + ": nodes and board differ"
+                    assert generator_state(g)==generator_state(game), what + ": the moves differ"
+
+def check_batchsim(players, games, rnd):
+    for n in players:
+        positions = [random_position(n, rnd.randint(0, 80), rnd) for k in range(games)]
+        sim = batchsim.BatchSimulator(n, seed=rnd.getrandbits(32))
+        sim.load(positions)
+        for o in range(n):
+            rows, starts, ends = sim.moves(np.arange(len(positions)), o)
+            for (k, game) in enumerate(positions):
+                expected = collections.Counter((p.square, e) for (p, e) in game.generate_moves(o))
+                found = collections.Counter(zip(starts[rows==k], ends[rows==k]))
+                assert found==expected, "%d players, position %d: batchsim moves of player %d differ" % (n, k, o)
+        sim = batchsim.BatchSimulator(n, seed=rnd.getrandbits(32), record=True)
+        sim.start(games)
+        winners = sim.run(150)
+        for k in range(games):
+            game = new_game(n)
+            for (movers, starts, ends) in sim.history:
+                if game.game_over:
+                    assert starts[k]==-1, "%d players, game %d: batchsim moved after the end" % (n, k)
+                    continue
+                if starts[k]<0:
+                    assert not game.generate_moves(movers[k]), "%d players, game %d: batchsim passed" % (n, k)
+                    continue
+                assert (starts[k], ends[k]) in move_pairs(game, movers[k]), \
+                    "%d players, game %d: batchsim made an illegal move" % (n, k)
+                game.make_move(thc.Move(game.board[starts[k]], game.node_list[starts[k]], game.node_list[ends[k]]))
+            assert (features.encode(game)==sim.boards[k]).all(), "%d players, game %d: the boards differ" % (n, k)
+            winner = -1 if game.winner is None else int(game.winner.playerID)
+            assert winner==winners[k], "%d players, game %d: the winners differ" % (n, k)
+            assert len(game.undo_stack)==sim.plies[k], "%d players, game %d: the plies differ" % (n, k)
+
+def expected_mobility(game):
+    """
+    The moves and attacks of FeatureExtractor.mobility, from the pieces.
+    """
+    n = game.n_players
+    moves = [0]*n
+    attacks = np.zeros((n, game.topology.n_nodes), dtype=np.int64)
+    board = game.board
+    for o in range(n):
+        for p in game.live_pieces[o]:
+            targets = p.get_move_indices()
+            if isinstance(p, thc.Pawn) and not p.moved:
+                singles = p.view[p.square][p.forward]
+                targets = [j for j in targets if j in singles or board[j] is not None]
+            moves[o] += len(targets)
+            if isinstance(p, thc.Pawn):
+                attacked = [j for d in p.diagonals for j in p.view[p.square][d]]
+            elif isinstance(p, thc.King):
+                attacked = []
+            elif isinstance(p, thc.KnightLike):
+                attacked = list(p.targets[p.square])
+            else:
+                attacked = []
+                for d in p.initial_directions:
+                    for path in p.rays[p.square][d]:
+                        for j in path:
+                            attacked.append(j)
+                            if board[j] is not None:
+                                break
+            for j in attacked:
+                attacks[o, j] += 1
+    return moves, attacks
+
+def check_features(players, games, rnd):
+    for n in players:
+        extractor = features.FeatureExtractor(n)
+        positions = [random_position(n, rnd.randint(0, 150), rnd) for k in range(games)]
+        moves, attacks = extractor.mobility(np.array([features.encode(g) for g in positions]))
+        for (k, game) in enumerate(positions):
+            expected_moves, expected_attacks = expected_mobility(game)
+            assert list(moves[k])==expected_moves, "%d players, position %d: the mobility differs" % (n, k)
+            assert (attacks[k]==expected_attacks).all(), "%d players, position %d: the attacks differ" % (n, k)
+
+class Snapshots(thc.GameListener):
+    """
+    Collects the snapshot after every move of a game.
+    """
+    def __init__(self):
+        self.states = []
+
+    def move_made(self, game, move):
+        self.states.append(game.snapshot())
+
+def check_records(players, games, rnd):
+    for n in players:
+        for k in range(games):
+            random.seed(rnd.getrandbits(32))
+            game = new_game(n, player_type=aiplayer.RandomPlayer)
+            recorder = records.GameRecorder()
+            snapshots = Snapshots()
+            game.subscribe(recorder)
+            game.subscribe(snapshots)
+            game.play(200)
+            record = records.GameRecord.unpack(recorder.record.pack())
+            replayed = [g.snapshot() for g in records.replay(record)][1:]
+            assert replayed==snapshots.states, "%d players, game %d: the replay differs" % (n, k)
+
+def check_render(players, games, rnd):
+    for n in players:
+        random.seed(rnd.getrandbits(32))
+        generator = gui.GuiNChessGenerator(n, player_type_list=[aiplayer.RandomPlayer]*n)
+        game = gui.GuiGame(generator)
+        game.render()
+        for ply in range(games*10):
+            if game.game_over:
+                break
+            game.play_next_move()
+            frame = game.render().copy()
+            game.renderer.redraw()
+            assert np.array_equal(frame, game.renderer.frame()), \
+                "%d players, ply %d: the incremental frame differs from a full redraw" % (n, ply)
+
+def check_sprt(players, games, rnd):
+    for (score, expected) in ((1., 'H1'), (0.5, 'H0'), (0., 'H0')):
+        test = tournament.SPRT()
+        for k in range(test.min_games):
+            test.add(score)
+        assert test.decision()==expected, "constant score %.1f: %s" % (score, test)
+    test = tournament.SPRT(-50., 0.)
+    for k in range(test.min_games):
+        test.add(0.5)
+    assert test.decision()=='H1', "constant score 0.5 against elo0=-50: %s" % test
+    # small error rates, so that the check fails by chance only rarely
+    for (p, expected) in ((0.75, 'H1'), (0.5, 'H0')):
+        test = tournament.SPRT(alpha=0.001, beta=0.001)
+        while test.decision() is None and test.n<100000:
+            test.add(1. if rnd.random()<p else 0.)
+        assert test.decision()==expected, "random scores with mean %.2f: %s" % (p, test)
+
+checks = collections.OrderedDict([
+    ('generators', check_generators),
+    ('hashes', check_hashes),
+    ('snapshots', check_snapshots),
+    ('batchsim', check_batchsim),
+    ('features', check_features),
+    ('records', check_records),
+    ('render', check_render),
+    ('sprt', check_sprt),
+])
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the move generators and the modules built on the rules.")
+    parser.add_argument('--players', default='2-6', help="e.g. 3 or 2-6 or 3,4")
+    parser.add_argument('--games', type=int, default=10, help="games or positions per check and board")
+    parser.add_argument('--checks', nargs='+', default=list(checks), choices=list(checks))
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    players = parse_range(args.players)
+    failures = []
+    for name in args.checks:
+        rnd = random.Random(args.seed)
+        try:
+            checks[name](players, args.games, rnd)
+        except ImportError as e:
+            print "%-10s skipped: %s" % (name, e)
+            continue
+        except AssertionError as e:
+            traceback.print_exc()
+            failures.append("%s: %s" % (name, e))
+            continue
+        print "%-10s ok" % name
+    for f in failures:
+        print "FAILED:", f
+    return 1 if failures else 0
+
+if __name__=='__main__':
+    sys.exit(main())
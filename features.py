@@ -0,0 +1,390 @@
+"""
+Batched position features and streaming training sets.
+
+A position is encoded as one int8 per node (see encode): 0 for an empty
+node, otherwise 1 + owner*n_kinds + kind. FeatureExtractor computes the
+features of a batch of encoded positions, each seen by one player (its
+perspective), with NumPy operations on the whole batch:
+
+planes   uint8 (n_players, n_kinds, n_nodes): the occupancy of every node
+         by every kind of piece, with the owners and the halfboards
+         rotated so that the perspective player is player 0. The halfboards
+         are glued in a ring, so the rotation maps the board onto itself.
+scalars  float32: per player (in the same rotated order) the number of
+         pieces of every kind, the material value, the mobility (the
+         number of moves, counting single pawn steps only) and the king
+         safety (king alive, attacks of other players on the king and on
+         its neighbors)
+
+The moves are counted from padded tables of the paths of every kind of
+piece and owner, built once per board: a target is reachable if all nodes
+before it on its path are empty.
+
+Run as a script, it plays games in a pool of worker processes and streams
+(planes, scalars, outcome) rows into shards of .npy files, written through
+numpy memmaps, so memory stays bounded by a batch per worker and one shard:
+
+python features.py --out data --games 10000 --players 4 --rows-per-shard 100000
+"""
+
+import argparse
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+import threechess as thc
+from search import piece_values
+
+n_kinds = len(thc.piece_types)
+# the code of a node outside the board, see FeatureExtractor.mobility
+WALL = 127
+
+def encode(game):
+    """
+    The position of a game as an int8 array with one code per node.
+    """
+    return np.array([0 if p is None else 1 + p.owner.id*n_kinds + p.kind for p in game.board], dtype=np.int8)
+
+def pad_paths(paths, fill):
+    """
+    Pack a list (per node) of lists of paths into an int array of shape
+    (nodes, paths, length), padded with fill.
+    """
+    n_paths = max(1, max(len(p) for p in paths))
+    length = max([1] + [len(path) for node in paths for path in node])
+    table = np.full((len(paths), n_paths, length), fill, dtype=np.intp)
+    for i, node in enumerate(paths):
+        for k, path in enumerate(node):
+            table[i, k, :len(path)] = path
+    return table
+
+class FeatureExtractor:
+    """
+    Computes the features of batches of encoded positions on one board.
+    """
+    def __init__(self, n_players, n_rows=4, n_cols=8):
+        generator = thc.NChessGenerator(n_players, n_rows, n_cols, [thc.Player]*n_players)
+        t = generator.get_template().topology
+        self.topology = t
+        self.n_players = n_players
+        n = self.n_nodes = t.n_nodes
+        half = n_rows*n_cols
+        # rotations[q][i] is the node shown at node i from the perspective of q
+        i = np.arange(n)
+        self.rotations = np.array([((i//half + q) % n_players)*half + i % half for q in range(n_players)])
+        self.values = np.array(piece_values, dtype=np.float32)
+        # per owner: (kind, table, mode) with mode 'move', 'quiet' (only to
+        # empty nodes, like kings and pawn steps) or 'capture'
+        self.tables = []
+        self.king_rings = []
+        for o in range(n_players):
+            view = t.views[o]
+            rays = t.rays[o]
+            steps = [[(j,) for d in range(8) for j in view[i][d]] for i in range(n)]
+            plans = [(thc.King.kind, pad_paths(steps, n), 'quiet')]
+            for piece_type in (thc.Queen, thc.Bishop, thc.Rook):
+                paths = [[path for d in piece_type.initial_directions for path in rays[i][d]] for i in range(n)]
+                plans.append((piece_type.kind, pad_paths(paths, n), 'move'))
+            jumps = t.jump_targets(o, thc.Knight.move_orders)
+            plans.append((thc.Knight.kind, pad_paths([[(j,) for j in targets] for targets in jumps], n), 'move'))
+            pushes = [[(j,) for j in view[i][thc.Pawn.forward]] for i in range(n)]
+            plans.append((thc.Pawn.kind, pad_paths(pushes, n), 'quiet'))
+            captures = [[(j,) for d in thc.Pawn.diagonals for j in view[i][d]] for i in range(n)]
+            plans.append((thc.Pawn.kind, pad_paths(captures, n), 'capture'))
+            self.tables.append(plans)
+            ring = np.zeros((n, n), dtype=np.float32)
+            for i in range(n):
+                for (j,) in steps[i]:
+                    ring[i, j] = 1
+            self.king_rings.append(ring)
+        self.n_scalars = n_players*(n_kinds+5)
+
+    def planes(self, boards, perspectives):
+        """
+        uint8 array (batch, n_players, n_kinds, n_nodes) of the rotated
+        piece occupancy.
+        """
+        batch = len(boards)
+        rotated = boards[np.arange(batch)[:, None], self.rotations[perspectives]].astype(np.intp)
+        b, i = np.nonzero(rotated)
+        codes = rotated[b, i] - 1
+        owners = (codes//n_kinds - perspectives[b]) % self.n_players
+        planes = np.zeros((batch, self.n_players, n_kinds, self.n_nodes), dtype=np.uint8)
+        planes[b, owners, codes % n_kinds, i] = 1
+        return planes
+
+    def counts(self, boards):
+        """
+        int array (batch, n_players, n_kinds) of the pieces on the board.
+        """
+        codes = boards.astype(np.intp)
+        offsets = np.arange(len(boards))[:, None]*(self.n_players*n_kinds+1)
+        counts = np.bincount((codes + offsets).ravel(), minlength=len(boards)*(self.n_players*n_kinds+1))
+        return counts.reshape(len(boards), -1)[:, 1:].reshape(len(boards), self.n_players, n_kinds)
+
+    def mobility(self, boards):
+        """
+        Returns (moves, attacks): the number of moves of every player, an int
+        array (batch, n_players), and the number of pieces of every player
+        that attack every node, (batch, n_players, n_nodes). Kings do not
+        attack, since they can not capture.
+        """
+        batch = len(boards)
+        n = self.n_nodes
+        padded = np.concatenate([boards, np.full((batch, 1), WALL, dtype=boards.dtype)], axis=1)
+        occupied = (padded!=0) & (padded!=WALL)
+        owners = (padded.astype(np.intp)-1)//n_kinds
+        moves = np.zeros((batch, self.n_players), dtype=np.int64)
+        attacks = np.zeros((batch, self.n_players, n+1), dtype=np.int64)
+        rows = np.arange(batch)[:, None, None, None]
+        for o, plans in enumerate(self.tables):
+            enemy = occupied & (owners!=o)
+            empty = padded==0
+            for (kind, table, mode) in plans:
+                present = boards==1 + o*n_kinds + kind
+                if not present.any():
+                    continue
+                nodes = np.nonzero(present.any(axis=0))[0]
+                table = table[nodes]
+                on_path = table!=n
+                if table.shape[2]>1:
+                    free = np.cumprod(empty[:, table], axis=3)
+                    reach = np.concatenate([np.ones(free.shape[:3] + (1,), dtype=bool),
+                                            free[:, :, :, :-1].astype(bool)], axis=3) & on_path
+                else:
+                    reach = np.broadcast_to(on_path, (batch,) + table.shape)
+                reach = reach & present[:, nodes, None, None]
+                if mode=='quiet':
+                    legal = reach & empty[:, table]
+                elif mode=='capture':
+                    legal = reach & enemy[:, table]
+                else:
+                    legal = reach & (empty[:, table] | enemy[:, table])
+                moves[:, o] += legal.sum(axis=(1, 2, 3))
+                if mode!='quiet':
+                    b = np.broadcast_to(rows, reach.shape)[reach]
+                    targets = np.broadcast_to(table, reach.shape)[reach]
+                    attacks[:, o] += np.bincount(b*(n+1) + targets, minlength=batch*(n+1)).reshape(batch, n+1)
+        return moves, attacks[:, :, :n]
+
+    def king_safety(self, boards, attacks):
+        """
+        float32 array (batch, n_players, 3): whether the king of every
+        player is alive, and the number of attacks of the other players on
+        its node and on its neighbors.
+        """
+        retval = np.zeros((len(boards), self.n_players, 3), dtype=np.float32)
+        total = attacks.sum(axis=1)
+        for o in range(self.n_players):
+            king = (boards==1 + o*n_kinds + thc.King.kind).astype(np.float32)
+            others = total - attacks[:, o]
+            retval[:, o, 0] = king.sum(axis=1)
+            retval[:, o, 1] = (king*others).sum(axis=1)
+            retval[:, o, 2] = (king.dot(self.king_rings[o])*others).sum(axis=1)
+        return retval
+
+    def scalars(self, boards, perspectives):
+        """
+        float32 array (batch, n_scalars), see the module docstring.
+        """
+        counts = self.counts(boards)
+        material = counts.dot(self.values)
+        moves, attacks = self.mobility(boards)
+        safety = self.king_safety(boards, attacks)
+        order = (perspectives[:, None] + np.arange(self.n_players)) % self.n_players
+        rows = np.arange(len(boards))[:, None]
+        parts = [counts[rows, order].reshape(len(boards), -1), material[rows, order],
+                 moves[rows, order], safety[rows, order].reshape(len(boards), -1)]
+        return np.concatenate(parts, axis=1).astype(np.float32)
+
+    def __call__(self, boards, perspectives):
+        """
+        The (planes, scalars) of a batch: boards is an int8 array (batch,
+        n_nodes) of encoded positions, perspectives the player every row is
+        seen by.
+        """
+        boards = np.asarray(boards, dtype=np.int8)
+        perspectives = np.asarray(perspectives, dtype=np.intp)
+        return self.planes(boards, perspectives), self.scalars(boards, perspectives)
+
+class PositionSampler(thc.GameListener):
+    """
+    Collects the encoded position and the player to move before every
+    sample_every-th move of a game.
+    """
+    def __init__(self, sample_every=1):
+        self.sample_every = sample_every
+        self.turns = 0
+        self.boards = []
+        self.movers = []
+
+    def turn(self, game, mover):
+        if self.turns % self.sample_every==0:
+            self.boards.append(encode(game))
+            self.movers.append(int(mover.playerID))
+        self.turns += 1
+
+    def outcomes(self, game):
+        """
+        The outcome of the game for the mover of every sample: 1 for the
+        winner, 0 for the others and 1/n_players if the game did not end.
+        """
+        if game.winner is None:
+            return np.full(len(self.movers), 1./game.n_players, dtype=np.float32)
+        return (np.array(self.movers)==int(game.winner.playerID)).astype(np.float32)
+
+# one extractor per board in every worker process
+extractors = {}
+
+def get_extractor(n_players, n_rows, n_cols):
+    key = (n_players, n_rows, n_cols)
+    if key not in extractors:
+        extractors[key] = FeatureExtractor(n_players, n_rows, n_cols)
+    return extractors[key]
+
+def play_and_extract(task):
+    """
+    Play one game described by a task tuple
+    (seed, n_players, n_rows, n_cols, player_specs, max_moves, sample_every)
+    and return the (planes, scalars, outcomes) of its sampled positions.
+    """
+    import selfplay
+    seed, n_players, n_rows, n_cols, player_specs, max_moves, sample_every = task
+    selfplay.seed_all(seed)
+    player_types = [selfplay.make_player_type(s) for s in player_specs]
+    game = thc.Game(thc.NChessGenerator(n_players, n_rows, n_cols, player_types))
+    sampler = PositionSampler(sample_every)
+    game.subscribe(sampler)
+    game.play(max_moves=max_moves)
+    for p in game.players:
+        if hasattr(p, 'close'):
+            p.close()
+    extractor = get_extractor(n_players, n_rows, n_cols)
+    planes, scalars = extractor(np.array(sampler.boards, dtype=np.int8), sampler.movers)
+    return planes, scalars, sampler.outcomes(game)
+
+class ShardWriter:
+    """
+    Appends rows to numbered shards in a directory, each shard a set of
+    .npy files shard-<k>-<name>.npy with rows_per_shard rows, written
+    through numpy memmaps. The last shard is cut to the rows written by
+    close().
+    """
+    def __init__(self, directory, rows_per_shard=2**16):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.rows_per_shard = rows_per_shard
+        self.shard = 0
+        while os.path.exists(self.path(self.shard, 'outcomes')):
+            self.shard += 1
+        self.arrays = None
+        self.filled = 0
+        self.rows = 0
+
+    def path(self, shard, name):
+        return os.path.join(self.directory, 'shard-%05d-%s.npy' % (shard, name))
+
+    def open_shard(self, columns):
+        self.arrays = {}
+        for (name, values) in columns:
+            self.arrays[name] = np.lib.format.open_memmap(self.path(self.shard, name), mode='w+', dtype=values.dtype,
+                                                          shape=(self.rows_per_shard,) + values.shape[1:])
+        self.filled = 0
+
+    def close_shard(self):
+        if self.arrays is None:
+            return
+        for (name, array) in self.arrays.items():
+            if self.filled<self.rows_per_shard:
+                path = self.path(self.shard, name)
+                part = np.lib.format.open_memmap(path + '.part', mode='w+', dtype=array.dtype,
+                                                 shape=(self.filled,) + array.shape[1:])
+                part[:] = array[:self.filled]
+                part.flush()
+                del part
+                del array
+                os.rename(path + '.part', path)
+            else:
+                array.flush()
+        self.arrays = None
+        self.shard += 1
+
+    def write(self, columns):
+        """
+        Append rows given as a list of (name, array) with the same number of
+        rows.
+        """
+        n = len(columns[0][1])
+        start = 0
+        while start<n:
+            if self.arrays is None:
+                self.open_shard(columns)
+            k = min(n-start, self.rows_per_shard-self.filled)
+            for (name, values) in columns:
+                self.arrays[name][self.filled:self.filled+k] = values[start:start+k]
+            self.filled += k
+            self.rows += k
+            start += k
+            if self.filled==self.rows_per_shard:
+                self.close_shard()
+
+    def close(self):
+        self.close_shard()
+
+def generate(directory, n_games, n_players=4, player_specs=None, n_rows=4, n_cols=8, max_moves=200,
+             sample_every=1, seed=0, processes=None, rows_per_shard=2**16, callback=None):
+    """
+    Play n_games games and write the features and outcomes of their
+    positions to shards in directory. Returns the number of rows written.
+    """
+    if player_specs is None:
+        player_specs = ['random']*n_players
+    tasks = ((seed+k, n_players, n_rows, n_cols, tuple(player_specs), max_moves, sample_every)
+             for k in xrange(n_games))
+    writer = ShardWriter(directory, rows_per_shard)
+    pool = None
+    if processes==1:
+        results = (play_and_extract(t) for t in tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(play_and_extract, tasks, 4)
+    try:
+        for (planes, scalars, outcomes) in results:
+            writer.write([('planes', planes), ('scalars', scalars), ('outcomes', outcomes)])
+            if callback is not None:
+                callback(writer.rows)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        writer.close()
+    return writer.rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Write training rows from self-play games.")
+    parser.add_argument('--out', required=True, help="directory of the shards")
+    parser.add_argument('--games', type=int, default=100)
+    parser.add_argument('--players', type=int, default=4)
+    parser.add_argument('--player-types', default='random',
+                        help="comma separated player spec per seat, or one spec for all seats (see selfplay.py)")
+    parser.add_argument('--max-moves', type=int, default=200)
+    parser.add_argument('--sample-every', type=int, default=1, help="keep every n-th position of a game")
+    parser.add_argument('--rows-per-shard', type=int, default=2**16)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--processes', type=int, default=None, help="default: one per core")
+    args = parser.parse_args()
+    specs = args.player_types.split(',')
+    if len(specs)==1:
+        specs = specs*args.players
+    start = time.time()
+    rows = generate(args.out, args.games, args.players, specs, max_moves=args.max_moves,
+                    sample_every=args.sample_every, seed=args.seed, processes=args.processes,
+                    rows_per_shard=args.rows_per_shard)
+    elapsed = time.time() - start
+    print "%d rows in %.1fs, %.0f rows/s (%.2fM rows/hour)" % (rows, elapsed, rows/elapsed, rows/elapsed*3600/1e6)
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,647 @@
+"""
+A server hosting many games at once.
+
+GameServer runs any number of games in one process and one thread, on an
+asyncore event loop over a TCP or Unix socket. Clients send and receive one
+JSON object per line. A client creates a game with
+
+{"type": "new", "seats": ["remote", "remote", "random"], "timeout": 10}
+
+where every seat is 'remote' (played by a client) or a player spec of
+selfplay.py ('random', 'paranoid:0.05', ...) played by the server. The
+server answers {"type": "created", "game": id}. Clients then take the
+remote seats with
+
+{"type": "join", "game": id, "seat": 0, "positions": false}
+
+(without seat, the first free one), and the game starts when all remote
+seats are taken. The server asks the player of a seat for the order of
+moves and for moves, and the client answers:
+
+{"type": "get_move_list", "game": id, "seat": k}
+{"type": "order", "game": id, "order": [2, 0, 1]}
+{"type": "get_move", "game": id, "seat": k, "moves": [[start, end], ...]}
+{"type": "move", "game": id, "start": start, "end": end}
+
+The moves are node indices of the topology. With "positions": true in the
+join message, every get_move also holds the position as a snapshot (see
+Game.snapshot). A seat that does not answer within the timeout of the game
+(seconds per request) plays a random legal move, or the players in turn as
+order; so does a seat whose client disconnected. An illegal answer gets an
+error message and the request stays open.
+
+Players and spectators ({"type": "watch", "game": id}) receive the events
+of the game: order, turn, move, capture, pass, timeout, crash (a server
+side player raised an exception and plays like a seat that timed out),
+game_over and finally finished. {"type": "list"} lists the games.
+
+Players are asked through their hooks get_move_list and get_move. A player
+with get_move_list_async(game, reply) and get_move_async(game, reply) is
+asked through these instead; it calls reply with its answer later, or never
+(see RemotePlayer). Players without async hooks, like the server side
+players of selfplay specs, block the loop while they think, so search bots
+are better run as clients.
+
+python gameserver.py serve --port 7777
+python gameserver.py bots --port 7777 --games 200 --seats remote,remote,remote
+"""
+
+import argparse
+import asynchat
+import asyncore
+import collections
+import heapq
+import itertools
+import json
+import os
+import random
+import socket
+import time
+import traceback
+
+import threechess as thc
+
+class ProtocolError(Exception):
+    pass
+
+def encode_message(message):
+    return json.dumps(message, separators=(',', ':')) + '\n'
+
+def socket_family(address):
+    """
+    A socket family for an address: a (host, port) pair or the path of a
+    Unix socket.
+    """
+    if isinstance(address, basestring):
+        return socket.AF_UNIX
+    return socket.AF_INET
+
+class LineChannel(asynchat.async_chat):
+    """
+    A connection exchanging one JSON object per line. Subclasses implement
+    handle_message.
+    """
+    max_line = 1 << 20
+
+    def __init__(self, sock=None, map=None):
+        asynchat.async_chat.__init__(self, sock, map=map)
+        self.set_terminator('\n')
+        self.buffer = []
+        self.buffered = 0
+
+    def collect_incoming_data(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered>self.max_line:
+            self.buffer = []
+            self.buffered = 0
+            self.send_message({'type': 'error', 'message': "line too long"})
+            self.close_when_done()
+
+    def found_terminator(self):
+        line = ''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        if not line.strip():
+            return
+        try:
+            message = json.loads(line)
+        except ValueError:
+            self.send_message({'type': 'error', 'message': "not JSON"})
+            return
+        if not isinstance(message, dict):
+            self.send_message({'type': 'error', 'message': "not a JSON object"})
+            return
+        self.handle_message(message)
+
+    def send_message(self, message):
+        self.push(encode_message(message))
+
+    def handle_message(self, message):
+        raise NotImplementedError()
+
+class Connection(LineChannel):
+    """
+    A client of a GameServer.
+    """
+    def __init__(self, server, sock):
+        LineChannel.__init__(self, sock, server.map)
+        self.server = server
+        # the (game, seat) pairs played and the games watched
+        self.seats = []
+        self.watching = set()
+
+    def handle_message(self, message):
+        try:
+            self.server.handle_message(self, message)
+        except ProtocolError as e:
+            reply = {'type': 'error', 'message': str(e)}
+            if 'game' in message:
+                reply['game'] = message['game']
+            self.send_message(reply)
+
+    def handle_close(self):
+        self.close()
+        self.server.connection_closed(self)
+
+class RemotePlayer(thc.Player):
+    """
+    A seat played by a client. The answers of the client are passed to
+    answer by the ServerGame.
+    """
+    def __init__(self, playerID):
+        thc.Player.__init__(self, playerID)
+        self.server_game = None
+        self.connection = None
+        self.positions = False
+        self.reply = None
+        self.request = None
+        self.legal = None
+
+    def send(self, message):
+        message['game'] = self.server_game.id
+        self.connection.send_message(message)
+
+    def get_move_list_async(self, game, reply):
+        if self.connection is None:
+            reply(None)
+            return
+        self.reply = reply
+        self.request = 'order'
+        self.send({'type': 'get_move_list', 'seat': self.playerID.id})
+
+    def get_move_async(self, game, reply):
+        if self.connection is None:
+            reply(None)
+            return
+        moves = [(p.square, e) for (p, e) in game.generate_moves(self.playerID)]
+        self.legal = set(moves)
+        self.reply = reply
+        self.request = 'move'
+        message = {'type': 'get_move', 'seat': self.playerID.id, 'moves': moves}
+        if self.positions:
+            message['position'] = game.snapshot()
+        self.send(message)
+
+    def answer(self, game, message):
+        """
+        Pass the answer of the client on to the game. Raises ProtocolError
+        for an answer that was not asked for or is not legal.
+        """
+        if self.reply is None or message['type']!=self.request:
+            raise ProtocolError("no %s was asked for" % message['type'])
+        if self.request=='order':
+            order = message.get('order')
+            if (not isinstance(order, list) or not all(type(k) in (int, long) for k in order)
+                    or sorted(order)!=range(game.n_players)):
+                raise ProtocolError("an order must hold every player once")
+            result = order
+        else:
+            move = (message.get('start'), message.get('end'))
+            if not all(type(x) in (int, long) for x in move) or move not in self.legal:
+                raise ProtocolError("illegal move")
+            start, end = move
+            result = thc.Move(game.board[start], game.node_list[start], game.node_list[end])
+        reply = self.reply
+        self.cancel()
+        reply(result)
+
+    def cancel(self):
+        self.reply = None
+        self.request = None
+        self.legal = None
+
+    def __str__(self):
+        return "Remote Player " + str(self.playerID)
+
+class ServerGame(thc.GameListener):
+    """
+    A game hosted by a GameServer. The game is played by next_turn, which
+    does what Game.play_next_move does, but asks the players through ask
+    and continues when they have answered.
+    """
+    def __init__(self, server, game_id, seats, timeout, max_moves):
+        import selfplay
+        self.server = server
+        self.id = game_id
+        self.seats = seats
+        self.timeout = timeout
+        self.max_moves = max_moves
+        player_types = [RemotePlayer if s=='remote' else selfplay.base_player_type(s) for s in seats]
+        generator = thc.NChessGenerator(len(seats), player_type_list=player_types)
+        self.game = thc.Game(generator, listeners=[self])
+        for p in self.game.players:
+            if isinstance(p, RemotePlayer):
+                p.server_game = self
+        self.spectators = set()
+        self.rnd = random.Random()
+        self.token = 0
+        self.legal = None
+        self.plies = 0
+        self.started = False
+        self.finished = False
+
+    def remote_players(self):
+        return [p for p in self.game.players if isinstance(p, RemotePlayer)]
+
+    def broadcast(self, message):
+        message['game'] = self.id
+        line = encode_message(message)
+        targets = set(self.spectators)
+        for p in self.remote_players():
+            if p.connection is not None:
+                targets.add(p.connection)
+        for c in targets:
+            c.push(line)
+
+    def describe(self):
+        return {'game': self.id, 'seats': self.seats, 'plies': self.plies, 'started': self.started,
+                'free': [p.playerID.id for p in self.remote_players() if p.connection is None]}
+
+    def join(self, connection, seat=None, positions=False):
+        if self.started:
+            raise ProtocolError("the game has started")
+        free = [p for p in self.remote_players() if p.connection is None]
+        if seat is not None:
+            free = [p for p in free if p.playerID.id==seat]
+        if not free:
+            raise ProtocolError("no free seat")
+        player = free[0]
+        player.connection = connection
+        player.positions = positions
+        connection.seats.append((self, player.playerID.id))
+        connection.send_message({'type': 'joined', 'game': self.id, 'seat': player.playerID.id,
+                                 'seats': self.seats})
+        if all(p.connection is not None for p in self.remote_players()):
+            self.start()
+
+    def leave(self, seat):
+        player = self.game.players[seat]
+        player.connection = None
+        if self.finished:
+            return
+        if self.started and not any(p.connection is not None for p in self.remote_players()):
+            self.finish()
+        elif player.reply is not None:
+            reply = player.reply
+            player.cancel()
+            reply(None)
+
+    def start(self):
+        self.started = True
+        self.broadcast({'type': 'start', 'seats': self.seats})
+        self.server.call_soon(self.next_turn)
+
+    def ask(self, player, hook, done):
+        """
+        Ask player for the result of hook ('get_move_list' or 'get_move')
+        and call done(player, result) from the loop; the result is None if
+        the player did not answer within the timeout or raised an exception,
+        which is printed and sent to the game as a crash event.
+        """
+        self.token += 1
+        token = self.token
+        def reply(result):
+            if self.token==token:
+                self.token += 1
+                self.server.call_soon(done, player, result)
+        async_hook = getattr(player, hook + '_async', None)
+        if async_hook is None:
+            try:
+                result = getattr(player, hook)(self.game)
+            except Exception as e:
+                traceback.print_exc()
+                self.broadcast({'type': 'crash', 'seat': player.playerID.id,
+                                'message': "%s: %s" % (type(e).__name__, e)})
+                result = None
+            reply(result)
+            return
+        self.server.call_later(self.timeout, self.expire, token, player, done)
+        async_hook(self.game, reply)
+
+    def expire(self, token, player, done):
+        if self.token!=token:
+            return
+        self.token += 1
+        if hasattr(player, 'cancel'):
+            player.cancel()
+        self.broadcast({'type': 'timeout', 'seat': player.playerID.id})
+        done(player, None)
+
+    def next_turn(self):
+        game = self.game
+        if self.finished:
+            return
+        if game.game_over or self.plies>=self.max_moves:
+            self.finish()
+            return
+        decider = game.next_decider()
+        if decider is not None:
+            self.ask(decider, 'get_move_list', self.order_received)
+            return
+        mover = game.move_list[0]
+        moves = game.generate_moves(mover.playerID)
+        if not moves:
+            game.move_list.pop(0)
+            self.plies += 1
+            self.broadcast({'type': 'pass', 'seat': mover.playerID.id})
+            self.server.call_soon(self.next_turn)
+            return
+        self.legal = moves
+        self.ask(game.next_mover(), 'get_move', self.move_received)
+
+    def order_received(self, decider, order):
+        game = self.game
+        if self.finished:
+            return
+        if not isinstance(order, list) or sorted(order)!=range(game.n_players):
+            order = range(game.n_players)
+        game.apply_order(decider, order)
+        self.server.call_soon(self.next_turn)
+
+    def move_received(self, mover, move):
+        game = self.game
+        if self.finished:
+            return
+        legal = [(p.square, e) for (p, e) in self.legal]
+        if (not isinstance(move, thc.Move) or move.piece is not game.board[move.start.index]
+                or (move.start.index, move.end.index) not in legal):
+            p, e = self.rnd.choice(self.legal)
+            move = thc.Move(p, p.position, game.node_list[e])
+        self.legal = None
+        game.make_move(move)
+        self.plies += 1
+        self.server.call_soon(self.next_turn)
+
+    def finish(self):
+        self.finished = True
+        self.token += 1
+        for p in self.remote_players():
+            if p.reply is not None:
+                p.cancel()
+        winner = self.game.winner
+        self.broadcast({'type': 'finished', 'plies': self.plies,
+                        'winner': None if winner is None else winner.playerID.id})
+        self.server.game_finished(self)
+
+    def answer(self, connection, message):
+        seats = [s for (g, s) in connection.seats if g is self]
+        for seat in seats:
+            player = self.game.players[seat]
+            if player.reply is not None:
+                player.answer(self.game, message)
+                return
+        raise ProtocolError("nothing was asked")
+
+    # GameListener events
+
+    def order_decided(self, game, decider, new_order):
+        self.broadcast({'type': 'order', 'decider': decider.playerID.id,
+                        'order': [p.playerID.id for p in new_order]})
+
+    def turn(self, game, mover):
+        self.broadcast({'type': 'turn', 'seat': mover.playerID.id})
+
+    def move_made(self, game, move):
+        self.broadcast({'type': 'move', 'seat': move.piece.owner.id,
+                        'start': move.start.index, 'end': move.end.index})
+
+    def capture(self, game, move, captured):
+        self.broadcast({'type': 'capture', 'seat': captured.owner.id, 'kind': captured.kind,
+                        'node': move.end.index})
+
+    def game_over(self, game, winner):
+        self.broadcast({'type': 'game_over', 'winner': winner.playerID.id})
+
+class GameServer(asyncore.dispatcher):
+    """
+    Listens on address, a (host, port) pair or the path of a Unix socket,
+    and hosts the games of its clients. serve() runs the event loop.
+    timeout is the default of the seconds a player has per request, and
+    max_moves the default of the number of moves after which a game ends
+    without winner.
+    """
+    def __init__(self, address, timeout=10., max_moves=1000):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        family = socket_family(address)
+        if family==socket.AF_UNIX and os.path.exists(address):
+            os.remove(address)
+        self.create_socket(family, socket.SOCK_STREAM)
+        if family!=socket.AF_UNIX:
+            self.set_reuse_addr()
+        self.bind(address)
+        self.listen(1024)
+        self.address = self.socket.getsockname()
+        self.timeout = timeout
+        self.max_moves = max_moves
+        self.games = {}
+        self.game_ids = itertools.count()
+        self.ready = collections.deque()
+        self.timers = []
+        self.timer_ids = itertools.count()
+        self.running = False
+        self.finished_games = 0
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            Connection(self, pair[0])
+
+    def call_soon(self, function, *args):
+        self.ready.append((function, args))
+
+    def call_later(self, delay, function, *args):
+        heapq.heappush(self.timers, (time.time() + delay, next(self.timer_ids), function, args))
+
+    def serve(self, max_time=None):
+        """
+        Run the event loop until stop() is called, or for max_time seconds.
+        """
+        self.running = True
+        end = None if max_time is None else time.time() + max_time
+        while self.running:
+            for k in range(len(self.ready)):
+                function, args = self.ready.popleft()
+                function(*args)
+            now = time.time()
+            while self.timers and self.timers[0][0]<=now:
+                when, k, function, args = heapq.heappop(self.timers)
+                function(*args)
+            if end is not None and now>=end:
+                break
+            if self.ready:
+                wait = 0.
+            elif self.timers:
+                wait = min(max(self.timers[0][0]-now, 0.), 1.)
+            else:
+                wait = 1.
+            asyncore.loop(wait, use_poll=True, map=self.map, count=1)
+        self.running = False
+
+    def stop(self):
+        self.running = False
+
+    def game(self, message):
+        game = self.games.get(message.get('game'))
+        if game is None:
+            raise ProtocolError("no such game")
+        return game
+
+    def handle_message(self, connection, message):
+        kind = message.get('type')
+        if kind=='new':
+            seats = message.get('seats')
+            if (not isinstance(seats, list) or not 2<=len(seats)<=6
+                    or not all(isinstance(s, basestring) for s in seats)):
+                raise ProtocolError("seats must be a list of 2 to 6 player specs")
+            try:
+                timeout = float(message.get('timeout', self.timeout))
+                max_moves = int(message.get('max_moves', self.max_moves))
+            except (TypeError, ValueError):
+                raise ProtocolError("timeout and max_moves must be numbers")
+            try:
+                game = ServerGame(self, next(self.game_ids), seats, timeout, max_moves)
+            except ValueError as e:
+                raise ProtocolError(str(e))
+            self.games[game.id] = game
+            connection.send_message({'type': 'created', 'game': game.id, 'seats': seats})
+            if not game.remote_players():
+                game.start()
+        elif kind=='join':
+            self.game(message).join(connection, message.get('seat'), bool(message.get('positions')))
+        elif kind=='watch':
+            game = self.game(message)
+            game.spectators.add(connection)
+            connection.watching.add(game)
+            connection.send_message({'type': 'watching', 'game': game.id, 'seats': game.seats,
+                                     'moves': game.game.move_history()})
+        elif kind=='list':
+            connection.send_message({'type': 'games',
+                                     'games': [g.describe() for g in self.games.itervalues()]})
+        elif kind in ('move', 'order'):
+            self.game(message).answer(connection, message)
+        else:
+            raise ProtocolError("unknown message type %s" % kind)
+
+    def game_finished(self, game):
+        self.finished_games += 1
+        del self.games[game.id]
+        for c in game.spectators:
+            c.watching.discard(game)
+        for p in game.remote_players():
+            if p.connection is not None:
+                p.connection.seats = [(g, s) for (g, s) in p.connection.seats if g is not game]
+
+    def connection_closed(self, connection):
+        for game in connection.watching:
+            game.spectators.discard(connection)
+        seats = connection.seats
+        connection.seats = []
+        for (game, seat) in seats:
+            game.leave(seat)
+
+class BotClient(LineChannel):
+    """
+    A client that plays random legal moves and random orders, to test a
+    server. Given seats it creates a game and joins its first remote seat,
+    and another BotClient joins every other remote seat; given game it
+    joins a free seat of that game. stats (shared by the bots of a run)
+    counts the moves and finished games; a bot closes its connection when
+    its game is finished.
+    """
+    def __init__(self, address, map, stats, seats=None, game=None, seed=None):
+        # connect blocking: asyncore takes the EAGAIN of a Unix socket with
+        # a full backlog for a connect in progress, which never completes
+        sock = socket.socket(socket_family(address), socket.SOCK_STREAM)
+        sock.connect(address)
+        LineChannel.__init__(self, sock, map)
+        self.server_address = address
+        self.map = map
+        self.stats = stats
+        self.rnd = random.Random(seed)
+        self.n_players = None
+        if seats is not None:
+            self.creator = True
+            self.send_message({'type': 'new', 'seats': seats})
+        else:
+            self.creator = False
+            self.send_message({'type': 'join', 'game': game})
+
+    def handle_message(self, message):
+        kind = message['type']
+        if kind=='created':
+            self.send_message({'type': 'join', 'game': message['game']})
+            for k in range(message['seats'].count('remote')-1):
+                BotClient(self.server_address, self.map, self.stats, game=message['game'],
+                          seed=self.rnd.getrandbits(32))
+        elif kind=='get_move_list':
+            order = range(self.n_players)
+            self.rnd.shuffle(order)
+            self.send_message({'type': 'order', 'game': message['game'], 'order': order})
+        elif kind=='get_move':
+            start, end = self.rnd.choice(message['moves'])
+            self.send_message({'type': 'move', 'game': message['game'], 'start': start, 'end': end})
+            self.stats['moves'] += 1
+        elif kind=='joined':
+            self.n_players = len(message['seats'])
+        elif kind=='finished':
+            if self.creator:
+                self.stats['finished'] += 1
+                self.stats['plies'] += message['plies']
+            self.close_when_done()
+        elif kind=='error':
+            self.stats['errors'] += 1
+
+    def handle_close(self):
+        self.close()
+
+def run_bots(address, n_games, seats, max_time=600., seed=0):
+    """
+    Play n_games games with the given seats on the server at address, with
+    a BotClient for every remote seat, all in this process. Returns the
+    stats of the bots and the seconds used.
+    """
+    bots = {}
+    stats = {'moves': 0, 'finished': 0, 'plies': 0, 'errors': 0}
+    rnd = random.Random(seed)
+    start = time.time()
+    for k in range(n_games):
+        BotClient(address, bots, stats, seats=seats, seed=rnd.getrandbits(32))
+    while stats['finished']<n_games and bots and time.time()-start<max_time:
+        asyncore.loop(1., use_poll=True, map=bots, count=1)
+    for c in bots.values():
+        c.close()
+    return stats, time.time()-start
+
+def main():
+    parser = argparse.ArgumentParser(description="Host many games, or test a server with bots.")
+    commands = parser.add_subparsers(dest='command')
+    serve = commands.add_parser('serve', help="run a server")
+    bots = commands.add_parser('bots', help="play games on a server with random bots")
+    for command in (serve, bots):
+        command.add_argument('--host', default='127.0.0.1')
+        command.add_argument('--port', type=int, default=7777)
+        command.add_argument('--unix', default=None, help="path of a Unix socket, instead of TCP")
+    serve.add_argument('--timeout', type=float, default=10., help="seconds per request")
+    serve.add_argument('--max-moves', type=int, default=1000)
+    bots.add_argument('--games', type=int, default=100)
+    bots.add_argument('--seats', default='remote,remote,remote', help="comma separated seats")
+    args = parser.parse_args()
+    address = args.unix if args.unix is not None else (args.host, args.port)
+    if args.command=='serve':
+        server = GameServer(address, args.timeout, args.max_moves)
+        print "serving on %s" % (server.address,)
+        try:
+            server.serve()
+        except KeyboardInterrupt:
+            pass
+    else:
+        seats = args.seats.split(',')
+        stats, elapsed = run_bots(address, args.games, seats)
+        print ("%d of %d games finished, %d moves by bots, %d errors, %.1fs, %.0f plies/s"
+               % (stats['finished'], args.games, stats['moves'], stats['errors'], elapsed,
+                  stats['plies']/max(elapsed, 1e-6)))
+
+if __name__=='__main__':
+    main()
@@ -1,16 +1,33 @@
 """
 This module is for testing how to plot a board
+
+GuiGame saves a picture of the board after every move. The board geometry
+is drawn once into a cached background (see BoardRenderer); after a move
+only the piece glyphs of the nodes the move changed are drawn again, and
+the frames are encoded and written by a background thread (see
+FrameWriter), so that play is not held up by PNG encoding.
+
+matplotlib is only imported when a board is drawn with it, so importing
+this module (e.g. through aiplayer in headless worker processes) stays
+cheap. SvgRenderer draws the board as SVG without matplotlib; GuiGame
+uses it with format='svg'. python guibench.py measures both.
 """
 
 import numpy as np
 import cmath
-import matplotlib.pyplot as plt
-from matplotlib.patches import Polygon
+import threading
+import Queue
 
 import threechess as thc
 
-def plot_line(x1, x2, args):
-    plt.plot(np.array([x1[0],x2[0]]), np.array([x1[1],x2[1]]), args)
+# the letter of every piece kind, see thc.piece_types
+piece_letters = ('K', 'Q', 'B', 'S', 'R', 'P')
+
+def plot_line(x1, x2, args, ax=None):
+    if ax is None:
+        import matplotlib.pyplot as plt
+        ax = plt.gca()
+    ax.plot(np.array([x1[0],x2[0]]), np.array([x1[1],x2[1]]), args)
 
 class Rectangle:
     def __init__(self, x1, x2, x3, x4, face_color=None):
@@ -21,36 +38,37 @@ class Rectangle:
         self.node = None
         self.face_color = face_color
 
-    def plot(self, color='k'):
+    def corners(self):
+        return (self.x1, self.x2, self.x3, self.x4)
+
+    def center(self):
+        return (self.x1+self.x2+ self.x3+self.x4)/4.
+
+    def plot(self, color='k', ax=None, pieces=True):
+        if ax is None:
+            import matplotlib.pyplot as plt
+            ax = plt.gca()
         if self.face_color is not None:
+            from matplotlib.patches import Polygon
             xy = np.array([[self.x1[0], self.x1[1]],
                              [self.x2[0], self.x2[1]],
                              [self.x3[0], self.x3[1]],
                              [self.x4[0], self.x4[1]]])
             pol = Polygon(xy, facecolor=self.face_color)
-            plt.gca().add_artist(pol)
+            ax.add_artist(pol)
         else:
-            plot_line(self.x1,self.x2, color)
-            plot_line(self.x2,self.x3, color)
-            plot_line(self.x3,self.x4, color)
-            plot_line(self.x4,self.x1, color)
-        if self.node and self.node.piece:
-            draw_piece(self.node.piece, (self.x1+self.x2+ self.x3+self.x4)/4.)
-
-def draw_piece(piece, center):
-    color = piece.owner.plt_color
-    if isinstance(piece, thc.King):
-        plt.text(center[0], center[1], 'K', color=color)
-    elif isinstance(piece, thc.Queen):
-        plt.text(center[0], center[1], 'Q', color=color)
-    elif isinstance(piece, thc.Bishop):
-        plt.text(center[0], center[1], 'B', color=color)
-    elif isinstance(piece, thc.Knight):
-        plt.text(center[0], center[1], 'S', color=color)
-    elif isinstance(piece, thc.Rook):
-        plt.text(center[0], center[1], 'R', color=color)
-    elif isinstance(piece, thc.Pawn):
-        plt.text(center[0], center[1], 'P', color=color)
+            plot_line(self.x1,self.x2, color, ax)
+            plot_line(self.x2,self.x3, color, ax)
+            plot_line(self.x3,self.x4, color, ax)
+            plot_line(self.x4,self.x1, color, ax)
+        if pieces and self.node and self.node.piece:
+            draw_piece(self.node.piece, self.center(), ax)
+
+def draw_piece(piece, center, ax=None):
+    if ax is None:
+        import matplotlib.pyplot as plt
+        ax = plt.gca()
+    ax.text(center[0], center[1], piece_letters[piece.kind], color=piece.owner.plt_color)
 
 
 class CornerBoard(Rectangle):
@@ -93,10 +111,10 @@ class CornerBoard(Rectangle):
                 p4 = points1[k+1]*float(j)/n_intervals_y + points2[k+1]*float(n_intervals_y-j)/n_intervals_y
                 self.rectangles.append(Rectangle(p1, p2, p3, p4, face_color=face_color.next()))
 
-    def plot(self, color='k'):
-        Rectangle.plot(self, color)
+    def plot(self, color='k', ax=None, pieces=True):
+        Rectangle.plot(self, color, ax, pieces)
         for r in self.rectangles:
-            r.plot(color)
+            r.plot(color, ax, pieces)
 
 class HalfBoard:
     def __init__(self, cornerboard_left, cornerboard_right, playerID):
@@ -104,9 +122,12 @@ class HalfBoard:
         self.cb_right = cornerboard_right
         self.owner = playerID
 
-    def plot(self, color='k'):
-        self.cb_left.plot(color)
-        self.cb_right.plot(color)
+    def plot(self, color='k', ax=None, pieces=True):
+        self.cb_left.plot(color, ax, pieces)
+        self.cb_right.plot(color, ax, pieces)
+
+    def rectangles(self):
+        return self.cb_left.rectangles + self.cb_right.rectangles
 
     def connect_nodes(self, nodesdict):
         nleft = []
@@ -149,45 +170,301 @@ def generate_halfboards(n_players=3):
 class GuiNChessGenerator(thc.NChessGenerator):
     def generate(self):
         self.gui_halfboards = generate_halfboards(self.n_players)
-        nodeslist = []
-        pieces = []
-        players = []
-        for p,ptype in zip(self.generate_playerIDs(), self.player_type_list):
-            n, pi, pl = self.generate_halfboard(playerID=p, PlayerType=ptype)
-            nodeslist.append(n)
-            pieces.extend(pi)
-            players.append(pl)
-            self.gui_halfboards[p.id].connect_nodes(n)
-        for p in range(self.n_players):
-            self.glue_halfboards(nodeslist[p-1], players[p-1].playerID, nodeslist[p], players[p].playerID)
-        nodes = thc.joindicts(nodeslist)
-        return nodes, pieces, players
+        nodes, pieces, players, topology = thc.NChessGenerator.generate(self)
+        for h in self.gui_halfboards:
+            h.connect_nodes(nodes)
+        return nodes, pieces, players, topology
+
+def write_frame(filename, frame):
+    """
+    Write an RGB or RGBA array to a PNG file.
+    """
+    try:
+        from matplotlib._png import write_png
+    except ImportError:
+        import matplotlib.image
+        matplotlib.image.imsave(filename, frame)
+    else:
+        write_png(frame, filename)
+
+class FrameWriter:
+    """
+    Writes RGBA frames to PNG files in a background thread. At most
+    max_pending frames wait to be written; write blocks while the queue is
+    full. close() waits until all frames are written.
+    """
+    def __init__(self, max_pending=16):
+        self.queue = Queue.Queue(max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            filename, frame = item
+            try:
+                write_frame(filename, frame)
+            except Exception as e:
+                self.error = e
+
+    def write(self, filename, frame):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((filename, frame))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+class BoardRenderer:
+    """
+    Draws the halfboards once into a cached background and keeps one text
+    artist per node for the glyph of its piece. update(dirty) only draws the
+    glyphs of the nodes in dirty again, on the background restored behind
+    them.
+    """
+    def __init__(self, halfboards, game):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        self.game = game
+        self.figure = Figure()
+        self.canvas = FigureCanvasAgg(self.figure)
+        ax = self.axes = self.figure.add_subplot(111)
+        ax.plot(0., 0., 'x')
+        colorlist = [p.playerID.color for p in game.players]
+        for h, color in zip(halfboards, colorlist):
+            h.plot(color, ax, pieces=False)
+        self.canvas.draw()
+        self.renderer = self.canvas.get_renderer()
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+        self.glyphs = {}
+        for h in halfboards:
+            for r in h.rectangles():
+                center = r.center()
+                self.glyphs[r.node.index] = ax.text(center[0], center[1], '', animated=True)
+        self.extents = dict((i, None) for i in self.glyphs)
+        self.redraw()
+
+    def set_glyph(self, i):
+        """
+        Set the text of the glyph of node i to its piece. Returns the
+        extent of the glyph, None if the node is empty.
+        """
+        p = self.game.board[i]
+        glyph = self.glyphs[i]
+        if p is None:
+            glyph.set_text('')
+            return None
+        glyph.set_text(piece_letters[p.kind])
+        glyph.set_color(p.owner.plt_color)
+        return glyph.get_window_extent(self.renderer).padded(2)
+
+    def clear(self, bbox):
+        # restore_region takes the bbox in rows from the top of the canvas,
+        # and xy as the origin of the saved region
+        height = self.figure.bbox.height
+        x0, y0, x1, y1 = bbox.extents
+        self.canvas.restore_region(self.background, xy=(0, 0),
+                                   bbox=(int(np.floor(x0)), int(np.floor(height-y1)),
+                                         int(np.ceil(x1)), int(np.ceil(height-y0))))
+
+    def redraw(self):
+        """
+        Draw the whole board: the background and all glyphs.
+        """
+        self.canvas.restore_region(self.background)
+        for i in sorted(self.glyphs):
+            self.extents[i] = self.set_glyph(i)
+            if self.extents[i] is not None:
+                self.axes.draw_artist(self.glyphs[i])
+
+    def update(self, dirty):
+        """
+        Draw the glyphs of the nodes with indices in dirty again. The
+        background is restored behind their old and new glyphs and behind
+        every glyph that overlaps these, which are drawn again as well, in
+        the order of redraw, so that the result is the same.
+        """
+        dirty = [i for i in dirty if i in self.glyphs]
+        areas = [self.extents[i] for i in dirty if self.extents[i] is not None]
+        for i in dirty:
+            self.extents[i] = self.set_glyph(i)
+        areas.extend(self.extents[i] for i in dirty if self.extents[i] is not None)
+        redraw = set(i for i in dirty if self.extents[i] is not None)
+        while areas:
+            area = areas.pop()
+            self.clear(area)
+            for (i, extent) in self.extents.iteritems():
+                if extent is not None and i not in redraw and extent.overlaps(area):
+                    redraw.add(i)
+                    areas.append(extent)
+        for i in sorted(redraw):
+            self.axes.draw_artist(self.glyphs[i])
+
+    def frame(self):
+        """
+        A copy of the current picture as an RGBA array.
+        """
+        width, height = self.canvas.get_width_height()
+        return np.frombuffer(self.canvas.buffer_rgba(), np.uint8).reshape(height, width, 4).copy()
+
+# SVG names of the matplotlib color letters used for the squares
+svg_colors = {'k': 'black', 'w': 'white'}
+
+def svg_color(color):
+    if color is None:
+        return 'black'
+    return svg_colors.get(color, color)
+
+def svg_points(points):
+    return ' '.join('%.4f,%.4f' % (x[0], -x[1]) for x in points)
+
+class SvgRenderer:
+    """
+    Draws the board as an SVG document in pure Python, with the geometry of
+    generate_halfboards. The squares and the outlines of the corner boards
+    are formatted once; render() only adds one text element per piece.
+    """
+    def __init__(self, halfboards, game, size=480):
+        self.game = game
+        colorlist = [p.playerID.color for p in game.players]
+        squares = []
+        outlines = []
+        self.prefixes = []
+        for h, color in zip(halfboards, colorlist):
+            for cb in (h.cb_left, h.cb_right):
+                outlines.append('<polygon points="%s" fill="none" stroke="%s" stroke-width="0.006"/>'
+                                % (svg_points(cb.corners()), svg_color(color)))
+                for r in cb.rectangles:
+                    fill = 'none' if r.face_color is None else svg_color(r.face_color)
+                    squares.append('<polygon points="%s" fill="%s"/>' % (svg_points(r.corners()), fill))
+                    center = r.center()
+                    self.prefixes.append((r.node.index, '<text x="%.4f" y="%.4f" fill="' % (center[0], -center[1])))
+        self.head = ('<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" viewBox="-1.05 -1.05 2.1 2.1">\n'
+                     % (size, size)
+                     + '\n'.join(squares + outlines)
+                     + '\n<g font-family="sans-serif" font-size="0.07" text-anchor="middle" dominant-baseline="central">\n')
+        self.tail = '</g>\n</svg>\n'
+        self.glyphs = [[svg_color(p.playerID.plt_color) + '">' + letter + '</text>\n' for letter in piece_letters]
+                       for p in game.players]
+
+    def render(self):
+        """
+        The SVG document of the current board.
+        """
+        board = self.game.board
+        glyphs = self.glyphs
+        parts = [self.head]
+        for (i, prefix) in self.prefixes:
+            p = board[i]
+            if p is not None:
+                parts.append(prefix)
+                parts.append(glyphs[p.owner.id][p.kind])
+        parts.append(self.tail)
+        return ''.join(parts)
 
 class GuiGame(thc.Game):
+    """
+    A game that saves a picture of the board after every move, as PNG drawn
+    with matplotlib (format='png') or as SVG (format='svg').
+    """
+    def __init__(self, generator, listeners=(), format='png', **kwargs):
+        if format not in ('png', 'svg'):
+            raise ValueError("Unknown format " + str(format))
+        thc.Game.__init__(self, generator, listeners, **kwargs)
+        self.format = format
+        self.halfboards = getattr(generator, 'gui_halfboards', None)
+        self.renderer = None
+        self.svg_renderer = None
+        self.writer = None
+        self.dirty = set()
+
     def set_halfboards(self, generator):
         self.halfboards = generator.gui_halfboards
+        self.renderer = None
+        self.svg_renderer = None
+
+    def make_move(self, move):
+        self.dirty.add(move.start.index)
+        self.dirty.add(move.end.index)
+        return thc.Game.make_move(self, move)
+
+    def restore(self, state):
+        thc.Game.restore(self, state)
+        self.dirty = set(range(len(self.board)))
+
+    def unmake_move(self):
+        move = thc.Game.unmake_move(self)
+        self.dirty.add(move.start.index)
+        self.dirty.add(move.end.index)
+        return move
+
+    def render(self):
+        """
+        The picture of the current board as an RGBA array.
+        """
+        if self.renderer is None:
+            self.renderer = BoardRenderer(self.halfboards, self)
+        else:
+            self.renderer.update(self.dirty)
+        self.dirty = set()
+        return self.renderer.frame()
+
+    def render_svg(self):
+        """
+        The SVG document of the current board.
+        """
+        if self.svg_renderer is None:
+            self.svg_renderer = SvgRenderer(self.halfboards, self)
+        return self.svg_renderer.render()
 
     def print_board(self, filename):
-        plt.hold(False)
-        plt.plot(0., 0., 'x')
-        plt.hold(True)
-        colorlist = [p.playerID.color for p in self.players]
-        for h, color in zip(self.halfboards, colorlist):
-            h.plot(color)
-        plt.savefig(filename)
+        """
+        Save the picture of the board to filename. PNG pictures are written
+        in the background; see close_frames.
+        """
+        if self.format=='svg':
+            f = open(filename, 'w')
+            try:
+                f.write(self.render_svg())
+            finally:
+                f.close()
+            return
+        frame = self.render()
+        if self.writer is None:
+            self.writer = FrameWriter()
+        self.writer.write(filename, frame)
+
+    def close_frames(self):
+        """
+        Wait until all pictures are written.
+        """
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
 
     def play(self, max_moves=100):
         turn_idx = 0
-        while not self.game_over and turn_idx < max_moves:
-            turn_idx += 1
-            filename = ('board%.3d.png' % turn_idx) #.format( turn_idx)
-            self.play_next_move()
-            self.print_board(filename)
+        try:
+            while not self.game_over and turn_idx < max_moves:
+                turn_idx += 1
+                filename = ('board%.3d.%s' % (turn_idx, self.format)) #.format( turn_idx)
+                self.play_next_move()
+                self.print_board(filename)
+        finally:
+            self.close_frames()
         return self.winner
 
 
 
 def test_plot_board():
+    import matplotlib.pyplot as plt
     halfboards = generate_halfboards()
     colorlist = ['k', 'y', 'b','r']
     for (h,color) in zip(halfboards, colorlist):
@@ -196,7 +473,7 @@ def test_plot_board():
 
 def test_guigame():
     generator = GuiNChessGenerator()
-    game = GuiGame(generator)
+    game = GuiGame(generator, [thc.ConsolePrinter()])
     game.set_halfboards(generator)
     game.play()
 
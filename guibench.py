@@ -0,0 +1,87 @@
+"""
+Start-up and per-frame cost of drawing boards.
+
+startup  seconds to start a python process and import aiplayer (which
+         imports gui), as a headless worker does, and the same with
+         matplotlib.pyplot imported as well, which gui used to do on import
+frames   milliseconds per frame after a random move for the SVG renderer,
+         the incremental matplotlib renderer of GuiGame and a full matplotlib
+         redraw (background and all pieces)
+
+python guibench.py --players 3 --moves 200
+"""
+
+import argparse
+import random
+import subprocess
+import sys
+import time
+
+import threechess as thc
+import gui
+
+def startup_seconds(statement, repeat=5):
+    """
+    The shortest time of repeat python processes that run statement.
+    """
+    code = ("import time\n"
+            "start = time.time()\n"
+            + statement + "\n"
+            "import sys\n"
+            "print time.time()-start, 'matplotlib' in sys.modules\n")
+    best = None
+    for k in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', code]).split()
+        seconds = float(output[0])
+        if best is None or seconds<best:
+            best = seconds
+        loaded = output[1]=='True'
+    return best, loaded
+
+def frame_times(n_players, n_moves, seed=0):
+    """
+    Milliseconds per frame of the SVG renderer, the incremental renderer
+    and a full redraw over a game of up to n_moves random moves.
+    """
+    rnd = random.Random(seed)
+    generator = gui.GuiNChessGenerator(n_players, player_type_list=[thc.Player]*n_players)
+    game = gui.GuiGame(generator)
+    game.render()
+    game.render_svg()
+    svg = incremental = full = 0.
+    frames = 0
+    for ply in range(n_moves):
+        moves = game.generate_moves(ply % n_players)
+        if not moves or game.game_over:
+            break
+        p, e = rnd.choice(moves)
+        game.make_move(thc.Move(p, p.position, game.node_list[e]))
+        start = time.time()
+        game.render_svg()
+        svg += time.time()-start
+        start = time.time()
+        game.render()
+        incremental += time.time()-start
+        start = time.time()
+        game.renderer.redraw()
+        game.renderer.frame()
+        full += time.time()-start
+        frames += 1
+    frames = max(frames, 1)
+    return 1000*svg/frames, 1000*incremental/frames, 1000*full/frames
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the start-up and frame cost of drawing boards.")
+    parser.add_argument('--players', type=int, default=3)
+    parser.add_argument('--moves', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=5, help="processes started per start-up measurement")
+    args = parser.parse_args()
+    for (name, statement) in (('import aiplayer', 'import aiplayer'),
+                              ('import aiplayer, matplotlib.pyplot', 'import aiplayer, matplotlib.pyplot')):
+        seconds, loaded = startup_seconds(statement, args.repeat)
+        print "startup %-36s %.3fs%s" % (name, seconds, ", matplotlib loaded" if loaded else "")
+    svg, incremental, full = frame_times(args.players, args.moves)
+    print "frames: svg %.3f ms, matplotlib incremental %.3f ms, matplotlib full %.3f ms" % (svg, incremental, full)
+
+if __name__=='__main__':
+    main()
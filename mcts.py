@@ -0,0 +1,328 @@
+"""
+A Monte Carlo tree search player for N-player chess.
+
+MCTSPlayer grows a tree of the positions after its move with UCT: every
+node keeps the sum of the rewards of the simulations through it as a
+vector with one entry per player, and the player to move at a node selects
+the child that is best for its own entry. A simulation ends with a random
+game (a rollout) from the new leaf. A rollout always captures a king when
+it can, and with probability capture_bias prefers a capture; otherwise it
+plays a uniformly random move, like aiplayer.RandomPlayer. A rollout that
+reaches max_rollout plies is scored by the share of the material of every
+player.
+
+With processes>1 the rollouts of a batch of leaves run in a pool of worker
+processes. Every worker keeps a copy of the game at the root, restored from
+a snapshot of the game (see Game.snapshot) when the root changes, so only
+the moves from the root to a leaf are sent per rollout. Leaves of a batch
+are spread by a virtual loss: their visits are counted when they are
+selected.
+
+The subtree of the position after the moves of the other players is kept
+for the next turn if the position is in it.
+"""
+
+import math
+import multiprocessing
+import random
+import time
+
+import threechess as thc
+from search import piece_values, predict_order, extend_order
+
+class TreeNode(object):
+    """
+    A position in the tree, reached by move (start, end) from its parent,
+    with mover to move and key its Game.position_key.
+    untried holds the moves without a child, None before the node is
+    expanded. terminal is the reward vector of a finished game.
+    """
+    __slots__ = ('move', 'mover', 'key', 'children', 'untried', 'visits', 'rewards', 'terminal')
+
+    def __init__(self, move, mover, key, n_players):
+        self.move = move
+        self.mover = mover
+        self.key = key
+        self.children = {}
+        self.untried = None
+        self.visits = 0
+        self.rewards = [0.]*n_players
+        self.terminal = None
+
+def material_shares(game):
+    m = [sum(v*len(pieces) for (v, pieces) in zip(piece_values, by_kind)) + 1
+         for by_kind in game.live_by_kind]
+    total = float(sum(m))
+    return [v/total for v in m]
+
+def outcome(game):
+    """
+    The reward vector of a position: 1 for the winner of a finished game,
+    otherwise the material shares.
+    """
+    if game.game_over:
+        winner = int(game.winner.playerID)
+        return [1. if k==winner else 0. for k in range(game.n_players)]
+    return material_shares(game)
+
+def rollout(game, order, ply, max_plies, rnd, capture_bias):
+    """
+    Play random moves from the current position, with order[ply] to move,
+    and return the outcome. The position is restored afterwards.
+    """
+    board = game.board
+    node_list = game.node_list
+    made = 0
+    while not game.game_over and made<max_plies:
+        moves = game.generate_moves(order[ply+made])
+        if not moves:
+            break
+        move = None
+        captures = []
+        for (p, e) in moves:
+            if board[e] is not None:
+                if board[e].kind==thc.King.kind:
+                    move = (p, e)
+                    break
+                captures.append((p, e))
+        if move is None:
+            if captures and rnd.random()<capture_bias:
+                move = rnd.choice(captures)
+            else:
+                move = rnd.choice(moves)
+        p, e = move
+        game.do_move(thc.Move(p, p.position, node_list[e]))
+        made += 1
+    reward = outcome(game)
+    for k in range(made):
+        game.unmake_move()
+    return reward
+
+def apply_moves(game, moves):
+    for (start, end) in moves:
+        game.do_move(thc.Move(game.board[start], game.node_list[start], game.node_list[end]))
+
+# the game of a worker process, see run_rollouts
+worker_root = {'key': None, 'game': None}
+
+def run_rollouts(batch):
+    """
+    Run the rollouts of a batch in a worker process. A batch is
+    (root, order, max_plies, capture_bias, leaves), where root is the
+    snapshot of the game at the root and leaves a list of (moves from the
+    root, seed). Returns the reward vector of every leaf.
+    """
+    root, order, max_plies, capture_bias, leaves = batch
+    if worker_root['key']!=root:
+        worker_root['key'] = root
+        worker_root['game'] = thc.game_from_snapshot(root)
+    game = worker_root['game']
+    rewards = []
+    for (path, seed) in leaves:
+        apply_moves(game, path)
+        rewards.append(rollout(game, order, len(path), max_plies, random.Random(seed), capture_bias))
+        for k in range(len(path)):
+            game.unmake_move()
+    return rewards
+
+class MCTSPlayer:
+    """
+    Plays the most visited move after a search limited by max_time seconds
+    and, if given, by a number of simulations. To configure it for a
+    generator, pass e.g.
+    functools.partial(MCTSPlayer, max_time=2., processes=4)
+    as player type. With processes>1 call close() when done to stop the
+    worker processes.
+
+    After every move, self.stats holds the number of simulations, the
+    time used, the simulations per second and the visits reused from the
+    previous turn.
+    """
+    def __init__(self, playerID, max_time=1., simulations=None, processes=1, exploration=1.4,
+                 max_rollout=200, capture_bias=0.5, batch_size=None, seed=None, verbose=False):
+        self.playerID = playerID
+        self.max_time = max_time
+        self.simulations = simulations
+        self.processes = processes
+        self.exploration = exploration
+        self.max_rollout = max_rollout
+        self.capture_bias = capture_bias
+        if batch_size is None:
+            batch_size = 8*processes
+        self.batch_size = batch_size
+        self.rnd = random.Random(seed)
+        self.verbose = verbose
+        self.pool = None
+        self.tree = None
+        self.tree_ply = None
+        self.stats = {}
+
+    def get_move_list(self, game):
+        return [self.playerID.id] + [k for k in range(game.n_players) if k!=self.playerID.id]
+
+    def get_move(self, game):
+        start = time.time()
+        deadline = start + self.max_time
+        self.root_id = self.playerID.id
+        self.order = predict_order(game, self.root_id, self.max_rollout + 256)
+        root = self.find_root(game)
+        reused = root.visits
+        done = 0
+        while time.time()<deadline and (self.simulations is None or done<self.simulations):
+            n = self.batch_size
+            if self.simulations is not None:
+                n = min(n, self.simulations-done)
+            if self.processes>1:
+                done += self.run_parallel(game, root, n)
+            else:
+                done += self.run_serial(game, root, n)
+            if root.untried==[] and not root.children:
+                break
+        if not root.children:
+            return self.fallback_move(game)
+        best = max(root.children.itervalues(), key=lambda c: c.visits)
+        elapsed = time.time() - start
+        self.stats = {'simulations': done, 'time': elapsed, 'sps': done/max(elapsed, 1e-6),
+                      'reused': reused, 'visits': best.visits,
+                      'value': best.rewards[self.root_id]/max(best.visits, 1)}
+        if self.verbose:
+            print self.report()
+        self.tree = best
+        self.tree_ply = len(game.undo_stack)+1
+        s, e = best.move
+        return thc.Move(game.board[s], game.node_list[s], game.node_list[e])
+
+    def fallback_move(self, game):
+        moves = game.generate_moves(self.playerID)
+        if not moves:
+            return None
+        p, e = moves[0]
+        return thc.Move(p, p.position, game.node_list[e])
+
+    def report(self):
+        return ("%s: %d simulations in %.2fs (%d/s), %d visits reused, best move %d visits"
+                % (self, self.stats['simulations'], self.stats['time'], self.stats['sps'],
+                   self.stats['reused'], self.stats['visits']))
+
+    def find_root(self, game):
+        """
+        The node of the current position in the tree of the last turn, or
+        a new node.
+        """
+        key = game.position_key(self.root_id)
+        node = self.tree
+        if node is not None and self.tree_ply is not None and len(game.undo_stack)>=self.tree_ply:
+            for (start, end) in game.move_history()[self.tree_ply:]:
+                node = node.children.get((start, end))
+                if node is None:
+                    break
+        else:
+            node = None
+        if node is None or node.key!=key:
+            node = TreeNode(None, self.root_id, key, game.n_players)
+        self.tree = None
+        return node
+
+    def select(self, game, root):
+        """
+        Walk down from root by UCT and add one child, applying the moves to
+        game. Counts a visit on every node of the path. Returns the path;
+        the caller takes back its moves.
+        """
+        node = root
+        path = [root]
+        ply = 0
+        node_list = game.node_list
+        while node.terminal is None:
+            if node.untried is None:
+                node.untried = [(p.square, e) for (p, e) in game.generate_moves(node.mover)]
+                self.rnd.shuffle(node.untried)
+            if node.untried:
+                start, end = node.untried.pop()
+                game.do_move(thc.Move(game.board[start], node_list[start], node_list[end]))
+                ply += 1
+                if ply+self.max_rollout>=len(self.order):
+                    # the tree grew deeper than the predicted order
+                    extend_order(self.order, ply+self.max_rollout+256, game.n_players)
+                child = TreeNode((start, end), self.order[ply], game.position_key(self.order[ply]), game.n_players)
+                if game.game_over:
+                    child.terminal = outcome(game)
+                node.children[(start, end)] = child
+                path.append(child)
+                break
+            if not node.children:
+                node.terminal = outcome(game)
+                break
+            node = self.best_child(node)
+            start, end = node.move
+            game.do_move(thc.Move(game.board[start], node_list[start], node_list[end]))
+            ply += 1
+            path.append(node)
+        for n in path:
+            n.visits += 1
+        return path
+
+    def best_child(self, node):
+        mover = node.mover
+        log_n = math.log(node.visits)
+        c = self.exploration
+        best = None
+        best_value = None
+        for child in node.children.itervalues():
+            value = child.rewards[mover]/child.visits + c*math.sqrt(log_n/child.visits)
+            if best is None or value>best_value:
+                best, best_value = child, value
+        return best
+
+    def backpropagate(self, path, reward):
+        for n in path:
+            rewards = n.rewards
+            for k in range(len(reward)):
+                rewards[k] += reward[k]
+
+    def run_serial(self, game, root, n):
+        for k in range(n):
+            path = self.select(game, root)
+            leaf = path[-1]
+            if leaf.terminal is not None:
+                reward = leaf.terminal
+            else:
+                reward = rollout(game, self.order, len(path)-1, self.max_rollout, self.rnd, self.capture_bias)
+            for j in range(len(path)-1):
+                game.unmake_move()
+            self.backpropagate(path, reward)
+        return n
+
+    def run_parallel(self, game, root, n):
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.processes)
+        paths = []
+        leaves = []
+        for k in range(n):
+            path = self.select(game, root)
+            for j in range(len(path)-1):
+                game.unmake_move()
+            if path[-1].terminal is not None:
+                self.backpropagate(path, path[-1].terminal)
+            else:
+                paths.append(path)
+                leaves.append(([node.move for node in path[1:]], self.rnd.getrandbits(32)))
+        if leaves:
+            root_state = game.snapshot()
+            chunks = [leaves[k::self.processes] for k in range(self.processes)]
+            batches = [(root_state, self.order, self.max_rollout, self.capture_bias, c)
+                       for c in chunks if c]
+            results = self.pool.map(run_rollouts, batches)
+            for k, rewards in enumerate(results):
+                for path, reward in zip(paths[k::self.processes], rewards):
+                    self.backpropagate(path, reward)
+        return n
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def __str__(self):
+        return "MCTS Player " + str(self.playerID)
@@ -0,0 +1,96 @@
+"""
+Memory used per game.
+
+Creates games, plays random moves in them and reports the bytes per game,
+measured in two ways:
+
+objects  the sizes of all objects reachable from a game, without the parts
+         that are shared by all games on a board (topology, board template,
+         Zobrist keys) and without classes, functions and modules
+rss      the growth of the resident memory of the process, divided by the
+         number of games
+
+python membench.py --games 200 --players 4 --moves 100
+"""
+
+import argparse
+import gc
+import os
+import random
+import sys
+import types
+
+import threechess as thc
+
+shared_types = (type, types.ClassType, types.ModuleType, types.FunctionType,
+                types.BuiltinFunctionType, types.MethodType)
+
+def reachable(roots, exclude=()):
+    """
+    The ids and total size of the objects reachable from roots that are
+    not in exclude (a set of ids) and are not classes, functions or modules.
+    """
+    seen = set()
+    size = 0
+    stack = list(roots)
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or id(obj) in exclude or isinstance(obj, shared_types):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        stack.extend(gc.get_referents(obj))
+    return seen, size
+
+def object_bytes(game):
+    shared, _ = reachable([game.topology, thc.board_templates])
+    seen, size = reachable([game], shared)
+    return size
+
+def rss_bytes():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+
+def play_random(game, n_moves, rnd):
+    for ply in range(n_moves):
+        moves = game.generate_moves(ply % game.n_players)
+        if not moves or game.game_over:
+            break
+        p, e = rnd.choice(moves)
+        game.make_move(thc.Move(p, p.position, game.node_list[e]))
+
+def new_game(n_players, history=True):
+    generator = thc.NChessGenerator(n_players, player_type_list=[thc.Player]*n_players)
+    return thc.Game(generator, history=history)
+
+def measure(n_games, n_players, n_moves, history=True, seed=0):
+    """
+    Returns (object bytes per game, rss bytes per game).
+    """
+    rnd = random.Random(seed)
+    new_game(n_players, history)
+    gc.collect()
+    start = rss_bytes()
+    games = []
+    for k in range(n_games):
+        game = new_game(n_players, history)
+        play_random(game, n_moves, rnd)
+        games.append(game)
+    gc.collect()
+    rss = float(rss_bytes()-start)/n_games
+    objects = sum(object_bytes(g) for g in games[:10])/float(min(n_games, 10))
+    return objects, rss
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the memory used per game.")
+    parser.add_argument('--games', type=int, default=200)
+    parser.add_argument('--players', type=int, default=4)
+    parser.add_argument('--moves', type=int, default=100, help="random moves played in every game")
+    parser.add_argument('--no-history', action='store_true', help="do not keep the moves played")
+    args = parser.parse_args()
+    objects, rss = measure(args.games, args.players, args.moves, not args.no_history)
+    print ("%d players, %d moves: %.0f bytes per game in objects, %.0f bytes per game rss"
+           % (args.players, args.moves, objects, rss))
+
+if __name__=='__main__':
+    main()
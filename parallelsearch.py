@@ -0,0 +1,188 @@
+"""
+Root parallel search.
+
+ParallelSearchPlayer is a SearchPlayer that splits the root moves of every
+iteration of its iterative deepening over a pool of worker processes. Every
+worker keeps a copy of the game, restored from a snapshot of the game when
+the position changes (like the rollout workers of mcts.py), and searches its
+share of the root moves with alpha-beta or max^n and its own transposition
+table. The best move of every share is exact, so the best of them is the
+best move of the iteration. The root moves are dealt out in search order,
+so every worker gets some of the promising moves.
+
+With reproducible=True the search ignores the clock and always searches to
+max_depth, which must then be given, and every share is searched with an empty table, so the chosen
+move only depends on the position, max_depth and the number of shares.
+
+Run as a script, it reports the speedup per number of processes on the
+start positions of NChessGenerator:
+
+python parallelsearch.py --players 3 4 --processes 1 2 4 8 --depth 6
+"""
+
+import argparse
+import multiprocessing
+import time
+
+import threechess as thc
+from search import SearchPlayer, SearchTimeout
+from zobrist import TranspositionTable
+
+# the game and search players of a worker process, see search_share
+worker_state = {'key': None, 'game': None, 'players': {}}
+
+def search_share(task):
+    """
+    Search a share of the root moves in a worker process. A task is
+    (position, move_generator, strategy, root, order, moves, depth, deadline,
+    fresh), where position is a snapshot of the game (see Game.snapshot),
+    move_generator the class of its move generator and moves the (start,
+    end) root moves to search. A deadline of None searches without a time
+    limit, fresh searches with an empty transposition table.
+    Returns (best move, value, nodes); the move is None after a timeout.
+    """
+    position, move_generator, strategy, root, order, moves, depth, deadline, fresh = task
+    key = (position, move_generator)
+    if worker_state['key']!=key:
+        worker_state['key'] = key
+        worker_state['game'] = thc.game_from_snapshot(position, move_generator=move_generator)
+    game = worker_state['game']
+    players = worker_state['players']
+    if fresh or strategy not in players:
+        players[strategy] = SearchPlayer(game.players[root].playerID, strategy, table=TranspositionTable())
+    player = players[strategy]
+    player.playerID = game.players[root].playerID
+    player.root = root
+    player.nodes = 0
+    player.deadline = float('inf') if deadline is None else deadline
+    player.table.new_search()
+    board = game.board
+    try:
+        best, value = player.search_root(game, [(board[s], e) for (s, e) in moves], order, depth)
+    except SearchTimeout:
+        return None, None, player.nodes
+    return (best[0].square, best[1]), value, player.nodes
+
+class ParallelSearchPlayer(SearchPlayer):
+    """
+    A SearchPlayer that searches the root moves in processes worker
+    processes, split into shares (by default one per process). To configure
+    it for a generator, pass e.g.
+    functools.partial(ParallelSearchPlayer, strategy='maxn', max_time=0.5, processes=8)
+    as player type, and call close() when done to stop the workers. With
+    processes=1 the shares are searched in the player's process.
+
+    stats['nodes'] counts the nodes of all workers. A reproducible player
+    searches to max_depth whatever the time, so it needs a max_depth; the
+    default of other players is that of SearchPlayer.
+    """
+    def __init__(self, playerID, strategy='paranoid', max_time=1., max_depth=None, processes=2,
+                 shares=None, reproducible=False, verbose=False):
+        if max_depth is None:
+            if reproducible:
+                raise ValueError("a reproducible search needs a max_depth")
+            max_depth = 64
+        SearchPlayer.__init__(self, playerID, strategy, max_time, max_depth, verbose=verbose)
+        self.processes = processes
+        if shares is None:
+            shares = processes
+        self.shares = shares
+        self.reproducible = reproducible
+        self.pool = None
+        self.position = None
+        self.move_generator = None
+
+    def get_move(self, game):
+        self.position = game.snapshot()
+        self.move_generator = game.move_generator.__class__
+        if self.reproducible:
+            max_time = self.max_time
+            self.max_time = float('inf')
+            try:
+                return SearchPlayer.get_move(self, game)
+            finally:
+                self.max_time = max_time
+        return SearchPlayer.get_move(self, game)
+
+    def search_root(self, game, moves, order, depth):
+        root_moves = [(p.square, e) for (p, e) in moves]
+        deadline = None if self.reproducible else self.deadline
+        tasks = [(self.position, self.move_generator, self.strategy, self.root, order,
+                  root_moves[k::self.shares], depth, deadline, self.reproducible)
+                 for k in range(min(self.shares, len(root_moves)))]
+        if self.processes>1:
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(self.processes)
+            results = self.pool.map(search_share, tasks, chunksize=1)
+        else:
+            results = map(search_share, tasks)
+        best = None
+        best_value = None
+        best_index = None
+        for (move, value, nodes) in results:
+            self.nodes += nodes
+        for (move, value, nodes) in results:
+            if move is None:
+                raise SearchTimeout()
+            index = root_moves.index(move)
+            if (best is None or self.score(value)>self.score(best_value)
+                    or (self.score(value)==self.score(best_value) and index<best_index)):
+                best, best_value, best_index = move, value, index
+        return moves[best_index], best_value
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def __str__(self):
+        return "Parallel Search Player " + str(self.playerID)
+
+def start_position(n_players):
+    generator = thc.NChessGenerator(n_players, player_type_list=[thc.Player]*n_players)
+    return thc.Game(generator)
+
+def measure(n_players, processes, strategy, depth, shares=None):
+    """
+    Search the start position with n_players to depth in reproducible mode.
+    Returns (seconds, nodes, move).
+    """
+    game = start_position(n_players)
+    player = ParallelSearchPlayer(game.players[0].playerID, strategy, max_depth=depth, processes=processes,
+                                  shares=shares, reproducible=True)
+    try:
+        if processes>1:
+            # start the workers before the clock
+            player.pool = multiprocessing.Pool(processes)
+            player.pool.map(abs, range(processes))
+        start = time.time()
+        move = player.get_move(game)
+        elapsed = time.time() - start
+    finally:
+        player.close()
+    return elapsed, player.stats['nodes'], (move.start.nodeID, move.end.nodeID)
+
+def main():
+    parser = argparse.ArgumentParser(description="Report the speedup of the root parallel search.")
+    parser.add_argument('--players', type=int, nargs='+', default=[3, 4])
+    parser.add_argument('--processes', type=int, nargs='+',
+                        default=sorted(set([1, 2, 4, multiprocessing.cpu_count()])))
+    parser.add_argument('--strategy', choices=('paranoid', 'maxn'), default='paranoid')
+    parser.add_argument('--depth', type=int, default=6)
+    parser.add_argument('--shares', type=int, default=None,
+                        help="shares of the root moves (default: one per process)")
+    args = parser.parse_args()
+    print "%d cores" % multiprocessing.cpu_count()
+    for n in args.players:
+        base = None
+        for k in args.processes:
+            elapsed, nodes, move = measure(n, k, args.strategy, args.depth, args.shares)
+            if base is None:
+                base = elapsed
+            print ("%d players, %2d processes: %.2fs, %d nodes (%d nodes/s), speedup %.2f, move %s to %s"
+                   % (n, k, elapsed, nodes, nodes/max(elapsed, 1e-6), base/max(elapsed, 1e-6),
+                      move[0], move[1]))
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,281 @@
+"""
+Perft: count the positions reachable from a position to a fixed depth, as
+a correctness check and benchmark of move generation.
+
+The players move in the order 0, 1, ..., n_players-1, 0, ... . A position in
+which a king was captured ends the game and counts as a leaf.
+Every board is checked from its start position and from a middle game
+position reached by a fixed sequence of random moves (see opening), where
+the pieces of the players interact already at small depths. --rows and
+--columns select the board size; the counts in known_counts are those of
+the default board of 4 rows and 8 columns and must not change unless the
+rules change.
+
+python perft.py --players 2-6 --depth 3
+python perft.py --rows 6 --columns 8
+python perft.py --save-baseline perft.json
+python perft.py --baseline perft.json --threshold 0.25
+python perft.py --engine attacks
+
+exits with status 1 if a count differs from the known count, or if the
+speed of a board is more than threshold below the saved baseline.
+
+The known counts were obtained with the move generation of threechess.py.
+All of them to depth 4 and the start position counts to depth 5 were also
+obtained with the original move generation of the nodes (get_possible_moves
+and Node.get_next_nodes of the first revision of threechess.py, see
+reference_perft):
+
+git show $(git rev-list --max-parents=0 HEAD):threechess.py > original.py
+python perft.py --reference original.py --depth 4
+python perft.py --reference original.py --depth 5 --opening-plies 0
+
+That revision recurses without end along a diagonal that runs in a circle
+without a piece on it (see Topology.trace_ray), which happens from depth 5
+in the middle game of 3 players, so such counts can not be compared.
+"""
+
+import argparse
+import imp
+import json
+import random
+import sys
+import time
+
+import threechess as thc
+
+OPENING_PLIES = 40
+
+# (n_players, opening plies, depth): number of leaf positions
+known_counts = {
+    (2, 0, 1): 20, (2, 0, 2): 400, (2, 0, 3): 8902, (2, 0, 4): 197742, (2, 0, 5): 4896886,
+    (3, 0, 1): 20, (3, 0, 2): 400, (3, 0, 3): 8000, (3, 0, 4): 178040, (3, 0, 5): 3958348,
+    (4, 0, 1): 20, (4, 0, 2): 400, (4, 0, 3): 8000, (4, 0, 4): 160000, (4, 0, 5): 3560800,
+    (5, 0, 1): 20, (5, 0, 2): 400, (5, 0, 3): 8000, (5, 0, 4): 160000, (5, 0, 5): 3200000,
+    (6, 0, 1): 20, (6, 0, 2): 400, (6, 0, 3): 8000, (6, 0, 4): 160000, (6, 0, 5): 3200000,
+    (2, 40, 1): 38, (2, 40, 2): 1084, (2, 40, 3): 41506, (2, 40, 4): 1265622,
+    (3, 40, 1): 24, (3, 40, 2): 1079, (3, 40, 3): 31900, (3, 40, 4): 803892,
+    (4, 40, 1): 27, (4, 40, 2): 1055, (4, 40, 3): 34896, (4, 40, 4): 1106357,
+    (5, 40, 1): 31, (5, 40, 2): 957, (5, 40, 3): 27935, (5, 40, 4): 1029876,
+    (6, 40, 1): 28, (6, 40, 2): 1122, (6, 40, 3): 32454, (6, 40, 4): 772175,
+}
+
+class PerftStats:
+    """
+    Number of move generation calls, generated moves and time spent in
+    move generation per piece kind.
+    """
+    def __init__(self):
+        n = len(thc.piece_types)
+        self.calls = [0]*n
+        self.moves = [0]*n
+        self.time = [0.]*n
+        self.nodes = 0
+
+    def moves_per_second(self, kind):
+        if self.time[kind]==0:
+            return 0.
+        return self.moves[kind]/self.time[kind]
+
+    def __str__(self):
+        lines = []
+        for (kind, t) in enumerate(thc.piece_types):
+            lines.append("  %-6s %9d calls %10d moves %12.0f moves/s"
+                         % (t.__name__, self.calls[kind], self.moves[kind], self.moves_per_second(kind)))
+        return "\n".join(lines)
+
+def perft(game, depth, ply=0, stats=None):
+    """
+    Number of leaf positions depth plies below the current position, with
+    player ply%n_players to move.
+    """
+    if depth==0 or game.game_over:
+        return 1
+    if stats is not None:
+        stats.nodes += 1
+    node_list = game.node_list
+    piece_moves = game.move_generator.piece_moves
+    total = 0
+    # captures only remove pieces of other players, so this list does not
+    # change while the moves are tried
+    for p in game.get_pieces(ply%game.n_players):
+        if stats is None:
+            moves = piece_moves(p)
+        else:
+            start = time.time()
+            moves = piece_moves(p)
+            stats.time[p.kind] += time.time()-start
+            stats.calls[p.kind] += 1
+            stats.moves[p.kind] += len(moves)
+        for e in moves:
+            game.do_move(thc.Move(p, p.position, node_list[e]))
+            total += perft(game, depth-1, ply+1, stats)
+            game.unmake_move()
+    return total
+
+def new_game(n_players, move_generator=thc.PieceMoveGenerator, n_rows=4, n_cols=8):
+    return thc.Game(thc.NChessGenerator(n_players, n_rows, n_cols, player_type_list=[thc.Player]*n_players),
+                    move_generator=move_generator)
+
+def opening(game, plies, seed=0):
+    """
+    Play plies random moves that do not capture a king. The moves are drawn
+    from the sorted (start, end) pairs, so the resulting position does not
+    depend on the order in which moves are generated.
+    """
+    rnd = random.Random(seed)
+    for ply in range(plies):
+        moves = sorted((p.square, e) for p in game.get_pieces(ply%game.n_players)
+                       for e in p.get_move_indices()
+                       if game.board[e] is None or game.board[e].kind!=thc.King.kind)
+        start, end = rnd.choice(moves)
+        game.do_move(thc.Move(game.board[start], game.node_list[start], game.node_list[end]))
+    return game
+
+def run(n_players, depth, opening_plies=0, verbose=True, move_generator=thc.PieceMoveGenerator,
+        n_rows=4, n_cols=8):
+    """
+    Run perft on an n_players board after opening_plies opening moves.
+    Returns (count, positions per second, stats); the timed run also
+    collects the per piece statistics, so it is slower than an untimed run.
+    """
+    game = opening(new_game(n_players, move_generator, n_rows, n_cols), opening_plies)
+    start = time.time()
+    count = perft(game, depth, opening_plies)
+    elapsed = max(time.time()-start, 1e-9)
+    stats = PerftStats()
+    perft(game, depth, opening_plies, stats)
+    assert(game.hash==game.compute_hash())
+    nps = count/elapsed
+    if verbose:
+        print ("%d players, %dx%d, %d opening plies, depth %d: %d positions in %.2fs (%.0f positions/s)"
+               % (n_players, n_rows, n_cols, opening_plies, depth, count, elapsed, nps))
+        print stats
+    return count, nps, stats
+
+def reference_perft(module, game, depth, ply=0):
+    """
+    perft on a game of module, a first revision of threechess.py, whose
+    pieces generate their moves with get_possible_moves by walking the
+    nodes. Moves are made and taken back on the nodes and pieces directly,
+    as that revision has no do_move.
+    """
+    if depth==0:
+        return 1
+    total = 0
+    owner = ply%len(game.players)
+    for p in [q for q in game.pieces if q.alive and q.owner.id==owner]:
+        start = p.position
+        for end in p.get_possible_moves():
+            captured = end.piece
+            if isinstance(captured, module.King):
+                total += 1
+                continue
+            start.piece = None
+            p.position = end
+            p.history.append(end)
+            end.piece = p
+            if captured is not None:
+                captured.alive = False
+            total += reference_perft(module, game, depth-1, ply+1)
+            if captured is not None:
+                captured.alive = True
+            end.piece = captured
+            p.history.pop()
+            p.position = start
+            start.piece = p
+    return total
+
+def reference_count(module, n_players, depth, opening_plies=0, n_rows=4, n_cols=8, verbose=True):
+    """
+    Count like run, with the move generation of module (see
+    reference_perft). The opening moves are those of opening, made on the
+    nodes with the same nodeID.
+    """
+    generator = module.NChessGenerator(n_players, n_rows, n_cols, player_type_list=[module.Player]*n_players)
+    # the first revision has colors for four players only
+    generator.generate_playerIDs = lambda: [module.PlayerID(k) for k in range(n_players)]
+    game = module.Game(generator)
+    nodes = dict((n.nodeID, n) for n in game.nodes.itervalues())
+    played = opening(new_game(n_players, n_rows=n_rows, n_cols=n_cols), opening_plies)
+    for (code, captured, game_over, winner, key) in played.undo_stack:
+        start, end = [nodes[played.node_list[j].nodeID] for j in played.unpack_move(code)]
+        p = start.piece
+        start.piece = None
+        p.position = end
+        p.history.append(end)
+        if end.piece is not None:
+            end.piece.alive = False
+        end.piece = p
+    start = time.time()
+    count = reference_perft(module, game, depth, opening_plies)
+    if verbose:
+        print ("%d players, %dx%d, %d opening plies, depth %d: %d positions in %.2fs with %s"
+               % (n_players, n_rows, n_cols, opening_plies, depth, count, time.time()-start, module.__file__))
+    return count
+
+def parse_range(s):
+    if '-' in s:
+        lo, hi = s.split('-')
+        return range(int(lo), int(hi)+1)
+    return [int(k) for k in s.split(',')]
+
+def main():
+    parser = argparse.ArgumentParser(description="Count positions to a fixed depth and time move generation.")
+    parser.add_argument('--players', default='2-6', help="e.g. 3 or 2-6 or 3,4")
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--opening-plies', type=int, nargs='+', default=[0, OPENING_PLIES],
+                        help="count from the positions after these numbers of opening moves")
+    parser.add_argument('--rows', type=int, default=4)
+    parser.add_argument('--columns', '--cols', type=int, default=8)
+    parser.add_argument('--engine', default='pieces', choices=sorted(thc.move_generator_names),
+                        help="move generator to check and time")
+    parser.add_argument('--baseline', default=None, help="JSON file with positions/s to compare against")
+    parser.add_argument('--save-baseline', default=None, help="write the measured positions/s to this JSON file")
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help="allowed relative slowdown against the baseline")
+    parser.add_argument('--reference', default=None,
+                        help="count with the move generation of this first revision of threechess.py instead")
+    args = parser.parse_args()
+    move_generator = thc.get_move_generator(args.engine)
+    reference = None
+    if args.reference is not None:
+        reference = imp.load_source('reference_threechess', args.reference)
+    baseline = {}
+    if args.baseline is not None:
+        baseline = json.load(open(args.baseline))
+    measured = {}
+    failures = []
+    for n in parse_range(args.players):
+        for plies in args.opening_plies:
+            if reference is not None:
+                try:
+                    count = reference_count(reference, n, args.depth, plies, args.rows, args.columns)
+                except RuntimeError:
+                    print "%d players, %d opening plies: the reference recursed without end" % (n, plies)
+                    continue
+            else:
+                count, nps, stats = run(n, args.depth, plies, move_generator=move_generator,
+                                        n_rows=args.rows, n_cols=args.columns)
+            key = "%d,%d,%d,%d,%d" % (n, args.rows, args.columns, plies, args.depth)
+            name = "%d players, %dx%d, %d opening plies, depth %d" % (n, args.rows, args.columns, plies, args.depth)
+            known = None
+            if (args.rows, args.columns)==(4, 8):
+                known = known_counts.get((n, plies, args.depth))
+            if known is None:
+                print "  no known count"
+            elif count!=known:
+                failures.append("%s: %d positions, expected %d" % (name, count, known))
+            if reference is not None:
+                continue
+            measured[key] = nps
+            if key in baseline and nps<(1-args.threshold)*baseline[key]:
+                failures.append("%s: %.0f positions/s, baseline %.0f" % (name, nps, baseline[key]))
+    if args.save_baseline is not None:
+        json.dump(measured, open(args.save_baseline, 'w'), indent=1, sort_keys=True)
+    for f in failures:
+        print "FAILED:", f
+    return 1 if failures else 0
+
+if __name__=='__main__':
+    sys.exit(main())
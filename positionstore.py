@@ -0,0 +1,376 @@
+"""
+A persistent store of search results, shared by processes and runs.
+
+A store file holds a fixed number of records in an open addressed hash
+table on the Game.position_key of the positions, and is accessed through
+mmap. It starts with a header
+
+header   struct '<8sBBBxII': the magic string 'NCHESSP2', n_players,
+         n_rows, n_cols, number of slots (a power of two), number of
+         filled slots
+
+followed by the slots, one record each:
+
+record   struct '<QIHHhxxI' + n_players floats: position key (0 for an
+         empty slot), sequence number, start and end node index of the best
+         move (0xffff for none), search depth, visits, and the score of
+         every player (NaN where unknown)
+
+A key is looked up in the slots following its low bits, at most max_probes
+of them. A store holds the results of one board size; the keys are the same
+in every process, since the Zobrist keys are.
+
+Any number of processes can read a store at the same time without locking.
+Writes take an exclusive flock on the file. The sequence number of a slot
+is odd while its record is written and is incremented again when it is
+written; readers skip a slot with an odd sequence number, or one that
+changed while they read the record, so that they never use a half written
+record. Players collect their results and merge them in batches, see
+StorePlayer:
+
+player_type = functools.partial(StorePlayer, store='book.pos',
+                                player_type=functools.partial(search.SearchPlayer, max_time=0.5))
+
+python positionstore.py create book.pos --players 4 --slots 1048576
+python positionstore.py merge book.pos run1.pos run2.pos
+python positionstore.py info book.pos
+"""
+
+import argparse
+import fcntl
+import mmap
+import os
+import struct
+
+import threechess as thc
+
+MAGIC = 'NCHESSP2'
+HEADER = struct.Struct('<8sBBBxII')
+NO_MOVE = 0xffff
+
+# offset of the sequence number in a record
+SEQUENCE = 8
+
+def record_struct(n_players):
+    return struct.Struct('<QIHHhxxI' + 'f'*n_players)
+
+def create_store(path, n_players, n_rows=4, n_cols=8, n_slots=2**20):
+    """
+    Create an empty store file with n_slots slots (rounded up to a power of
+    two) for games of n_players on boards of n_rows x n_cols per player.
+    """
+    n = 1
+    while n<n_slots:
+        n *= 2
+    record = record_struct(n_players)
+    f = open(path, 'wb')
+    try:
+        f.write(HEADER.pack(MAGIC, n_players, n_rows, n_cols, n, 0))
+        f.truncate(HEADER.size + n*record.size)
+    finally:
+        f.close()
+
+def better(depth, visits, old_depth, old_visits):
+    """
+    True if a result of depth and visits should replace an older one.
+    """
+    return depth>old_depth or (depth==old_depth and visits>old_visits)
+
+class PositionStore:
+    """
+    An open store file. Results are (move, depth, scores, visits) tuples,
+    where move is a (start, end) pair of node indices or None and scores a
+    tuple of one float per player.
+    """
+    max_probes = 8
+
+    def __init__(self, path, writable=True):
+        self.path = path
+        self.writable = writable
+        self.file = open(path, 'r+b' if writable else 'rb')
+        header = self.file.read(HEADER.size)
+        if len(header)<HEADER.size or header[:len(MAGIC)]!=MAGIC:
+            self.file.close()
+            if header[:len(MAGIC)-1]==MAGIC[:-1]:
+                raise ValueError(path + " is a position store of another format version")
+            raise ValueError(path + " is not a position store")
+        magic, self.n_players, self.n_rows, self.n_cols, self.n_slots, filled = HEADER.unpack(header)
+        self.mask = self.n_slots-1
+        self.record = record_struct(self.n_players)
+        access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+        self.map = mmap.mmap(self.file.fileno(), HEADER.size + self.n_slots*self.record.size, access=access)
+        self.hits = 0
+        self.misses = 0
+
+    def check(self, game):
+        """
+        Raise ValueError if game is not played on the board of the store.
+        """
+        t = game.topology
+        if (game.n_players, t.n_rows, t.n_cols)!=(self.n_players, self.n_rows, self.n_cols):
+            raise ValueError("%s holds %d player %dx%d positions"
+                             % (self.path, self.n_players, self.n_rows, self.n_cols))
+
+    def offset(self, slot):
+        return HEADER.size + slot*self.record.size
+
+    def read(self, slot):
+        """
+        The (key, result) in a slot, or (0, None) if it is empty or being
+        written.
+        """
+        offset = self.offset(slot)
+        sequence = struct.unpack_from('<I', self.map, offset+SEQUENCE)[0]
+        if sequence & 1:
+            return 0, None
+        fields = self.record.unpack_from(self.map, offset)
+        key = fields[0]
+        if key==0 or struct.unpack_from('<I', self.map, offset+SEQUENCE)[0]!=sequence:
+            return 0, None
+        start, end, depth, visits = fields[2:6]
+        move = None if start==NO_MOVE else (start, end)
+        return key, (move, depth, fields[6:], visits)
+
+    def lookup(self, key):
+        """
+        The stored result for a position key, or None.
+        """
+        record = self.record
+        data = self.map
+        for k in range(self.max_probes):
+            offset = HEADER.size + ((key+k) & self.mask)*record.size
+            stored = struct.unpack_from('<Q', data, offset)[0]
+            if stored==key:
+                found, result = self.read((key+k) & self.mask)
+                if found==key:
+                    self.hits += 1
+                    return result
+                break
+            if stored==0:
+                break
+        self.misses += 1
+        return None
+
+    def lock(self):
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+
+    def unlock(self):
+        self.map.flush()
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+
+    def write(self, slot, key, move, depth, scores, visits):
+        offset = self.offset(slot)
+        start, end = (NO_MOVE, NO_MOVE) if move is None else move
+        scores = list(scores) + [float('nan')]*(self.n_players-len(scores))
+        sequence = struct.unpack_from('<I', self.map, offset+SEQUENCE)[0] | 1
+        struct.pack_into('<I', self.map, offset+SEQUENCE, sequence)
+        self.record.pack_into(self.map, offset, key, sequence, start, end, depth, visits, *scores)
+        struct.pack_into('<I', self.map, offset+SEQUENCE, (sequence+1) & 0xffffffff)
+
+    def put(self, key, move, depth, scores, visits):
+        """
+        Store a result without locking, see merge. Returns True if it was
+        stored: a result replaces the one of the same position if it is
+        better (deeper, or as deep with more visits). Otherwise it takes an
+        empty slot or the slot of the worst result among its slots, if it
+        is better than that result.
+        """
+        if key==0:
+            return False
+        worst = None
+        worst_result = None
+        for k in range(self.max_probes):
+            slot = (key+k) & self.mask
+            old_key, old = self.read(slot)
+            if old_key==key:
+                if not better(depth, visits, old[1], old[3]):
+                    return False
+                self.write(slot, key, move, depth, scores, visits)
+                return True
+            if old_key==0:
+                self.write(slot, key, move, depth, scores, visits)
+                self.add_filled(1)
+                return True
+            if worst is None or better(worst_result[1], worst_result[3], old[1], old[3]):
+                worst, worst_result = slot, old
+        if not better(depth, visits, worst_result[1], worst_result[3]):
+            return False
+        self.write(worst, key, move, depth, scores, visits)
+        return True
+
+    def add_filled(self, n):
+        offset = HEADER.size - 4
+        filled = struct.unpack_from('<I', self.map, offset)[0]
+        struct.pack_into('<I', self.map, offset, filled+n)
+
+    def store(self, key, move, depth, scores, visits=0):
+        self.lock()
+        try:
+            return self.put(key, move, depth, scores, visits)
+        finally:
+            self.unlock()
+
+    def merge(self, results):
+        """
+        Store (key, move, depth, scores, visits) results under one lock.
+        Returns the number of results that were stored.
+        """
+        stored = 0
+        self.lock()
+        try:
+            for (key, move, depth, scores, visits) in results:
+                if self.put(key, move, depth, scores, visits):
+                    stored += 1
+        finally:
+            self.unlock()
+        return stored
+
+    def __iter__(self):
+        """
+        The (key, move, depth, scores, visits) of all stored results.
+        """
+        for slot in xrange(self.n_slots):
+            key, result = self.read(slot)
+            if key:
+                yield (key,) + result
+
+    def __len__(self):
+        return struct.unpack_from('<I', self.map, HEADER.size-4)[0]
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __str__(self):
+        return ("PositionStore %s: %d player %dx%d, %d/%d filled"
+                % (self.path, self.n_players, self.n_rows, self.n_cols, len(self), self.n_slots))
+
+def result_scores(value, playerID, n_players):
+    """
+    The score vector of a search value: a vector is kept, a single number is
+    the score of playerID.
+    """
+    if isinstance(value, (tuple, list)):
+        return tuple(float(v) for v in value)
+    scores = [float('nan')]*n_players
+    if value is not None:
+        scores[int(playerID)] = float(value)
+    return tuple(scores)
+
+class StorePlayer:
+    """
+    Plays the stored move of a position if it was searched to at least
+    min_depth or with at least min_visits visits (MCTS results have depth
+    0), and asks a player of
+    player_type otherwise. With record=True the results of that player
+    (taken from its stats, see search.SearchPlayer and mcts.MCTSPlayer) are
+    collected and merged into the store every flush_every moves and by
+    close(). store is a PositionStore or the path of a store file, which is
+    then opened by the player and closed by close().
+    """
+    def __init__(self, playerID, store, player_type, min_depth=1, min_visits=1000, record=True, flush_every=64):
+        self.playerID = playerID
+        self.own_store = not isinstance(store, PositionStore)
+        if self.own_store:
+            store = PositionStore(store, writable=record)
+        self.store = store
+        self.player = player_type(playerID)
+        self.min_depth = min_depth
+        self.min_visits = min_visits
+        self.record = record
+        self.flush_every = flush_every
+        self.pending = []
+        self.book_moves = 0
+
+    def get_move_list(self, game):
+        return self.player.get_move_list(game)
+
+    def stored_move(self, game):
+        self.store.check(game)
+        result = self.store.lookup(game.position_key(self.playerID))
+        if result is None:
+            return None
+        move, depth, scores, visits = result
+        if move is None or (depth<self.min_depth and visits<self.min_visits):
+            return None
+        start, end = move
+        p = game.board[start] if start<len(game.board) else None
+        if p is None or p.owner is not self.playerID or end not in game.move_generator.piece_moves(p):
+            return None
+        return thc.Move(p, p.position, game.node_list[end])
+
+    def get_move(self, game):
+        move = self.stored_move(game)
+        if move is not None:
+            self.book_moves += 1
+            return move
+        key = game.position_key(self.playerID)
+        move = self.player.get_move(game)
+        stats = getattr(self.player, 'stats', None)
+        if self.record and move is not None and stats:
+            depth = stats.get('depth', 0)
+            visits = stats.get('simulations', 0)
+            if depth>0 or visits>0:
+                scores = result_scores(stats.get('value'), self.playerID, game.n_players)
+                self.pending.append((key, (move.start.index, move.end.index), depth, scores, visits))
+                if len(self.pending)>=self.flush_every:
+                    self.flush()
+        return move
+
+    def flush(self):
+        if self.pending:
+            self.store.merge(self.pending)
+            self.pending = []
+
+    def close(self):
+        if self.record:
+            self.flush()
+        if hasattr(self.player, 'close'):
+            self.player.close()
+        if self.own_store and self.store is not None:
+            self.store.close()
+            self.store = None
+
+    def __str__(self):
+        return "Store Player " + str(self.playerID)
+
+def main():
+    parser = argparse.ArgumentParser(description="Create, merge and inspect position stores.")
+    commands = parser.add_subparsers(dest='command')
+    create = commands.add_parser('create', help="create an empty store")
+    create.add_argument('path')
+    create.add_argument('--players', type=int, default=4)
+    create.add_argument('--rows', type=int, default=4)
+    create.add_argument('--columns', type=int, default=8)
+    create.add_argument('--slots', type=int, default=2**20)
+    merge = commands.add_parser('merge', help="merge the results of other stores into a store")
+    merge.add_argument('path')
+    merge.add_argument('sources', nargs='+')
+    info = commands.add_parser('info', help="describe a store")
+    info.add_argument('path')
+    args = parser.parse_args()
+    if args.command=='create':
+        if os.path.exists(args.path):
+            parser.error(args.path + " exists")
+        create_store(args.path, args.players, args.rows, args.columns, args.slots)
+        print PositionStore(args.path, writable=False)
+    elif args.command=='merge':
+        store = PositionStore(args.path)
+        for path in args.sources:
+            source = PositionStore(path, writable=False)
+            if (source.n_players, source.n_rows, source.n_cols)!=(store.n_players, store.n_rows, store.n_cols):
+                parser.error(path + " holds positions of another board")
+            stored = store.merge(iter(source))
+            print "%s: %d of %d results stored" % (path, stored, len(source))
+            source.close()
+        print store
+    else:
+        store = PositionStore(args.path, writable=False)
+        print store
+        depths = {}
+        for (key, move, depth, scores, visits) in store:
+            depths[depth] = depths.get(depth, 0) + 1
+        print "results per depth: " + ", ".join("%d: %d" % kv for kv in sorted(depths.items()))
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,225 @@
+"""
+Compact binary game records.
+
+A record file starts with the magic string 'NCHESSR1' followed by records:
+
+header     struct '<BBBbII': n_players, n_rows, n_cols, winner (-1 for none),
+           number of moves, number of move order decisions
+moves      (start, end) node index pairs, one byte per index on boards with at
+           most 256 nodes, two bytes (little endian) otherwise
+decisions  one byte for the deciding player and n_players bytes for the
+           new order of moves, per decision
+
+Next to every record file <path> lives an index file <path>.idx with the
+offset of every record as little endian uint64, so that game k can be read
+without parsing the games before it.
+"""
+
+import array
+import os
+import struct
+import sys
+
+import numpy as np
+
+import threechess as thc
+
+MAGIC = 'NCHESSR1'
+HEADER = struct.Struct('<BBBbII')
+
+def index_typecode(n_nodes):
+    if n_nodes<=256:
+        return 'B'
+    return 'H'
+
+class GameRecord:
+    """
+    The generator parameters, the moves as (start, end) node indices, the
+    move order decisions as (decider, order) and the winner of one game.
+    """
+    def __init__(self, n_players, n_rows, n_cols, moves=None, decisions=None, winner=None):
+        self.n_players = n_players
+        self.n_rows = n_rows
+        self.n_cols = n_cols
+        self.moves = moves if moves is not None else []
+        self.decisions = decisions if decisions is not None else []
+        self.winner = winner
+
+    def pack(self):
+        winner = -1 if self.winner is None else self.winner
+        s = HEADER.pack(self.n_players, self.n_rows, self.n_cols, winner,
+                        len(self.moves), len(self.decisions))
+        moves = array.array(index_typecode(self.n_players*self.n_rows*self.n_cols))
+        for (start, end) in self.moves:
+            moves.append(start)
+            moves.append(end)
+        if sys.byteorder!='little':
+            moves.byteswap()
+        decisions = array.array('B')
+        for (decider, order) in self.decisions:
+            decisions.append(decider)
+            decisions.extend(order)
+        return s + moves.tostring() + decisions.tostring()
+
+    @classmethod
+    def unpack(cls, data, offset=0):
+        n_players, n_rows, n_cols, winner, n_moves, n_decisions = HEADER.unpack_from(data, offset)
+        offset += HEADER.size
+        moves = array.array(index_typecode(n_players*n_rows*n_cols))
+        size = 2*n_moves*moves.itemsize
+        moves.fromstring(data[offset:offset+size])
+        if sys.byteorder!='little':
+            moves.byteswap()
+        offset += size
+        decisions = array.array('B')
+        decisions.fromstring(data[offset:offset+n_decisions*(n_players+1)])
+        record = cls(n_players, n_rows, n_cols,
+                     zip(moves[0::2], moves[1::2]),
+                     [(decisions[k], tuple(decisions[k+1:k+1+n_players]))
+                      for k in range(0, len(decisions), n_players+1)],
+                     None if winner<0 else winner)
+        return record
+
+    def __len__(self):
+        return len(self.moves)
+
+class GameRecorder(thc.GameListener):
+    """
+    Collects a GameRecord while a game is played:
+
+    recorder = GameRecorder()
+    game.subscribe(recorder)
+    game.play()
+    writer.write(recorder.record)
+    """
+    def __init__(self):
+        self.record = None
+
+    def start(self, game):
+        t = game.topology
+        self.record = GameRecord(game.n_players, t.n_rows, t.n_cols)
+
+    def order_decided(self, game, decider, new_order):
+        if self.record is None:
+            self.start(game)
+        self.record.decisions.append((int(decider.playerID), tuple(int(p.playerID) for p in new_order)))
+
+    def move_made(self, game, move):
+        if self.record is None:
+            self.start(game)
+        self.record.moves.append((move.start.index, move.end.index))
+
+    def game_over(self, game, winner):
+        self.record.winner = int(winner.playerID)
+
+class GameRecordWriter:
+    """
+    Appends records to a record file and its index.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.data = open(path, 'ab')
+        self.data.seek(0, os.SEEK_END)
+        if self.data.tell()==0:
+            self.data.write(MAGIC)
+        self.index = open(path + '.idx', 'ab')
+
+    def write(self, record):
+        """
+        Append a GameRecord or an already packed record.
+        """
+        if isinstance(record, GameRecord):
+            record = record.pack()
+        # the record goes to the file before its index entry, so that an
+        # entry never points past the end of the file
+        offset = self.data.tell()
+        self.data.write(record)
+        self.data.flush()
+        self.index.write(struct.pack('<Q', offset))
+        self.index.flush()
+
+    def flush(self):
+        self.data.flush()
+        self.index.flush()
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class GameRecordReader:
+    """
+    Random access to the records of a record file:
+
+    reader = GameRecordReader(path)
+    record = reader[k]
+    """
+    def __init__(self, path):
+        self.path = path
+        self.data = open(path, 'rb')
+        if self.data.read(len(MAGIC))!=MAGIC:
+            raise ValueError(path + " is not a game record file")
+        self.data.seek(0, os.SEEK_END)
+        self.size = self.data.tell()
+        if os.path.getsize(path + '.idx')>0:
+            self.offsets = np.memmap(path + '.idx', dtype='<u8', mode='r')
+        else:
+            self.offsets = np.zeros(0, dtype='<u8')
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, k):
+        if k<0:
+            k += len(self)
+        if not 0<=k<len(self):
+            raise IndexError("record index out of range")
+        start = int(self.offsets[k])
+        end = int(self.offsets[k+1]) if k+1<len(self) else self.size
+        self.data.seek(start)
+        return GameRecord.unpack(self.data.read(end-start))
+
+    def __iter__(self):
+        for k in xrange(len(self)):
+            yield self[k]
+
+    def close(self):
+        self.data.close()
+
+def replay(record, player_type=thc.Player):
+    """
+    Rebuild the positions of a recorded game. Yields the game before the
+    first move and after every move. The moves and the recorded move order
+    decisions are applied like Game.play_next_move does, so move_list and
+    move_decision_list follow the original game and listeners subscribed
+    to the yielded game see the same events.
+    """
+    generator = thc.NChessGenerator(record.n_players, record.n_rows, record.n_cols,
+                                    [player_type]*record.n_players)
+    game = thc.Game(generator)
+    decisions = iter(record.decisions)
+    yield game
+    for (start, end) in record.moves:
+        move_decider = game.next_decider()
+        if move_decider is not None:
+            try:
+                decider, order = next(decisions)
+            except StopIteration:
+                raise ValueError("the record has too few move decisions")
+            if decider!=int(move_decider.playerID):
+                raise ValueError("the record does not match the order of move decisions")
+            game.apply_order(move_decider, order)
+        game.next_mover()
+        node = game.node_list[start]
+        game.make_move(thc.Move(node.piece, node, game.node_list[end]))
+        yield game
+
+def final_position(record):
+    for game in replay(record):
+        pass
+    return game
@@ -0,0 +1,318 @@
+"""
+A search based player for N-player chess.
+
+SearchPlayer looks ahead with iterative deepening until a wall-clock deadline,
+using one of two multi-player strategies:
+
+paranoid: all other players are assumed to play against the searching player,
+          which turns the game into a two-sided game for alpha-beta pruning.
+maxn:     every player maximizes its own entry of a score vector.
+"""
+
+import time
+
+import threechess as thc
+from zobrist import TranspositionTable, EXACT, LOWER, UPPER
+
+# material values, indexed by Piece.kind (King, Queen, Bishop, Knight, Rook, Pawn)
+piece_values = (0, 9, 3, 3, 5, 1)
+WIN = 100000
+INFINITY = 10*WIN
+
+class SearchTimeout(Exception):
+    pass
+
+def generate_moves(game, playerID):
+    """
+    All moves of playerID as (piece, end index) pairs, in search order:
+    king captures, then the other captures with the most valuable victim and
+    the least valuable attacker first, then all other moves.
+    """
+    board = game.board
+    kings = []
+    captures = []
+    quiet = []
+    for (p, e) in game.generate_moves(playerID):
+        victim = board[e]
+        if victim is None:
+            quiet.append((p, e))
+        elif victim.kind==thc.King.kind:
+            kings.append((p, e))
+        else:
+            captures.append((16*piece_values[victim.kind]-piece_values[p.kind], p, e))
+    captures.sort(key=lambda c: c[0], reverse=True)
+    return kings + [(p, e) for (v, p, e) in captures] + quiet
+
+def predict_order(game, first, length):
+    """
+    The players (as ints) to move in the next length plies, starting with
+    first. Beyond the part of game.move_list that is already decided, the
+    last decided order is assumed to repeat.
+    """
+    n = game.n_players
+    upcoming = [int(p.playerID) for p in game.move_list]
+    if len(upcoming)<n:
+        upcoming = [(first+k)%n for k in range(1, n+1)]
+    order = [first] + upcoming
+    extend_order(order, length, n)
+    return order
+
+def extend_order(order, length, n_players):
+    """
+    Extend a predicted order in place to at least length plies, by
+    repeating its last n_players entries.
+    """
+    while len(order)<length:
+        order.extend(order[-n_players:])
+
+def order_key(game, order, ply):
+    """
+    Key of the players to move after order[ply] in the next n_players-1
+    plies, to be combined with game.position_key(order[ply]).
+    """
+    upcoming = game.zobrist.upcoming
+    key = 0
+    for k in range(len(upcoming)):
+        key ^= upcoming[k][order[ply+1+k]]
+    return key
+
+def to_table(value, ply):
+    """
+    A win value as it is stored in a transposition table, counting the
+    plies to the end of the game from the node at ply rather than from the
+    root. from_table converts it back.
+    """
+    if value>=WIN//2:
+        return value + ply
+    if value<=-WIN//2:
+        return value - ply
+    return value
+
+def from_table(value, ply):
+    if value>=WIN//2:
+        return value - ply
+    if value<=-WIN//2:
+        return value + ply
+    return value
+
+def material(game):
+    return [sum(v*len(pieces) for (v, pieces) in zip(piece_values, by_kind))
+            for by_kind in game.live_by_kind]
+
+def move_to_front(moves, tt_move):
+    if tt_move is None:
+        return
+    for k, (p, e) in enumerate(moves):
+        if p.square==tt_move[0] and e==tt_move[1]:
+            moves.insert(0, moves.pop(k))
+            return
+
+class SearchPlayer:
+    """
+    Plays the best move found by a search of at most max_time seconds.
+    To configure it for a generator, pass e.g.
+    functools.partial(SearchPlayer, strategy='maxn', max_time=0.5)
+    as player type. Players can share a TranspositionTable.
+
+    After every move, self.stats holds the completed depth, the number of
+    searched nodes, the time used and the nodes per second.
+    """
+    def __init__(self, playerID, strategy='paranoid', max_time=1., max_depth=64, table=None, verbose=False):
+        if strategy not in ('paranoid', 'maxn'):
+            raise ValueError("Unknown search strategy " + str(strategy))
+        self.playerID = playerID
+        self.strategy = strategy
+        self.max_time = max_time
+        self.max_depth = max_depth
+        if table is None:
+            table = TranspositionTable()
+        self.table = table
+        self.verbose = verbose
+        self.stats = {}
+        self.nodes = 0
+
+    def get_move_list(self, game):
+        return [self.playerID.id] + [k for k in range(game.n_players) if k!=self.playerID.id]
+
+    def get_move(self, game):
+        start = time.time()
+        self.deadline = start + self.max_time
+        self.nodes = 0
+        self.root = self.playerID.id
+        self.table.new_search()
+        order = self.turn_order(game)
+        moves = generate_moves(game, self.playerID)
+        if not moves:
+            return None
+        best = moves[0]
+        depth = 0
+        value = None
+        victim = game.board[best[1]]
+        if len(moves)>1 and (victim is None or victim.kind!=thc.King.kind):
+            try:
+                for d in range(1, self.max_depth+1):
+                    best, value = self.search_root(game, moves, order, d)
+                    depth = d
+                    moves.remove(best)
+                    moves.insert(0, best)
+                    if self.decided(value):
+                        break
+            except SearchTimeout:
+                pass
+        elapsed = time.time() - start
+        self.stats = {'depth': depth, 'nodes': self.nodes, 'time': elapsed,
+                      'nps': self.nodes/max(elapsed, 1e-6), 'value': value}
+        if self.verbose:
+            print self.report()
+        p, e = best
+        return thc.Move(p, p.position, game.node_list[e])
+
+    def report(self):
+        return ("%s: depth %d, %d nodes in %.2fs (%d nodes/s)"
+                % (self, self.stats['depth'], self.stats['nodes'], self.stats['time'], self.stats['nps']))
+
+    def turn_order(self, game):
+        """
+        The players to move in the next plies, starting with this player,
+        far enough for order_key at every ply of the search.
+        """
+        return predict_order(game, self.root, self.max_depth+game.n_players)
+
+    def decided(self, value):
+        if self.strategy=='maxn':
+            value = value[self.root]
+        return abs(value)>=WIN-self.max_depth
+
+    def check_time(self):
+        self.nodes += 1
+        if self.nodes & 127==0 and time.time()>self.deadline:
+            raise SearchTimeout()
+
+    def search_root(self, game, moves, order, depth):
+        best = None
+        best_value = None
+        alpha = -INFINITY
+        for (p, e) in moves:
+            game.do_move(thc.Move(p, p.position, game.node_list[e]))
+            try:
+                if self.strategy=='paranoid':
+                    value = self.paranoid(game, order, 1, depth-1, alpha, INFINITY)
+                else:
+                    value = self.maxn(game, order, 1, depth-1)
+            finally:
+                game.unmake_move()
+            if best is None or self.score(value)>self.score(best_value):
+                best = (p, e)
+                best_value = value
+                alpha = max(alpha, self.score(value))
+        return best, best_value
+
+    def score(self, value):
+        if self.strategy=='maxn':
+            return value[self.root]
+        return value
+
+    def paranoid(self, game, order, ply, depth, alpha, beta):
+        self.check_time()
+        if game.game_over:
+            if int(game.winner.playerID)==self.root:
+                return WIN-ply
+            return -WIN+ply
+        if depth==0:
+            return self.evaluate_paranoid(game)
+        mover = order[ply]
+        key = game.position_key(mover) ^ order_key(game, order, ply) ^ game.zobrist.perspectives[self.root]
+        entry = self.table.lookup(key)
+        tt_move = None
+        if entry is not None:
+            entry_depth, value, tt_move, flag, generation = entry
+            value = from_table(value, ply)
+            if entry_depth>=depth:
+                if flag==EXACT:
+                    return value
+                if flag==LOWER and value>=beta:
+                    return value
+                if flag==UPPER and value<=alpha:
+                    return value
+        moves = generate_moves(game, mover)
+        if not moves:
+            return self.evaluate_paranoid(game)
+        move_to_front(moves, tt_move)
+        maximizing = mover==self.root
+        alpha0, beta0 = alpha, beta
+        best_value = -INFINITY if maximizing else INFINITY
+        best_move = None
+        for (p, e) in moves:
+            start = p.square
+            game.do_move(thc.Move(p, p.position, game.node_list[e]))
+            try:
+                value = self.paranoid(game, order, ply+1, depth-1, alpha, beta)
+            finally:
+                game.unmake_move()
+            if maximizing:
+                if value>best_value:
+                    best_value, best_move = value, (start, e)
+                    alpha = max(alpha, value)
+            else:
+                if value<best_value:
+                    best_value, best_move = value, (start, e)
+                    beta = min(beta, value)
+            if alpha>=beta:
+                break
+        if best_value<=alpha0:
+            flag = UPPER
+        elif best_value>=beta0:
+            flag = LOWER
+        else:
+            flag = EXACT
+        self.table.store(key, depth, to_table(best_value, ply), best_move, flag)
+        return best_value
+
+    def maxn(self, game, order, ply, depth):
+        self.check_time()
+        if game.game_over:
+            winner = int(game.winner.playerID)
+            return tuple(WIN-ply if k==winner else -WIN+ply for k in range(game.n_players))
+        if depth==0:
+            return self.evaluate_maxn(game)
+        mover = order[ply]
+        key = game.position_key(mover) ^ order_key(game, order, ply)
+        entry = self.table.lookup(key)
+        tt_move = None
+        if entry is not None:
+            entry_depth, value, tt_move, flag, generation = entry
+            if entry_depth>=depth:
+                return tuple(from_table(v, ply) for v in value)
+        moves = generate_moves(game, mover)
+        if not moves:
+            return self.evaluate_maxn(game)
+        move_to_front(moves, tt_move)
+        best_value = None
+        best_move = None
+        for (p, e) in moves:
+            start = p.square
+            game.do_move(thc.Move(p, p.position, game.node_list[e]))
+            try:
+                value = self.maxn(game, order, ply+1, depth-1)
+            finally:
+                game.unmake_move()
+            if best_value is None or value[mover]>best_value[mover]:
+                best_value, best_move = value, (start, e)
+                if value[mover]>=WIN-ply-1:
+                    break
+        self.table.store(key, depth, tuple(to_table(v, ply) for v in best_value), best_move, EXACT)
+        return best_value
+
+    def evaluate_paranoid(self, game):
+        m = material(game)
+        others = sum(m) - m[self.root]
+        return m[self.root] - float(others)/max(game.n_players-1, 1)
+
+    def evaluate_maxn(self, game):
+        m = material(game)
+        total = sum(m)
+        n = max(game.n_players-1, 1)
+        return tuple(v - float(total-v)/n for v in m)
+
+    def __str__(self):
+        return "Search Player " + str(self.playerID)
@@ -0,0 +1,216 @@
+"""
+Headless batch self-play.
+
+Plays many games without output across a pool of worker processes and
+aggregates the results. Only a small summary of every game is sent back to
+the parent process.
+
+python selfplay.py --games 10000 --players 4 --player-types random
+python selfplay.py --games 100 --player-types maxn:0.05 --engine attacks
+python selfplay.py --games 100 --player-types paranoid:0.1 --store book.pos
+"""
+
+import argparse
+import functools
+import multiprocessing
+import random
+import time
+
+import numpy as np
+
+import threechess as thc
+from records import GameRecorder, GameRecordWriter
+
+def make_player_type(spec, store=None):
+    """
+    The player type for a spec string: 'random', 'paranoid', 'maxn' or
+    'mcts'. The search players may be followed by ':<seconds per move>',
+    e.g. 'maxn:0.05'. The MCTS player runs its rollouts in the process of
+    the game, since the games already run in a pool.
+    If store is the path of a position store, the search and MCTS players
+    play its moves and add their results to it, see positionstore.py.
+    """
+    player_type = base_player_type(spec)
+    if store is not None and not spec.startswith('random'):
+        import positionstore
+        player_type = functools.partial(positionstore.StorePlayer, store=store, player_type=player_type)
+    return player_type
+
+def base_player_type(spec):
+    name, _, arg = spec.partition(':')
+    if name=='random':
+        import aiplayer
+        return aiplayer.RandomPlayer
+    if name in ('paranoid', 'maxn'):
+        import search
+        kwargs = {'strategy': name}
+        if arg:
+            kwargs['max_time'] = float(arg)
+        return functools.partial(search.SearchPlayer, **kwargs)
+    if name=='mcts':
+        import mcts
+        kwargs = {'processes': 1}
+        if arg:
+            kwargs['max_time'] = float(arg)
+        return functools.partial(mcts.MCTSPlayer, **kwargs)
+    raise ValueError("Unknown player type " + spec)
+
+def seed_all(seed):
+    random.seed(seed)
+    np.random.seed(seed % 2**32)
+
+def play_game(task):
+    """
+    Play one game described by a task tuple
+    (index, seed, n_players, n_rows, n_cols, player_specs, max_moves, record, engine, store)
+    and return a summary dict that is cheap to send between processes.
+    If record is true, the summary contains the packed GameRecord.
+    """
+    index, seed, n_players, n_rows, n_cols, player_specs, max_moves, record, engine, store = task
+    seed_all(seed)
+    player_types = [make_player_type(s, store) for s in player_specs]
+    generator = thc.NChessGenerator(n_players, n_rows, n_cols, player_types)
+    game = thc.Game(generator, move_generator=thc.get_move_generator(engine))
+    if record:
+        recorder = GameRecorder()
+        recorder.start(game)
+        game.subscribe(recorder)
+    start = time.time()
+    game.play(max_moves=max_moves)
+    for p in game.players:
+        if hasattr(p, 'close'):
+            p.close()
+    captures = [0]*len(thc.piece_types)
+    for entry in game.undo_stack:
+        captured = entry[1]
+        if captured is not None:
+            captures[captured.kind] += 1
+    winner = None
+    if game.winner is not None:
+        winner = int(game.winner.playerID)
+    retval = {'index': index, 'seed': seed, 'players': player_specs,
+              'winner': winner, 'moves': len(game.undo_stack),
+              'captures': captures, 'time': time.time()-start}
+    if record:
+        retval['record'] = recorder.record.pack()
+    return retval
+
+class Summary:
+    """
+    Aggregated results of a batch of games.
+    """
+    def __init__(self, n_players):
+        self.n_players = n_players
+        self.games = 0
+        self.unfinished = 0
+        self.wins = [0]*n_players
+        self.wins_by_type = {}
+        self.lengths = {}
+        self.captures = [0]*len(thc.piece_types)
+        self.game_time = 0.
+
+    def add(self, result):
+        self.games += 1
+        if result['winner'] is None:
+            self.unfinished += 1
+        else:
+            self.wins[result['winner']] += 1
+            spec = result['players'][result['winner']]
+            self.wins_by_type[spec] = self.wins_by_type.get(spec, 0) + 1
+        self.lengths[result['moves']] = self.lengths.get(result['moves'], 0) + 1
+        for k, c in enumerate(result['captures']):
+            self.captures[k] += c
+        self.game_time += result['time']
+
+    def mean_length(self):
+        if self.games==0:
+            return 0.
+        return float(sum(l*c for (l, c) in self.lengths.iteritems()))/self.games
+
+    def __str__(self):
+        s  = "%d games, %d without winner\n" % (self.games, self.unfinished)
+        s += "wins per seat: " + ", ".join("%d: %d" % (k, w) for (k, w) in enumerate(self.wins)) + "\n"
+        s += "wins per player type: " + ", ".join("%s: %d" % kv for kv in sorted(self.wins_by_type.items())) + "\n"
+        if self.games:
+            s += "game length: mean %.1f, min %d, max %d moves\n" % (self.mean_length(), min(self.lengths), max(self.lengths))
+        s += "captures: " + ", ".join("%s: %d" % (t.__name__, c) for (t, c) in zip(thc.piece_types, self.captures))
+        return s
+
+def make_tasks(n_games, n_players, n_rows, n_cols, player_specs, max_moves, seed, record, engine, store):
+    for k in xrange(n_games):
+        yield (k, seed+k, n_players, n_rows, n_cols, tuple(player_specs), max_moves, record, engine, store)
+
+def run_batch(n_games, n_players=4, player_specs=None, n_rows=4, n_cols=8, max_moves=200,
+              seed=0, processes=None, chunksize=8, callback=None, record_path=None, engine='pieces', store=None):
+    """
+    Play n_games games and return their Summary.
+    player_specs holds one spec per seat (see make_player_type), game k is
+    seeded with seed+k. With processes=1 the games are played in this
+    process. callback, if given, is called with every game result.
+    If record_path is given, the games are appended in order to that
+    record file (see records.py). engine names the move generator of the
+    games, see thc.move_generator_names. store is the path of a position
+    store for the search players, see make_player_type.
+    """
+    if player_specs is None:
+        player_specs = ['random']*n_players
+    assert(len(player_specs)==n_players)
+    summary = Summary(n_players)
+    record = record_path is not None
+    tasks = make_tasks(n_games, n_players, n_rows, n_cols, player_specs, max_moves, seed, record, engine, store)
+    writer = None
+    pool = None
+    if processes==1:
+        results = (play_game(t) for t in tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        if record:
+            results = pool.imap(play_game, tasks, chunksize)
+        else:
+            results = pool.imap_unordered(play_game, tasks, chunksize)
+    if record:
+        writer = GameRecordWriter(record_path)
+    try:
+        for r in results:
+            summary.add(r)
+            if writer is not None:
+                writer.write(r.pop('record'))
+            if callback is not None:
+                callback(r)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if writer is not None:
+            writer.close()
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description="Play many games without output and summarize the results.")
+    parser.add_argument('--games', type=int, default=100)
+    parser.add_argument('--players', type=int, default=4, help="number of players")
+    parser.add_argument('--player-types', default='random',
+                        help="comma separated player spec per seat, or one spec for all seats")
+    parser.add_argument('--rows', type=int, default=4)
+    parser.add_argument('--columns', type=int, default=8)
+    parser.add_argument('--max-moves', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--processes', type=int, default=None, help="default: one per core")
+    parser.add_argument('--record', default=None, help="append the games to this record file")
+    parser.add_argument('--engine', default='pieces', choices=sorted(thc.move_generator_names), help="move generator")
+    parser.add_argument('--store', default=None,
+                        help="position store the search players consult and add to (see positionstore.py)")
+    args = parser.parse_args()
+    specs = args.player_types.split(',')
+    if len(specs)==1:
+        specs = specs*args.players
+    start = time.time()
+    summary = run_batch(args.games, args.players, specs, args.rows, args.columns,
+                        args.max_moves, args.seed, args.processes, record_path=args.record,
+                        engine=args.engine, store=args.store)
+    elapsed = time.time() - start
+    print summary
+    print "%.1fs, %.1f games/s" % (elapsed, summary.games/elapsed)
+
+if __name__=='__main__':
+    main()
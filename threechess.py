@@ -1,15 +1,24 @@
 
+from contextlib import contextmanager
+import numpy as np
+
+from zobrist import ZobristKeys
 
 all_directions = ('e','ne','n','nw','w','sw','s','se')
 direction_map = {'e':0 , 'ne':1, 'n': 2, 'nw':3, 'w':4, 'sw':5, 's':6, 'se':7}
 
-class PlayerID:
+def direction_indices(directions):
+    return tuple(direction_map[d] for d in directions)
+
+class PlayerID(object):
     """
     A playerID fully identifies a player.
     It is useful, if more information about a player is necessary, but not
     the player object itself.
     It can be compared to an int.
     """
+    __slots__ = ('id', 'color', 'name', 'plt_color')
+
     def __init__(self, intID, color=None, name=None, plt_color=None):
         self.id = intID
         self.color = color
@@ -38,14 +47,37 @@ class PlayerID:
     def __hash__(self):
         return self.id
 
-class Node:
-    def __init__(self, playerID, nodeID):
+    def __int__(self):
+        return self.id
+
+class Node(object):
+    """
+    A field of the board.
+    Nodes copied from a BoardTemplate only keep the neighbor indices of the
+    template (links) and the node list of their game; the neighbors dict is
+    built from them when it is first used. Move generation does not use it.
+    """
+    __slots__ = ('nodeID', 'index', 'owner', 'piece', 'links', 'node_list', 'neighbor_dict')
+
+    def __init__(self, playerID, nodeID, index=None, links=None, node_list=None):
         self.nodeID = nodeID
-        self.neighbors = {}
-        for d in all_directions:
-            self.neighbors[d] = []
+        self.index = index
         self.owner = playerID
         self.piece = None
+        self.links = links
+        self.node_list = node_list
+        self.neighbor_dict = None
+        if links is None:
+            self.neighbor_dict = dict((d, []) for d in all_directions)
+
+    @property
+    def neighbors(self):
+        if self.neighbor_dict is None:
+            neighbors = dict((d, []) for d in all_directions)
+            for (d, targets) in self.links:
+                neighbors[d] = [self.node_list[j] for j in targets]
+            self.neighbor_dict = neighbors
+        return self.neighbor_dict
 
     def get_next_nodes(self, moving_playerID, direction):
         if isinstance(direction, list):
@@ -71,77 +103,324 @@ class Node:
     def __str__(self):
         return str(self.nodeID)
 
-class Piece:
+class Topology:
+    """
+    The node graph compiled to integer indices.
+
+    Nodes are numbered 0..n_nodes-1 by their index attribute.
+    self.table[i, o, d, k] is the k-th neighbor of node i in direction d
+    (an index into all_directions) or -1, for a moving player with
+    orientation o: 0 if the player owns node i, 1 otherwise. The direction
+    flip of Node.get_next_nodes is already applied.
+
+    The table is resolved once per player into self.views, so that
+    self.views[playerID][i][d] is the tuple of neighbors a piece of that
+    player reaches from node i in direction d. self.rays[playerID][i][d]
+    holds the paths a sliding piece follows from node i in direction d.
+    Move generation only uses the views and rays.
+    """
+    def __init__(self, nodes):
+        nodes = sorted(nodes, key=lambda n: n.index)
+        assert([n.index for n in nodes]==range(len(nodes)))
+        self.n_nodes = len(nodes)
+        self.node_ids = [n.nodeID for n in nodes]
+        self.n_cols = max(c for (p, c, r) in self.node_ids)+1
+        self.n_rows = max(r for (p, c, r) in self.node_ids)+1
+        self.owners = np.array([n.owner.id for n in nodes], dtype=int)
+        self.n_players = int(self.owners.max())+1
+        self.degree = max(len(l) for n in nodes for l in n.neighbors.itervalues())
+        self.table = -np.ones((self.n_nodes, 2, 8, max(self.degree, 1)), dtype=int)
+        for n in nodes:
+            for d in range(8):
+                for o in range(2):
+                    neighbors = n.neighbors[all_directions[(d+4*o)%8]]
+                    for k, m in enumerate(neighbors):
+                        self.table[n.index, o, d, k] = m.index
+        self.views = [self.compile_view(p) for p in range(self.n_players)]
+        self.rays = [self.compile_rays(v) for v in self.views]
+        self.jumps = {}
+        self.zobrist = None
+        self.bits = tuple(1 << i for i in range(self.n_nodes))
+
+    def zobrist_keys(self):
+        if self.zobrist is None:
+            self.zobrist = ZobristKeys(self.n_nodes, len(piece_types), self.n_players)
+        return self.zobrist
+
+    def compile_view(self, playerID):
+        orientation = (self.owners!=playerID).astype(int)
+        table = self.table[np.arange(self.n_nodes), orientation].tolist()
+        return tuple(tuple(tuple(j for j in targets if j>=0) for targets in node)
+                     for node in table)
+
+    def compile_rays(self, view):
+        return tuple(tuple(self.trace_ray(view, i, d) for d in range(8))
+                     for i in range(self.n_nodes))
+
+    def jump_targets(self, playerID, move_orders):
+        """
+        For every node, the nodes a KnightLike piece of playerID reaches by
+        one of its move orders, ignoring the pieces in between.
+        """
+        key = (playerID, tuple(move_orders))
+        if key not in self.jumps:
+            view = self.views[playerID]
+            targets = []
+            for i in range(self.n_nodes):
+                retval = []
+                for mo in move_orders:
+                    frontier = (i,)
+                    for d in mo:
+                        frontier = [k for j in frontier for k in view[j][d]]
+                    retval.extend(frontier)
+                targets.append(tuple(retval))
+            self.jumps[key] = tuple(targets)
+        return self.jumps[key]
+
+    def trace_ray(self, view, start, direction):
+        """
+        All paths from start that keep following direction.
+        On boards with three or more players some diagonals run in a circle,
+        so a path ends before it would enter a node a second time.
+        """
+        paths = []
+        stack = [(start, ())]
+        while stack:
+            current, path = stack.pop()
+            targets = [j for j in view[current][direction] if j!=start and j not in path]
+            if not targets and path:
+                paths.append(path)
+            for j in targets:
+                stack.append((j, path + (j,)))
+        return tuple(paths)
+
+class Piece(object):
+    """
+    A piece on a node. moved counts the moves the piece made (0 for a piece
+    that has not moved yet); the nodes it visited can be looked up in the
+    game, see Game.piece_history.
+    The attributes below bind are set by the game and its move generator.
+    """
+    __slots__ = ('owner', 'position', 'square', 'moved', 'alive',
+                 'view', 'rays', 'board', 'node_list', 'keys',
+                 'slot', 'kind_slot', 'number')
+
     def __init__(self, playerID, position):
         self.owner = playerID
         self.position = position
-        self.history  = [position]
+        self.square   = position.index
+        self.moved    = 0
         self.alive    = True
 
-class King(Piece):
+    def bind(self, game):
+        """
+        Attach the piece to the integer board of a game.
+        """
+        self.view = game.topology.views[self.owner.id]
+        self.rays = game.topology.rays[self.owner.id]
+        self.board = game.board
+        self.node_list = game.node_list
+        self.keys = game.zobrist.pieces[self.kind][self.owner.id]
+
     def get_possible_moves(self):
+        node_list = self.node_list
+        return [node_list[i] for i in self.get_move_indices()]
+
+    def get_move_indices(self):
+        raise NotImplementedError()
+
+    def iter_moves(self):
+        """
+        The node indices of get_move_indices, one at a time.
+        """
+        return iter(self.get_move_indices())
+
+    def iter_captures(self):
+        """
+        The node indices of the moves that capture a piece.
+        """
+        board = self.board
+        for j in self.iter_moves():
+            if board[j] is not None:
+                yield j
+
+    def can_move_to(self, target):
+        for j in self.iter_moves():
+            if j==target:
+                return True
+        return False
+
+class King(Piece):
+    __slots__ = ()
+    kind = 0
+
+    def get_move_indices(self):
+        board = self.board
         retval = []
-        for d in all_directions:
-            retval.extend(filter(lambda x: x.piece is None,  self.position.get_next_nodes(self.owner, d)))
+        for targets in self.view[self.square]:
+            for j in targets:
+                if board[j] is None:
+                    retval.append(j)
         return retval
 
+    def iter_moves(self):
+        board = self.board
+        for targets in self.view[self.square]:
+            for j in targets:
+                if board[j] is None:
+                    yield j
+
+    def iter_captures(self):
+        # a king only moves to empty nodes
+        return iter(())
+
+    def can_move_to(self, target):
+        if self.board[target] is not None:
+            return False
+        for targets in self.view[self.square]:
+            if target in targets:
+                return True
+        return False
+
     def __str__(self):
         return "King(" + str(self.owner)+ ") at " + str(self.position)
 
 class Pawn(Piece):
-    def get_possible_moves(self):
-        retval = []
-        onestep = filter(lambda x: x.piece is None,  self.position.get_next_nodes(self.owner, 'n'))
-        retval.extend(onestep)
-        retval.extend(filter(lambda x: x.piece is not None and x.piece.owner is not self.owner, self.position.get_next_nodes(self.owner, ['nw','ne'])))
-        if len(self.history)==1:
-            for s in onestep:
-                retval.extend(filter(lambda x: x.piece is None,  s.get_next_nodes(self.owner, 'n')))
+    __slots__ = ()
+    kind = 5
+    forward = direction_map['n']
+    diagonals = direction_indices(['nw', 'ne'])
+
+    def get_move_indices(self):
+        board = self.board
+        neighbors = self.view[self.square]
+        retval = [j for j in neighbors[self.forward] if board[j] is None]
+        if not self.moved:
+            view = self.view
+            for s in list(retval):
+                retval.extend([j for j in view[s][self.forward] if board[j] is None])
+        for d in self.diagonals:
+            for j in neighbors[d]:
+                if board[j] is not None and board[j].owner is not self.owner:
+                    retval.append(j)
         return retval
 
+    def iter_moves(self):
+        board = self.board
+        view = self.view
+        for j in view[self.square][self.forward]:
+            if board[j] is None:
+                yield j
+                if not self.moved:
+                    for k in view[j][self.forward]:
+                        if board[k] is None:
+                            yield k
+        for j in self.iter_captures():
+            yield j
+
+    def can_move_to(self, target):
+        return target in self.get_move_indices()
+
+    def iter_captures(self):
+        board = self.board
+        neighbors = self.view[self.square]
+        for d in self.diagonals:
+            for j in neighbors[d]:
+                if board[j] is not None and board[j].owner is not self.owner:
+                    yield j
+
     def __str__(self):
         return "Pawn(" + str(self.owner)+ ") at " + str(self.position)
 
 class DecideAndContinuePiece(Piece):
-    def get_possible_moves(self):
+    """
+    Sliding pieces, which move in one of their initial_directions (a class
+    attribute of direction indices) until they hit a piece.
+    """
+    __slots__ = ()
+
+    def get_move_indices(self):
         retval = []
-        directiondict = {}
+        rays = self.rays[self.square]
         for d in self.initial_directions:
-            firststep = filter(lambda x: x.piece is None or x.piece.owner is not self.owner, self.position.get_next_nodes(self.owner, d))
-            directiondict[d] = firststep
-            retval.extend(firststep)
-            for s in filter(lambda x: x.piece is None, firststep):
-                retval.extend(self.continue_step(s, d))
+            for path in rays[d]:
+                self.continue_step(path, retval)
         return retval
 
-    def continue_step(self, current_node, direction):
-        nextstep = filter(lambda x: x.piece is None or x.piece.owner is not self.owner, current_node.get_next_nodes(self.owner, direction))
-        retval = []
-        for n in filter(lambda x: x.piece is None, nextstep):
-            retval.extend(self.continue_step(n, direction))
-        retval.extend(nextstep)
+    def continue_step(self, path, retval):
+        """
+        Follow path until a piece is hit, appending every reachable node
+        index to retval.
+        """
+        board = self.board
+        for j in path:
+            if board[j] is None:
+                retval.append(j)
+            else:
+                if board[j].owner is not self.owner:
+                    retval.append(j)
+                break
         return retval
 
+    def iter_moves(self):
+        board = self.board
+        rays = self.rays[self.square]
+        for d in self.initial_directions:
+            for path in rays[d]:
+                for j in path:
+                    if board[j] is None:
+                        yield j
+                    else:
+                        if board[j].owner is not self.owner:
+                            yield j
+                        break
+
+    def iter_captures(self):
+        board = self.board
+        rays = self.rays[self.square]
+        for d in self.initial_directions:
+            for path in rays[d]:
+                for j in path:
+                    if board[j] is not None:
+                        if board[j].owner is not self.owner:
+                            yield j
+                        break
+
+    def can_move_to(self, target):
+        board = self.board
+        if board[target] is not None and board[target].owner is self.owner:
+            return False
+        rays = self.rays[self.square]
+        for d in self.initial_directions:
+            for path in rays[d]:
+                if target in path:
+                    for j in path:
+                        if j==target:
+                            return True
+                        if board[j] is not None:
+                            break
+        return False
+
 class Bishop(DecideAndContinuePiece):
-    def __init__(self, playerID, position):
-        Piece.__init__(self, playerID, position)
-        self.initial_directions = ['nw','ne','sw','se']
+    __slots__ = ()
+    kind = 2
+    initial_directions = direction_indices(['nw','ne','sw','se'])
 
     def __str__(self):
         return "Bishop(" + str(self.owner)+ ") at " + str(self.position)
 
 class Rook(DecideAndContinuePiece):
-    def __init__(self, playerID, position):
-        Piece.__init__(self, playerID, position)
-        self.initial_directions = ['n','s','e','w']
+    __slots__ = ()
+    kind = 4
+    initial_directions = direction_indices(['n','s','e','w'])
 
     def __str__(self):
         return "Rook(" + str(self.owner)+ ") at " + str(self.position)
 
 class Queen(DecideAndContinuePiece):
-    def __init__(self, playerID, position):
-        Piece.__init__(self, playerID, position)
-        self.initial_directions = all_directions
+    __slots__ = ()
+    kind = 1
+    initial_directions = direction_indices(all_directions)
 
     def __str__(self):
         return "Queen(" + str(self.owner)+ ") at " + str(self.position)
@@ -150,39 +429,48 @@ class KnightLike(Piece):
     """
     Nightlike pieces have a set of move orders that they can do.
     Like knights, they can ignore other pieces on the nodes they pass.
-    This set must defined in the constructor as self.move_orders
+    This set must be defined as the class attribute move_orders, each move
+    order being a sequence of direction indices. The targets of all move
+    orders are looked up in the topology when the piece is bound to a game.
     """
-    def get_possible_moves(self):
-        retval = []
-        for mo in self.move_orders:
-            retval.extend(self.do_move_order(self.position, mo))
-        return retval
+    __slots__ = ('targets',)
 
-    def do_move_order(self, current_node, move_order):
-        mo = list(move_order)
-        d = mo.pop(0)
-        if len(mo)==0:
-            return filter(lambda x: x.piece is None or x.piece.owner is not self.owner, current_node.get_next_nodes(self.owner, d))
-        retval = []
-        for n in current_node.get_next_nodes(self.owner, d):
-            retval.extend(self.do_move_order(n, mo))
-        return retval
+    def bind(self, game):
+        Piece.bind(self, game)
+        self.targets = game.topology.jump_targets(self.owner.id, self.move_orders)
+
+    def get_move_indices(self):
+        board = self.board
+        return [j for j in self.targets[self.square] if board[j] is None or board[j].owner is not self.owner]
+
+    def iter_moves(self):
+        board = self.board
+        for j in self.targets[self.square]:
+            if board[j] is None or board[j].owner is not self.owner:
+                yield j
+
+    def can_move_to(self, target):
+        board = self.board
+        return ((board[target] is None or board[target].owner is not self.owner)
+                and target in self.targets[self.square])
 
 class Knight(KnightLike):
-    def __init__(self, playerID, position):
-        Piece.__init__(self, playerID, position)
-        self.move_orders = [['n','n','w'],
-                            ['n','n','e'],
-                            ['s','s','w'],
-                            ['s','s','e'],
-                            ['e','e','n'],
-                            ['e','e','s'],
-                            ['w','w','n'],
-                            ['w','w','s']]
+    __slots__ = ()
+    kind = 3
+    move_orders = tuple(direction_indices(mo) for mo in [['n','n','w'],
+                                                         ['n','n','e'],
+                                                         ['s','s','w'],
+                                                         ['s','s','e'],
+                                                         ['e','e','n'],
+                                                         ['e','e','s'],
+                                                         ['w','w','n'],
+                                                         ['w','w','s']])
 
     def __str__(self):
         return "Knight(" + str(self.owner)+ ") at " + str(self.position)
 
+piece_types = (King, Queen, Bishop, Knight, Rook, Pawn)
+
 class Player:
     def __init__(self, playerID):
         self.playerID = playerID
@@ -197,7 +485,13 @@ class Player:
         return "Player " + str(self.playerID)
 
 
-class Move:
+class Move(object):
+    """
+    A move of piece from startnode to endnode. Games keep the moves they
+    made packed into ints, see Game.pack_move.
+    """
+    __slots__ = ('piece', 'start', 'end')
+
     def __init__(self, piece, startnode, endnode):
         self.piece = piece
         self.start = startnode
@@ -257,33 +551,222 @@ class ConsolePlayer(Player):
     def __str__(self):
         return "ConsolePlayer " + str(self.playerID)
 
+class GameListener:
+    """
+    Base class for objects that follow a game, see Game.subscribe.
+    Every event is a method that does nothing here, subclasses override the
+    events they are interested in. move_made and the events after it are
+    sent once the move is on the board.
+    """
+    def order_decided(self, game, decider, new_order):
+        pass
+
+    def turn(self, game, mover):
+        pass
+
+    def move_made(self, game, move):
+        pass
+
+    def capture(self, game, move, captured):
+        pass
+
+    def game_over(self, game, winner):
+        pass
+
+class ConsolePrinter(GameListener):
+    """
+    Prints the course of a game to the console.
+    """
+    def order_decided(self, game, decider, new_order):
+        print "The new order of moves must be decided on by player ", decider.playerID
+        print "The current order of moves is ", [str(p) for p in game.move_list[:-len(new_order)]]
+        print "The new order of moves is " , [str(m) for m in new_order]
+        print "The next moves will be ", [str(p) for p in game.move_list]
+
+    def turn(self, game, mover):
+        print "It is the turn of", mover
+
+    def move_made(self, game, move):
+        # the piece stands on move.end by now, print it where it moved from
+        p = move.piece
+        print ("Move %s(%s) at %s from %s to %s"
+               % (p.__class__.__name__, p.owner, move.start, move.start, move.end))
+
+class PieceMoveGenerator:
+    """
+    Generates the moves of a game with the get_move_indices method of every
+    piece. Other move generators (see attacks.py) derive from this class
+    and are selected per game:
+
+    game = Game(generator, move_generator=attacks.AttackMapMoveGenerator)
+    """
+    def __init__(self, game):
+        self.game = game
+
+    def piece_moves(self, p):
+        """
+        The node indices piece p can move to.
+        """
+        return p.get_move_indices()
+
+    def moves(self, playerID):
+        """
+        All moves of playerID as (piece, end index) pairs.
+        """
+        return [(p, e) for p in self.game.live_pieces[int(playerID)] for e in self.piece_moves(p)]
+
+    def iter_moves(self, playerID, captures_only=False, target=None):
+        """
+        The moves of playerID as (piece, end index) pairs, generated only as
+        far as they are consumed. With captures_only, only the moves that
+        capture a piece; with a target node index, only the moves to it.
+        The position must not change while the moves are consumed.
+        """
+        for p in self.game.live_pieces[int(playerID)]:
+            if target is not None:
+                if p.can_move_to(target):
+                    yield (p, target)
+            elif captures_only:
+                for e in p.iter_captures():
+                    yield (p, e)
+            else:
+                for e in p.iter_moves():
+                    yield (p, e)
+
+    def filter_moves(self, playerID, captures_only=False, target=None):
+        """
+        iter_moves for generators that keep the moves of every piece, by
+        filtering the lists of piece_moves.
+        """
+        board = self.game.board
+        for p in self.game.live_pieces[int(playerID)]:
+            for e in self.piece_moves(p):
+                if target is not None and e!=target:
+                    continue
+                if captures_only and board[e] is None:
+                    continue
+                yield (p, e)
+
+    def has_move(self, playerID):
+        for m in self.iter_moves(playerID):
+            return True
+        return False
+
+    def king_attacked(self, playerID):
+        """
+        True if a piece of another player can capture the king of playerID.
+        """
+        game = self.game
+        kings = game.get_pieces(playerID, King.kind)
+        if not kings:
+            return False
+        square = kings[0].square
+        for k in range(game.n_players):
+            if k!=int(playerID):
+                for m in self.iter_moves(k, target=square):
+                    return True
+        return False
+
+# move generators by name, for command line options: (module, class)
+move_generator_names = {'pieces': (None, 'PieceMoveGenerator'),
+                        'attacks': ('attacks', 'AttackMapMoveGenerator')}
+
+def get_move_generator(name):
+    module, cls = move_generator_names[name]
+    if module is None:
+        return globals()[cls]
+    return getattr(__import__(module), cls)
+
 class Game:
-    def __init__(self, generator):
-        self.nodes, self.pieces, self.players = generator.generate()
+    """
+    The state of a game. With history=False the moves made by make_move are
+    not kept, which saves memory when many games are held; such games can
+    not be reset and their moves can not be taken back. Moves made by
+    do_move can always be taken back.
+    """
+    def __init__(self, generator, listeners=(), move_generator=PieceMoveGenerator, history=True):
+        self.listeners = list(listeners)
+        self.history = history
+        self.nodes, self.pieces, self.players, self.topology = generator.generate()
+        self.node_list = [None]*self.topology.n_nodes
+        for n in self.nodes.itervalues():
+            self.node_list[n.index] = n
+        self.board = [n.piece for n in self.node_list]
+        self.zobrist = self.topology.zobrist_keys()
         self.move_list = list(self.players)
         self.move_decision_list = list(self.players)
         self.n_players = len(self.players)
+        self.index_pieces()
         self.game_over = False
         self.winner = None
+        # entries (packed move, captured piece, game_over, winner, hash)
+        self.undo_stack = []
+        self.move_shift = self.topology.n_nodes.bit_length()
+        self.move_generator = move_generator(self)
+
+    def index_pieces(self):
+        """
+        Bind self.pieces to the game and build the live piece lists, the
+        bitboards and the hash from them.
+        """
+        self.live_pieces = [[] for k in range(self.n_players)]
+        self.live_by_kind = [[[] for t in piece_types] for k in range(self.n_players)]
+        # one bit per node, see attacks.py
+        self.occupancy = [0]*self.n_players
+        bits = self.topology.bits
+        for p in self.pieces:
+            p.bind(self)
+            if p.alive:
+                p.slot = len(self.live_pieces[p.owner.id])
+                self.live_pieces[p.owner.id].append(p)
+                p.kind_slot = len(self.live_by_kind[p.owner.id][p.kind])
+                self.live_by_kind[p.owner.id][p.kind].append(p)
+                self.occupancy[p.owner.id] |= bits[p.square]
+        self.occupied = 0
+        for o in self.occupancy:
+            self.occupied |= o
+        self.hash = self.compute_hash()
 
     def play_next_move(self):
+        move_decider = self.next_decider()
+        if move_decider is not None:
+            self.apply_order(move_decider, move_decider.get_move_list(self))
+        mover = self.next_mover()
+        move = mover.get_move(self)
+        self.make_move(move)
+
+    def next_decider(self):
+        """
+        The player who has to decide the order of the next moves before the
+        next move, or None if it is decided already.
+        """
         if (len(self.move_decision_list)<=self.n_players):
             self.move_decision_list.extend(self.players)
         if (len(self.move_list)<=self.n_players):
-            move_decider = self.move_decision_list.pop(0)
-            print "The new order of moves must be decided on by player ", move_decider.playerID
-            print "The current order of moves is ", [str(p) for p in self.move_list]
-            new_moves = [self.players[k] for k in move_decider.get_move_list(self)]
-            print "The new order of moves is " , [str(m) for m in new_moves]
-            assert(len(new_moves)==self.n_players)
-            self.move_list.extend(new_moves)
-            print "The next moves will be ", [str(p) for p in self.move_list]
+            return self.move_decision_list[0]
+        return None
+
+    def apply_order(self, move_decider, order):
+        """
+        Append order, the list of player ints decided by move_decider (the
+        player returned by next_decider), to move_list.
+        """
+        assert(move_decider is self.move_decision_list[0])
+        self.move_decision_list.pop(0)
+        new_moves = [self.players[k] for k in order]
+        assert(len(new_moves)==self.n_players)
+        self.move_list.extend(new_moves)
+        if self.listeners:
+            self.notify('order_decided', move_decider, new_moves)
+
+    def next_mover(self):
+        """
+        Take the player to move next from move_list and announce its turn.
+        """
         mover = self.move_list.pop(0)
-        print "It is the turn of", mover
-        move = mover.get_move(self)
-        self.game_over = self.make_move(move)
-        if self.game_over:
-            self.winner = mover
+        if self.listeners:
+            self.notify('turn', mover)
+        return mover
 
     def play(self, max_moves=None):
         move_counter = 0
@@ -294,26 +777,306 @@ class Game:
                 break
         return self.winner
 
+    def subscribe(self, listener):
+        """
+        Let listener (a GameListener) follow the moves made in this game.
+        Moves made by do_move, e.g. during a search, are not reported.
+        """
+        self.listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        self.listeners.remove(listener)
+
+    def notify(self, event, *args):
+        for l in self.listeners:
+            getattr(l, event)(self, *args)
+
     def make_move(self, move):
         #p = self.pieces[move.pieceID]
-        print move
+        king_captured = self.do_move(move)
+        if self.listeners:
+            self.notify('move_made', move)
+            captured = self.undo_stack[-1][1]
+            if captured is not None:
+                self.notify('capture', move, captured)
+            if king_captured:
+                self.notify('game_over', self.winner)
+        if not self.history:
+            self.undo_stack.pop()
+        return king_captured
+
+    def do_move(self, move):
+        """
+        Apply a move without printing it.
+        Everything needed to take it back is pushed onto self.undo_stack,
+        see unmake_move. Returns True if the move captured a king, which
+        ends the game with the owner of the moving piece as winner.
+        """
         p = move.piece
         assert(p.position==move.start)
         assert(p==move.start.piece)
+        captured = move.end.piece
+        self.undo_stack.append(((move.start.index << self.move_shift) | move.end.index,
+                                captured, self.game_over, self.winner, self.hash))
+        self.hash ^= p.keys[move.start.index] ^ p.keys[move.end.index]
         move.start.piece = None
+        self.board[move.start.index] = None
         p.position = move.end
-        p.history.append(move.end)
-        if isinstance(move.end.piece, King):
-            return True
-        if move.end.piece is not None:
-            move.end.piece.alive = False
+        p.square = move.end.index
+        p.moved += 1
         move.end.piece = p
-        return False
+        self.board[p.square] = p
+        bits = self.topology.bits
+        self.occupancy[p.owner.id] ^= bits[move.start.index] | bits[p.square]
+        king_captured = False
+        if captured is None:
+            self.occupied ^= bits[move.start.index] | bits[p.square]
+        else:
+            self.occupied ^= bits[move.start.index]
+            self.occupancy[captured.owner.id] ^= bits[p.square]
+            self.hash ^= captured.keys[move.end.index]
+            captured.alive = False
+            self.remove_live_piece(captured)
+            if isinstance(captured, King):
+                self.game_over = True
+                self.winner = self.players[p.owner.id]
+                king_captured = True
+        return king_captured
+
+    def unmake_move(self):
+        """
+        Take back the last move applied by make_move or do_move, restoring
+        the captured piece, the move count of the moved piece and the game
+        over and winner flags and the hash. Returns the move.
+        """
+        code, captured, self.game_over, self.winner, self.hash = self.undo_stack.pop()
+        start, end = self.unpack_move(code)
+        p = self.board[end]
+        move = Move(p, self.node_list[start], self.node_list[end])
+        p.moved -= 1
+        p.position = move.start
+        p.square = move.start.index
+        move.start.piece = p
+        self.board[p.square] = p
+        move.end.piece = captured
+        self.board[move.end.index] = captured
+        bits = self.topology.bits
+        self.occupancy[p.owner.id] ^= bits[p.square] | bits[move.end.index]
+        if captured is None:
+            self.occupied ^= bits[p.square] | bits[move.end.index]
+        else:
+            self.occupied ^= bits[p.square]
+            self.occupancy[captured.owner.id] ^= bits[move.end.index]
+            captured.alive = True
+            self.restore_live_piece(captured)
+        return move
+
+    def reset(self):
+        """
+        Return to the start position in place, by taking back all moves.
+        The order of moves starts over as well.
+        """
+        if not self.history:
+            raise ValueError("a game without history can not be reset")
+        while self.undo_stack:
+            self.unmake_move()
+        self.move_list = list(self.players)
+        self.move_decision_list = list(self.players)
 
-    def get_pieces(self, playerID=None):
+    def snapshot(self):
+        """
+        The position as a tuple of ints and tuples of ints, to store it or
+        send it to another process:
+
+        (n_players, n_rows, n_cols, kinds, owners, squares, moved, alive,
+         move_list, move_decision_list, game_over, winner)
+
+        kinds (see piece_types), owners, squares, moved and alive have one
+        entry per piece of self.pieces, captured pieces included, and
+        move_list and move_decision_list hold player ids. winner is None
+        until the game is over. The moves made so far are not included.
+        """
+        t = self.topology
+        pieces = self.pieces
+        return (self.n_players, t.n_rows, t.n_cols,
+                tuple(p.kind for p in pieces), tuple(p.owner.id for p in pieces),
+                tuple(p.square for p in pieces), tuple(p.moved for p in pieces),
+                tuple(p.alive for p in pieces),
+                tuple(int(p.playerID) for p in self.move_list),
+                tuple(int(p.playerID) for p in self.move_decision_list),
+                self.game_over, None if self.winner is None else int(self.winner.playerID))
+
+    def restore(self, state):
+        """
+        Set up the position of a snapshot of a game on a board of the same
+        size, replacing the pieces of this game. The moves made before are
+        forgotten: the restored position is the start of the history, see
+        reset. Raises ValueError for a snapshot of another board.
+        """
+        (n_players, n_rows, n_cols, kinds, owners, squares, moved, alive,
+         move_list, move_decision_list, game_over, winner) = state
+        t = self.topology
+        if (n_players, n_rows, n_cols)!=(self.n_players, t.n_rows, t.n_cols):
+            raise ValueError("snapshot of a %d player %dx%d board" % (n_players, n_rows, n_cols))
+        for p in self.pieces:
+            if p.alive:
+                p.position.piece = None
+                self.board[p.square] = None
+        playerIDs = [p.playerID for p in self.players]
+        node_list = self.node_list
+        self.pieces = []
+        for k in range(len(kinds)):
+            node = node_list[squares[k]]
+            p = piece_types[kinds[k]](playerIDs[owners[k]], node)
+            p.moved = moved[k]
+            p.alive = alive[k]
+            if p.alive:
+                node.piece = p
+                self.board[node.index] = p
+            self.pieces.append(p)
+        self.index_pieces()
+        self.move_list = [self.players[k] for k in move_list]
+        self.move_decision_list = [self.players[k] for k in move_decision_list]
+        self.game_over = game_over
+        self.winner = None if winner is None else self.players[winner]
+        self.undo_stack = []
+        self.move_generator = self.move_generator.__class__(self)
+
+    def remove_live_piece(self, p):
+        """
+        Remove a captured piece from the live piece lists by moving the last
+        piece of each list into its slot. restore_live_piece undoes this
+        exactly, if calls are undone in reverse order.
+        """
+        for (pieces, attr) in ((self.live_pieces[p.owner.id], 'slot'),
+                               (self.live_by_kind[p.owner.id][p.kind], 'kind_slot')):
+            last = pieces.pop()
+            if last is not p:
+                i = getattr(p, attr)
+                pieces[i] = last
+                setattr(last, attr, i)
+
+    def restore_live_piece(self, p):
+        for (pieces, attr) in ((self.live_pieces[p.owner.id], 'slot'),
+                               (self.live_by_kind[p.owner.id][p.kind], 'kind_slot')):
+            i = getattr(p, attr)
+            if i<len(pieces):
+                moved = pieces[i]
+                setattr(moved, attr, len(pieces))
+                pieces.append(moved)
+                pieces[i] = p
+            else:
+                pieces.append(p)
+
+    @contextmanager
+    def try_move(self, move):
+        """
+        Look at the position after move and take it back afterwards:
+
+        with game.try_move(move):
+            evaluate(game)
+        """
+        self.do_move(move)
+        try:
+            yield self
+        finally:
+            self.unmake_move()
+
+    def pack_move(self, move):
+        return (move.start.index << self.move_shift) | move.end.index
+
+    def unpack_move(self, code):
+        """
+        The (start, end) node indices of a packed move.
+        """
+        return code >> self.move_shift, code & ((1 << self.move_shift)-1)
+
+    def move_history(self):
+        """
+        The moves made so far as (start, end) node indices.
+        """
+        return [self.unpack_move(entry[0]) for entry in self.undo_stack]
+
+    def piece_history(self, p):
+        """
+        The nodes piece p visited, starting with its initial node. Moves
+        made by make_move in a game without history are missing; if the
+        capture of a dead piece is missing, only its last node is known.
+        """
+        entries = self.undo_stack
+        k = len(entries)
+        if not p.alive:
+            while k>0 and entries[k-1][1] is not p:
+                k -= 1
+            if k==0:
+                return [self.node_list[p.square]]
+            k -= 1
+        square = p.square
+        visited = [square]
+        while k>0:
+            k -= 1
+            start, end = self.unpack_move(entries[k][0])
+            if end==square:
+                square = start
+                visited.append(square)
+        return [self.node_list[i] for i in reversed(visited)]
+
+    def compute_hash(self):
+        """
+        The Zobrist hash of the board, computed from scratch.
+        do_move and unmake_move keep self.hash equal to this.
+        """
+        h = 0
+        for p in self.pieces:
+            if p.alive:
+                h ^= p.keys[p.square]
+        return h
+
+    def position_key(self, playerID):
+        """
+        Key of the current position with playerID to move, for
+        transposition tables.
+        """
+        return self.hash ^ self.zobrist.movers[int(playerID)]
+
+    def generate_moves(self, playerID):
+        """
+        All moves of playerID as (piece, end index) pairs, from the move
+        generator of this game.
+        """
+        return self.move_generator.moves(playerID)
+
+    def king_attacked(self, playerID):
+        """
+        True if another player can capture the king of playerID with the
+        next move, see PieceMoveGenerator.king_attacked.
+        """
+        return self.move_generator.king_attacked(playerID)
+
+    def iter_moves(self, playerID, captures_only=False, target=None):
+        """
+        The moves of playerID one at a time, see PieceMoveGenerator.iter_moves.
+        """
+        return self.move_generator.iter_moves(playerID, captures_only, target)
+
+    def has_move(self, playerID):
+        """
+        True if playerID has any move; stops at the first one found.
+        """
+        return self.move_generator.has_move(playerID)
+
+    def get_pieces(self, playerID=None, kind=None):
+        """
+        The pieces of playerID that are still alive, optionally only those of
+        one kind (see piece_types).
+        For a single player this is the game's own list, which changes with
+        every capture and must not be modified by the caller.
+        """
         if playerID is None:
-            return filter(lambda x: x.alive, self.pieces)
-        return filter(lambda x: x.owner==playerID and x.alive, self.pieces)
+            return [p for pieces in self.live_pieces for p in pieces]
+        if kind is None:
+            return self.live_pieces[int(playerID)]
+        return self.live_by_kind[int(playerID)][kind]
 
     def __str__(self):
         s = ""
@@ -328,8 +1091,49 @@ def joindicts(dictlist):
             retval[k] = v
     return retval
 
+board_templates = {}
+
+class BoardTemplate:
+    """
+    The part of a board that is the same in every game: the compiled
+    topology, the neighbors of every node as indices and the initial piece
+    layout as (piece type, owner id, node index) triples.
+    New games copy the nodes and pieces from a template instead of wiring
+    and compiling the node graph again.
+    """
+    def __init__(self, nodes, pieces, topology):
+        self.topology = topology
+        node_list = sorted(nodes.itervalues(), key=lambda n: n.index)
+        self.neighbors = [[(d, tuple(m.index for m in n.neighbors[d])) for d in all_directions if n.neighbors[d]]
+                          for n in node_list]
+        self.layout = [(p.__class__, p.owner.id, p.square) for p in pieces]
+
+    def build_nodes(self, playerIDs):
+        node_list = []
+        for (i, nodeID) in enumerate(self.topology.node_ids):
+            node_list.append(Node(playerIDs[nodeID[0]], nodeID, i, self.neighbors[i], node_list))
+        nodes = dict(((n.owner, n.nodeID[1], n.nodeID[2]), n) for n in node_list)
+        return nodes, node_list
+
+    def place_pieces(self, node_list, playerIDs, layout=None):
+        if layout is None:
+            layout = self.layout
+        pieces = []
+        for (piece_type, owner, square) in layout:
+            node = node_list[square]
+            p = piece_type(playerIDs[owner], node)
+            node.piece = p
+            pieces.append(p)
+        return pieces
+
 class NChessGenerator:
-    def __init__(self, number_of_players=3, number_of_rows=4, number_of_columns=8, player_type_list=None):
+    """
+    Generates the board, pieces and players of a game.
+    The board of every size is only built once and then kept as a
+    BoardTemplate. layout optionally replaces the initial position, see
+    BoardTemplate.
+    """
+    def __init__(self, number_of_players=3, number_of_rows=4, number_of_columns=8, player_type_list=None, layout=None):
         self.n_rows = number_of_rows
         self.n_cols = number_of_columns
         self.n_players = number_of_players
@@ -337,6 +1141,7 @@ class NChessGenerator:
             self.player_type_list = [ ConsolePlayer]*self.n_players
         else:
             self.player_type_list = player_type_list
+        self.layout = layout
 
     def generate_halfboard(self, playerID, PlayerType=ConsolePlayer):
         rows = range(self.n_rows)
@@ -344,7 +1149,8 @@ class NChessGenerator:
         nodes = {}
         for r in rows:
             for c in cols:
-                nodes[(playerID, c, r)] = Node(playerID, (playerID.id, c, r))
+                index = (playerID.id*self.n_rows + r)*self.n_cols + c
+                nodes[(playerID, c, r)] = Node(playerID, (playerID.id, c, r), index)
         for c in cols:
             for r in rows:
                 if c<(self.n_cols-1):
@@ -420,27 +1226,56 @@ class NChessGenerator:
                 board2[(playerID2, self.n_cols/2-c-1, self.n_rows-1)].neighbors['nw'].append(board1[(playerID1, c+self.n_cols/2+1, self.n_rows-1)])
 
     def generate_playerIDs(self):
-        colorlist = ['red', 'green', 'yellow', 'blue']
+        colorlist = ['red', 'green', 'yellow', 'blue', 'orange', 'purple']
+        colorlist += [None]*(self.n_players-len(colorlist))
         plt_colorlist = colorlist#['k','b','g','y']
         return [PlayerID(i,color=c,plt_color=pc) for i, c, pc in zip(range(self.n_players), colorlist, plt_colorlist)]
 
-    def generate(self):
+    def build_board(self):
         nodeslist = []
         pieces = []
-        players = []
-        for p,ptype in zip(self.generate_playerIDs(), self.player_type_list):
-            n, pi, pl = self.generate_halfboard(playerID=p, PlayerType=ptype)
+        playerIDs = self.generate_playerIDs()
+        for p in playerIDs:
+            n, pi, pl = self.generate_halfboard(playerID=p)
             nodeslist.append(n)
             pieces.extend(pi)
-            players.append(pl)
         for p in range(self.n_players):
-            self.glue_halfboards(nodeslist[p-1], players[p-1].playerID, nodeslist[p], players[p].playerID)
+            self.glue_halfboards(nodeslist[p-1], playerIDs[p-1], nodeslist[p], playerIDs[p])
         nodes = joindicts(nodeslist)
-        return nodes, pieces, players
+        return nodes, pieces
+
+    def compile_topology(self, nodes):
+        return Topology(nodes.itervalues())
+
+    def get_template(self):
+        key = (self.n_players, self.n_rows, self.n_cols)
+        if key not in board_templates:
+            nodes, pieces = self.build_board()
+            board_templates[key] = BoardTemplate(nodes, pieces, self.compile_topology(nodes))
+        return board_templates[key]
+
+    def generate(self):
+        template = self.get_template()
+        playerIDs = self.generate_playerIDs()
+        nodes, node_list = template.build_nodes(playerIDs)
+        pieces = template.place_pieces(node_list, playerIDs, self.layout)
+        players = [ptype(p) for p,ptype in zip(playerIDs, self.player_type_list)]
+        return nodes, pieces, players, template.topology
+
+def game_from_snapshot(state, player_type_list=None, listeners=(), move_generator=PieceMoveGenerator, history=True):
+    """
+    A new game in the position of a snapshot, see Game.snapshot.
+    """
+    n_players, n_rows, n_cols = state[:3]
+    if player_type_list is None:
+        player_type_list = [Player]*n_players
+    game = Game(NChessGenerator(n_players, n_rows, n_cols, player_type_list), listeners, move_generator, history)
+    game.restore(state)
+    return game
 
 if __name__=='__main__':
     generator = NChessGenerator()
-    game = Game(generator)
+    game = Game(generator, [ConsolePrinter()])
     f = open('output.txt', 'w')
     f.write(str(game))
     f.close()
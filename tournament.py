@@ -0,0 +1,299 @@
+"""
+Tournaments between player types.
+
+Entrants are player specs of selfplay.py ('random', 'paranoid:0.05',
+'maxn:0.05', 'mcts:0.5', ...). Games are played in blocks: a block seats
+one lineup of entrants in every rotation of the seats (or with
+permute=True, in every permutation), so that every entrant of the lineup
+plays from every seat. Since the first moves and the players that decide
+the order of moves (Game.move_decision_list) follow the seats, this also
+rotates the deciders. All games of a block are played with the same seed.
+The lineups are the combinations of n_players entrants, or with fewer
+entrants than seats, the combinations with repetition that hold at least
+two entrants; blocks cycle through them.
+
+Blocks are played in a pool of worker processes (see selfplay.play_game)
+and their results are taken in order, so the ratings only depend on the
+seed. The ratings are multi-player Elo ratings: a game counts as one
+result per pair of entrants, a win for the winner over everybody else and
+a draw between the others.
+
+With sprt=(a, b) the tournament stops as soon as a sequential probability
+ratio test on the score of b against a decides between the hypotheses
+that b is elo0 and elo1 Elo stronger than a, at the error rates alpha and
+beta. Every game where both play counts as one observation of the mean
+pairwise score of b against a; the test is checked after every block.
+
+python tournament.py --entrants random paranoid:0.05 --players 3 --games 300
+python tournament.py --entrants paranoid:0.05 maxn:0.05 --players 3 --sprt --elo1 50
+"""
+
+import argparse
+import collections
+import itertools
+import math
+import multiprocessing
+import time
+
+import threechess as thc
+from selfplay import play_game
+
+def seatings(n_players, permute=False):
+    """
+    The seatings of a block: for every game, the index in the lineup of
+    the entrant on every seat.
+    """
+    if permute:
+        return list(itertools.permutations(range(n_players)))
+    return [tuple((k+r) % n_players for k in range(n_players)) for r in range(n_players)]
+
+def lineups(entrants, n_players):
+    if len(entrants)>=n_players:
+        return list(itertools.combinations(entrants, n_players))
+    return [l for l in itertools.combinations_with_replacement(entrants, n_players) if len(set(l))>1]
+
+def elo_score(elo):
+    """
+    The expected score of a player elo Elo stronger than its opponent.
+    """
+    return 1./(1. + 10**(-elo/400.))
+
+def pair_score(specs, winner, a, b):
+    """
+    The mean score of entrant b against entrant a in a game with specs per
+    seat and winner seat (or None): 1 for a win of b, 0 for a win of a,
+    1/2 otherwise. None if they did not both play.
+    """
+    seats_a = [k for (k, s) in enumerate(specs) if s==a]
+    seats_b = [k for (k, s) in enumerate(specs) if s==b]
+    if not seats_a or not seats_b:
+        return None
+    total = 0.
+    for i in seats_b:
+        for j in seats_a:
+            if winner==i:
+                total += 1.
+            elif winner!=j:
+                total += 0.5
+    return total/(len(seats_a)*len(seats_b))
+
+class Ratings:
+    """
+    Multi-player Elo ratings of the entrants. Every game updates the
+    rating of every entrant by k/(n_players-1) times the sum over its
+    opponents of its score minus its expected score.
+    """
+    def __init__(self, entrants, k=16., initial=1500.):
+        self.entrants = list(entrants)
+        self.k = k
+        self.rating = dict((e, initial) for e in entrants)
+        self.games = collections.Counter()
+        self.wins = collections.Counter()
+        # pair (a, b): [games, sum of scores of b against a]
+        self.pairs = collections.defaultdict(lambda: [0, 0.])
+        self.unfinished = 0
+
+    def add(self, specs, winner):
+        """
+        Add a game with specs per seat and the winning seat, or None.
+        """
+        n = len(specs)
+        if winner is None:
+            self.unfinished += 1
+        else:
+            self.wins[specs[winner]] += 1
+        for s in set(specs):
+            self.games[s] += 1
+        delta = [0.]*n
+        for i in range(n):
+            for j in range(n):
+                if i==j or specs[i]==specs[j]:
+                    continue
+                score = 1. if winner==i else 0. if winner==j else 0.5
+                delta[i] += score - elo_score(self.rating[specs[i]]-self.rating[specs[j]])
+        for i in range(n):
+            self.rating[specs[i]] += self.k*delta[i]/(n-1)
+        for a in set(specs):
+            for b in set(specs):
+                if a!=b:
+                    pair = self.pairs[(a, b)]
+                    pair[0] += 1
+                    pair[1] += pair_score(specs, winner, a, b)
+
+    def __str__(self):
+        width = max(len(e) for e in self.entrants)
+        lines = []
+        for e in sorted(self.entrants, key=lambda e: -self.rating[e]):
+            lines.append("%-*s  Elo %6.0f  %5d games  %5d wins" % (width, e, self.rating[e], self.games[e], self.wins[e]))
+        for (a, b) in sorted(self.pairs):
+            games, total = self.pairs[(a, b)]
+            if a<b:
+                lines.append("%s against %s: score %.3f in %d games" % (b, a, total/games, games))
+        return "\n".join(lines)
+
+class SPRT:
+    """
+    A sequential probability ratio test on scores in [0, 1] between the
+    hypotheses that the score is elo_score(elo0) and elo_score(elo1), with
+    the log likelihood ratio of the normal approximation of the scores. The
+    approximation needs some scores, so nothing is decided before
+    min_games of them. The variance of the scores is taken to be at least
+    that of scores spread between the two hypotheses, ((s1-s0)/2)**2, so
+    that a stream of equal scores (all wins, all draws) is decided as well.
+    """
+    def __init__(self, elo0=0., elo1=50., alpha=0.05, beta=0.05, min_games=30):
+        self.elo0 = elo0
+        self.elo1 = elo1
+        self.min_games = min_games
+        self.s0 = elo_score(elo0)
+        self.s1 = elo_score(elo1)
+        self.min_variance = ((self.s1-self.s0)/2.)**2
+        self.lower = math.log(beta/(1.-alpha))
+        self.upper = math.log((1.-beta)/alpha)
+        self.n = 0
+        self.total = 0.
+        self.squares = 0.
+
+    def add(self, score):
+        self.n += 1
+        self.total += score
+        self.squares += score*score
+
+    def llr(self):
+        if self.n<2:
+            return 0.
+        mean = self.total/self.n
+        variance = max(self.squares/self.n - mean*mean, self.min_variance)
+        return self.n*(self.s1-self.s0)*(2*mean - self.s0 - self.s1)/(2*variance)
+
+    def decision(self):
+        """
+        'H1' (the elo1 hypothesis is accepted), 'H0' or None while the test
+        continues.
+        """
+        if self.n<self.min_games:
+            return None
+        llr = self.llr()
+        if llr>=self.upper:
+            return 'H1'
+        if llr<=self.lower:
+            return 'H0'
+        return None
+
+    def __str__(self):
+        decision = self.decision()
+        mean = self.total/self.n if self.n else 0.5
+        return ("SPRT elo0=%.0f elo1=%.0f: %d games, score %.3f, LLR %.2f in [%.2f, %.2f], %s"
+                % (self.elo0, self.elo1, self.n, mean, self.llr(), self.lower, self.upper,
+                   {'H1': "H1 accepted", 'H0': "H0 accepted", None: "undecided"}[decision]))
+
+def make_blocks(entrants, n_players, seed, permute, max_moves, n_rows, n_cols, engine):
+    """
+    The task lists of selfplay.play_game of the blocks, without end.
+    """
+    orders = seatings(n_players, permute)
+    all_lineups = lineups(entrants, n_players)
+    index = 0
+    for b in itertools.count():
+        lineup = all_lineups[b % len(all_lineups)]
+        tasks = []
+        for order in orders:
+            specs = tuple(lineup[k] for k in order)
+            tasks.append((index, seed+b, n_players, n_rows, n_cols, specs, max_moves, False, engine, None))
+            index += 1
+        yield tasks
+
+def run_tournament(entrants, n_players=3, max_games=1000, sprt=None, sprt_test=None, permute=False,
+                   max_moves=200, n_rows=4, n_cols=8, engine='pieces', seed=0, processes=None, callback=None):
+    """
+    Play blocks of games until max_games games are played (the last block
+    is played to its end) or the SPRT on
+    the pair of entrants sprt (if given) is decided. sprt_test is the
+    SPRT to use (default SPRT()). callback, if given, is called with every
+    game result. Returns (ratings, the SPRT or None, games played).
+    """
+    if len(set(entrants))!=len(entrants) or len(entrants)<2:
+        raise ValueError("a tournament needs at least two different entrants")
+    if sprt is None:
+        sprt_test = None
+    else:
+        if sprt_test is None:
+            sprt_test = SPRT()
+        if not all(e in entrants for e in sprt):
+            raise ValueError("the SPRT pair must be entrants")
+    ratings = Ratings(entrants)
+    blocks = make_blocks(entrants, n_players, seed, permute, max_moves, n_rows, n_cols, engine)
+    pool = None
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes>1:
+        pool = multiprocessing.Pool(processes)
+    # blocks submitted ahead, to keep the pool busy
+    ahead = 1 if pool is None else 2*processes
+    pending = collections.deque()
+    played = 0
+    submitted = 0
+    try:
+        while played<max_games:
+            while submitted<max_games and len(pending)<ahead:
+                tasks = next(blocks)
+                submitted += len(tasks)
+                if pool is None:
+                    pending.append(map(play_game, tasks))
+                else:
+                    pending.append(pool.map_async(play_game, tasks, chunksize=1))
+            results = pending.popleft()
+            if pool is not None:
+                results = results.get()
+            for r in results:
+                ratings.add(r['players'], r['winner'])
+                if sprt is not None:
+                    score = pair_score(r['players'], r['winner'], sprt[0], sprt[1])
+                    if score is not None:
+                        sprt_test.add(score)
+                if callback is not None:
+                    callback(r)
+            played += len(results)
+            if sprt is not None and sprt_test.decision() is not None:
+                break
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return ratings, sprt_test, played
+
+def main():
+    parser = argparse.ArgumentParser(description="Rate player types against each other.")
+    parser.add_argument('--entrants', nargs='+', required=True, help="player specs, see selfplay.py")
+    parser.add_argument('--players', type=int, default=3, help="players per game")
+    parser.add_argument('--games', type=int, default=1000, help="maximal number of games")
+    parser.add_argument('--permute', action='store_true', help="seat every lineup in all permutations")
+    parser.add_argument('--sprt', nargs='*', default=None,
+                        help="stop when an SPRT of the second entrant against the first is decided "
+                             "(default: the first two entrants)")
+    parser.add_argument('--elo0', type=float, default=0.)
+    parser.add_argument('--elo1', type=float, default=50.)
+    parser.add_argument('--alpha', type=float, default=0.05)
+    parser.add_argument('--beta', type=float, default=0.05)
+    parser.add_argument('--max-moves', type=int, default=200)
+    parser.add_argument('--engine', default='pieces', choices=sorted(thc.move_generator_names), help="move generator")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--processes', type=int, default=None, help="default: one per core")
+    args = parser.parse_args()
+    sprt = None
+    if args.sprt is not None:
+        sprt = tuple(args.sprt) or tuple(args.entrants[:2])
+        if len(sprt)!=2:
+            parser.error("--sprt takes two entrants")
+    start = time.time()
+    ratings, sprt_test, played = run_tournament(
+        args.entrants, args.players, args.games, sprt, SPRT(args.elo0, args.elo1, args.alpha, args.beta),
+        args.permute, args.max_moves, engine=args.engine, seed=args.seed, processes=args.processes)
+    elapsed = time.time() - start
+    print ratings
+    if sprt_test is not None:
+        print sprt_test
+    print "%d games, %d without winner, %.1fs" % (played, ratings.unfinished, elapsed)
+
+if __name__=='__main__':
+    main()
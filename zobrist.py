@@ -0,0 +1,125 @@
+"""
+Zobrist hashing of positions and a transposition table to share search
+results between players.
+"""
+
+import random
+
+EXACT, LOWER, UPPER = range(3)
+
+class ZobristKeys:
+    """
+    One random 64 bit key for every (node, piece kind, owner) and one for
+    every player to move.
+    The hash of a position is the xor of the keys of all pieces on the board,
+    so moving a piece changes it by two or three xors.
+    self.pieces[kind][owner][node] is the key of a piece on a node.
+    self.perspectives has one more key per player, for search results that
+    are only valid from the point of view of that player, and
+    self.upcoming[k][owner] one for owner moving k+1 plies after the player
+    to move, for search results that depend on the order of the next moves.
+    """
+    def __init__(self, n_nodes, n_kinds, n_players, seed=0):
+        rnd = random.Random(seed)
+        self.pieces = [[[rnd.getrandbits(64) for i in range(n_nodes)]
+                        for o in range(n_players)]
+                       for k in range(n_kinds)]
+        self.movers = [rnd.getrandbits(64) for o in range(n_players)]
+        self.perspectives = [rnd.getrandbits(64) for o in range(n_players)]
+        self.upcoming = [[rnd.getrandbits(64) for o in range(n_players)]
+                         for k in range(n_players-1)]
+
+    def key(self, node, kind, owner):
+        return self.pieces[kind][owner][node]
+
+class TranspositionTable:
+    """
+    A bounded table of search results indexed by position keys.
+
+    There are size slots (rounded up to a power of two), the slot of a key
+    is given by its low bits. An entry in a slot is replaced if it belongs
+    to the same position, to an earlier search (see new_search), or if it
+    was searched to at most the depth of the new entry. Otherwise the new
+    entry is dropped.
+
+    Entries are tuples (depth, value, move, flag, generation). value and
+    move are not interpreted by the table; moves should be stored as
+    (start, end) node indices so that the table can be shared between games.
+    """
+    def __init__(self, size=2**18):
+        n = 1
+        while n<size:
+            n *= 2
+        self.size = n
+        self.mask = n-1
+        self.keys = [None]*n
+        self.entries = [None]*n
+        self.generation = 0
+        self.filled = 0
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.replacements = 0
+        self.rejections = 0
+
+    def lookup(self, key):
+        i = key & self.mask
+        if self.keys[i]==key:
+            self.hits += 1
+            return self.entries[i]
+        self.misses += 1
+        return None
+
+    def store(self, key, depth, value, move=None, flag=EXACT):
+        """
+        Store a search result, returns False if the slot was kept for a
+        more valuable entry.
+        """
+        i = key & self.mask
+        old_key = self.keys[i]
+        if old_key is None:
+            self.filled += 1
+        elif old_key!=key:
+            old = self.entries[i]
+            if old[4]==self.generation and old[0]>depth:
+                self.rejections += 1
+                return False
+            self.replacements += 1
+        self.keys[i] = key
+        self.entries[i] = (depth, value, move, flag, self.generation)
+        self.stores += 1
+        return True
+
+    def new_search(self):
+        """
+        Mark all present entries as old, so that they are replaced first.
+        """
+        self.generation += 1
+
+    def clear(self):
+        self.keys = [None]*self.size
+        self.entries = [None]*self.size
+        self.filled = 0
+        self.reset_counters()
+
+    def hit_rate(self):
+        probes = self.hits + self.misses
+        if probes==0:
+            return 0.
+        return float(self.hits)/probes
+
+    def stats(self):
+        return {'size': self.size, 'filled': self.filled,
+                'hits': self.hits, 'misses': self.misses,
+                'stores': self.stores, 'replacements': self.replacements,
+                'rejections': self.rejections}
+
+    def __len__(self):
+        return self.filled
+
+    def __str__(self):
+        return ("TranspositionTable %d/%d filled, %d hits, %d misses (%.1f%%)"
+                % (self.filled, self.size, self.hits, self.misses, 100*self.hit_rate()))